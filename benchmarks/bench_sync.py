@@ -0,0 +1,153 @@
+"""Offline benchmark of `SyncEnrollments.pull` and the Conduit push
+against local stand-ins of Moodle, PowerCampus and the Conduit SFTP
+server.
+
+PowerCampus queries are sharded by `PC_SHARDS` and Moodle requests
+bounded by `MDL_CONCURRENCY` as in production.
+
+Example:
+    $ python -m benchmarks.bench_sync --shells 10000 --latency 0.05
+"""
+from benchmarks.fakes import FakeMoodle, MoodleProcess, LocalConduitSession, SqlitePcConnect
+from benchmarks.generate import (generate_mapping, generate_enrollments, write_powercampus,
+                                 TERM, YEAR)
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.utils.mdltools import mdl_connect
+from mdlpipeline.utils.mdltools.mdl_connect import create_session
+from mdlpipeline.utils.profiling import Profiler
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+
+async def run_pipeline(mapping, db_h, conduit, profile=None):
+    """Pull, diff and push once against running stand-ins, profiled
+    into the `profile` directory when given.
+
+    Returns:
+        tuple: pulled `SyncEnrollments` and seconds spent pushing
+    """
+    session = create_session()
+    profiler = Profiler('benchmark', profile) if profile else contextlib.nullcontext()
+    try:
+        async with profiler:
+            se = await SyncEnrollments.pull(mapping, session=session, db_h=db_h, conduit=conduit,
+                                            term=TERM, year=YEAR)
+            start = time.perf_counter()
+            await se.push()
+            return se, time.perf_counter() - start
+    finally:
+        await session.close()
+
+
+def run_benchmark(shells=1000, students=30, drift=0.05, latency=0.0, error_rate=0.0,
+                  sftp_latency=0.0, seed=0, workdir=None, profile=None):
+    """Generate a synthetic term of `shells` Moodle courses, sync it once
+    and measure the pipeline.
+
+    Args:
+        shells (int): number of Moodle courses in the mapping
+        students (int): maximum students per PowerCampus section
+        drift (float): share of enrollments Moodle is missing, and of
+        extra enrollments it has
+        latency (float): seconds the Moodle stand-in adds per request
+        error_rate (float): share of Moodle requests failing with HTTP 503
+        sftp_latency (float): seconds the SFTP stand-in adds per request
+        seed (int): random seed
+        workdir (str): directory for the generated data, logs and Conduit
+        files, a temporary directory by default
+        profile (str): directory to write a `Profiler` profile of the run
+        to, None for none
+
+    Returns:
+        dict: stage timings in seconds, peak traced memory, throughput and
+        counters of the run
+    """
+    with (tempfile.TemporaryDirectory() if workdir is None
+          else contextlib.nullcontext(workdir)) as workdir:
+        start = time.perf_counter()
+        mapping = generate_mapping(shells, seed)
+        rows, rosters, expected = generate_enrollments(mapping, students, drift, seed=seed)
+        db_path = os.path.join(workdir, 'powercampus.sqlite')
+        write_powercampus(db_path, rows)
+        generated = time.perf_counter() - start
+
+        db_h = SqlitePcConnect(db_path)
+        conduit = LocalConduitSession(os.path.join(workdir, 'sftp'), sftp_latency)
+        url, cwd = mdl_connect.URL, os.getcwd()
+        with MoodleProcess(FakeMoodle(rosters, latency, error_rate, seed)) as moodle:
+            mdl_connect.URL = moodle.url
+            # the Conduit log is written relative to the working directory
+            os.chdir(workdir)
+            if profile:
+                profile = os.path.join(cwd, profile)
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                se, pushed = asyncio.run(run_pipeline(mapping, db_h, conduit, profile))
+                total = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+                os.chdir(cwd)
+                mdl_connect.URL = url
+
+    changes = sum(len(df) for df in se.conduit_dfs.values())
+    return {
+        'shells': shells,
+        'pc_rows': len(rows),
+        'moodle_enrolments': sum(len(roster) for roster in rosters.values()),
+        'expected_changes': expected,
+        'changes': changes,
+        'generate': generated,
+        **se.timings,
+        'push': pushed,
+        'total': total,
+        'peak_mb': peak / 2 ** 20,
+        'shells_per_s': shells / total,
+        'changes_per_s': changes / total,
+        'moodle_requests': moodle.requests,
+        'moodle_errors': moodle.errors,
+        'wc_pull_errors': len(se.wc_pull_errors),
+        'pc_queries': db_h.queries,
+        'sftp_connections': conduit.connections,
+    }
+
+
+def report(results):
+    """Format benchmark `results` as aligned lines.
+    """
+    width = max(len(name) for name in results)
+    return '\n'.join(f'{name:<{width}}  {value:.3f}' if isinstance(value, float)
+                     else f'{name:<{width}}  {value}' for name, value in results.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shells', type=int, default=1000)
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--drift', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--sftp-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', help='profile the run into this directory')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    results = run_benchmark(args.shells, args.students, args.drift, args.latency,
+                            args.error_rate, args.sftp_latency, args.seed,
+                            profile=args.profile)
+    print(report(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+from mdlpipeline.utils.mdltools.conduit import ConduitSession
+from mdlpipeline.utils.sqltools.pc_connect import PcConnect
+from mdlpipeline.utils.sqltools.query_tools import Query
+
+from aiohttp import web
+from contextlib import contextmanager
+from datetime import datetime
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import time
+
+ENDPOINT = '/webservice/rest/server.php'
+
+
+class FakeMoodle():
+    """Local aiohttp server imitating the Moodle Web Services endpoint for
+    core_enrol_get_enrolled_users, including the `userfields`, `limitfrom`
+    and `limitnumber` options.
+
+    Args:
+        rosters (dict): Moodle courseid as key and dictionary of idnumber
+        and list of roleids as value
+        latency (float): seconds added to every response
+        error_rate (float): share of requests answered with HTTP 503
+        seed (int): random seed of the injected errors
+
+    Attributes:
+        url (str): base URL of the running server
+        requests (int): requests received
+        errors (int): errors injected
+        peers (set): client addresses requests came from, one per
+        TCP connection
+    """
+    def __init__(self, rosters, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.users = {}
+        self.userids = {}
+        for courseid, roster in rosters.items():
+            self.users[courseid] = [
+                {'id': self.userids.setdefault(idnumber, len(self.userids) + 2),
+                 'idnumber': idnumber, 'roles': [{'roleid': roleid} for roleid in roleids]}
+                for idnumber, roleids in roster.items()]
+        self.url = None
+        self.requests = 0
+        self.errors = 0
+        self.peers = set()
+        self._runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post(ENDPOINT, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.url = 'http://{}:{}/'.format(*self._runner.addresses[0][:2])
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info('peername'))
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+        if form.get('wsfunction') != 'core_enrol_get_enrolled_users':
+            return web.json_response({'exception': 'webservice_access_exception',
+                                      'message': 'Access control exception'})
+        options = {form[key]: form[key[:-len('[name]')] + '[value]']
+                   for key in form if key.startswith('options[') and key.endswith('[name]')}
+        users = self.users.get(int(form['courseid']), [])
+        start = int(options.get('limitfrom', 0))
+        limit = int(options.get('limitnumber', 0)) or len(users)
+        fields = set(options.get('userfields', 'id,idnumber,roles').split(',')) | {'id'}
+        page = [{field: user[field] for field in fields if field in user}
+                for user in users[start:start + limit]]
+        return web.Response(body=json.dumps(page).encode(), content_type='application/json')
+
+
+def serve(moodle, messages, stop):
+    async def run():
+        messages.put(await moodle.start())
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        messages.put((moodle.requests, moodle.errors))
+        await moodle.close()
+    asyncio.run(run())
+
+
+class MoodleProcess():
+    """Run a `FakeMoodle` in a child process, so serving requests does not
+    compete with the pipeline for the event loop or show in its traced
+    memory.
+
+    Example:
+        >>> with MoodleProcess(FakeMoodle(rosters)) as moodle:
+        ...     print(moodle.url)
+    """
+    def __init__(self, moodle):
+        self.moodle = moodle
+        self.url = None
+        self.requests = 0
+        self.errors = 0
+
+    def __enter__(self):
+        self._messages = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=serve, daemon=True,
+                                                args=(self.moodle, self._messages, self._stop))
+        self._process.start()
+        self.url = self._messages.get(timeout=60)
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self.requests, self.errors = self._messages.get(timeout=60)
+        self._process.join()
+
+
+class SqlitePcConnect(PcConnect):
+    """PowerCampus handler running the roster queries on a SQLite database
+    written by `benchmarks.generate.write_powercampus`.
+
+    Statements are translated from T-SQL: the "dbo." schema, N'' literals,
+    casts to date and time, "#" temporary tables and "@" parameters. Every borrow opens its own
+    connection, so sharded pulls run in parallel as on SQL Server.
+
+    Args:
+        path (str): location of the SQLite database
+        query_cache (QueryCache): cache of query results, None for none
+    """
+    def __init__(self, path, query_cache=None):
+        self.path = path
+        self.query_cache = query_cache
+        self.queries = 0
+
+    def close(self):
+        pass
+
+    def cache_scope(self):
+        return self.path
+
+    @contextmanager
+    def connect_to_db(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            yield connection.cursor()
+        finally:
+            connection.close()
+
+    def translate(self, sql):
+        sql = sql.replace('dbo.', '')
+        sql = re.sub(r"\bN'", "'", sql)
+        sql = re.sub(r'CAST\(([\w.@]+) AS (date|time)\)', r'\2(\1)', sql)
+        sql = re.sub(r'#(\w+)', r'temp.\1', sql)
+        return re.sub(r'@(\w+)', r':\1', sql)
+
+    def execute(self, cursor, query):
+        self.queries += 1
+        if not isinstance(query, Query):
+            cursor.execute(self.translate(query))
+            return
+        for table in query.tables:
+            self.load_table(cursor, table)
+        cursor.execute(self.translate(query.sql),
+                       {name: value.isoformat(' ') if isinstance(value, datetime) else value
+                        for name, _, value in query.params})
+
+    def load_table(self, cursor, table):
+        self.drop_table(cursor, table.name)
+        name = table.name.lstrip('#')
+        cursor.execute(f'CREATE TEMP TABLE {name} '
+                       f'({", ".join(column for column, _ in table.columns)})')
+        cursor.executemany(f'INSERT INTO temp.{name} VALUES '
+                           f'({", ".join(["?"] * len(table.columns))})', table.rows)
+
+    def drop_table(self, cursor, name):
+        cursor.execute(f'DROP TABLE IF EXISTS temp.{name.lstrip("#")}')
+
+
+class LocalFile():
+    """Writable file of `LocalSftp`, with the paramiko `SFTPFile` methods
+    the Conduit push uses.
+    """
+    def __init__(self, path, mode, latency=0.0):
+        self.f = open(path, mode)
+        self.latency = latency
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def write(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.f.write(data.encode() if isinstance(data, str) else data)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalSftp():
+    """SFTP stand-in storing files under a local `root` directory, adding
+    `latency` seconds to every request like a network round trip.
+    """
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+
+    def local_path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def stat(self, path):
+        self.wait()
+        return os.stat(self.local_path(path))
+
+    def open(self, path, mode):
+        self.wait()
+        os.makedirs(os.path.dirname(self.local_path(path)), exist_ok=True)
+        return LocalFile(self.local_path(path), mode, self.latency)
+
+    def rename(self, path, new_path):
+        self.wait()
+        os.replace(self.local_path(path), self.local_path(new_path))
+
+    def close(self):
+        pass
+
+
+class LocalConduitSession(ConduitSession):
+    """Conduit session over a `LocalSftp` rooted at `root`.
+
+    Attributes:
+        connections (int): number of connections opened
+    """
+    def __init__(self, root, latency=0.0):
+        super().__init__(host='localhost', password='')
+        self.root = root
+        self.latency = latency
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        # SSH handshake and authentication take a few round trips
+        time.sleep(4 * self.latency)
+        return LocalSftp(self.root, self.latency)
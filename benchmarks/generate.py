@@ -0,0 +1,145 @@
+from datetime import datetime
+import random
+import sqlite3
+
+TERM = 'Winter'
+YEAR = '2021'
+PROGRAMS = ('CHIRO', 'NUTRIT', 'CLMH')
+SECTIONS = ('01', '02', '03')
+STUDENT_ROLEID = 5
+AUDITING_ROLEID = 14
+# Revision time stamped on generated PowerCampus rows
+REVISED = datetime(2021, 1, 4, 12)
+
+
+def generate_mapping(shells, seed=0, cross_listed=0.2, sectioned=0.4):
+    """Synthetic Moodle to PowerCampus mapping of `shells` courses, in the
+    format of `data/wc_pc_mapping_wi21.json`.
+
+    Args:
+        shells (int): number of Moodle courses
+        seed (int): random seed
+        cross_listed (float): share of courses fed by two PowerCampus
+        courses
+        sectioned (float): share of courses fed by a single section
+
+    Returns:
+        dict: Moodle shortname as key and dictionary of "courses", optional
+        "section" and "id" as value
+    """
+    rng = random.Random(seed)
+    catalog = [f'{dept}{number}' for dept in ('BSC', 'COUN', 'NUTR', 'CHIR', 'ACUP', 'MSCI')
+               for number in range(5000, 5000 + max(1, shells))]
+    rng.shuffle(catalog)
+    mapping = {}
+    for i in range(shells):
+        courses = [catalog[i]]
+        if rng.random() < cross_listed:
+            courses.append(catalog[(i + shells) % len(catalog)])
+        entry = {'courses': courses, 'id': 10000 + i}
+        if rng.random() < sectioned:
+            entry['section'] = rng.choice(SECTIONS)
+        mapping[''.join(courses) + entry.get('section', '') + TERM + YEAR] = entry
+    return mapping
+
+
+def generate_enrollments(mapping, students=30, drift=0.05, audit=0.03, seed=0):
+    """Synthetic PowerCampus enrollments of the courses in `mapping` and
+    Moodle rosters that differ from them by `drift`.
+
+    Every section of every mapped PowerCampus course gets about `students`
+    students. Moodle rosters hold the expected roster of each course less
+    a `drift` share of its students, plus as many students who should not
+    be enrolled, so a sync finds about `2 * drift` changes per enrollment.
+
+    Returns:
+        tuple: list of (idnumber, course, section, final grade) PowerCampus
+        rows, dictionary of Moodle courseid as key and dictionary of
+        idnumber and list of roleids as value, and the number of add/drop
+        records a sync should find
+    """
+    rng = random.Random(seed)
+    pool = [f'{i:07d}' for i in range(1, max(2, len(mapping) * students // 4))]
+    courses = sorted({course for entry in mapping.values() for course in entry['courses']})
+    enrolled = {}
+    rows = []
+    for course in courses:
+        for section in SECTIONS:
+            members = rng.sample(pool, min(len(pool), rng.randint(students // 2, students)))
+            enrolled[course, section] = members
+            for idnumber in members:
+                grade = 'AU' if rng.random() < audit else ''
+                rows.append((idnumber, course, section, grade))
+            # withdrawn students are filtered by the roster queries
+            rows.append((rng.choice(pool), course, section, 'W'))
+
+    roles = {(idnumber, course, section): STUDENT_ROLEID if grade != 'AU' else AUDITING_ROLEID
+             for idnumber, course, section, grade in rows if grade != 'W'}
+    moodle = {}
+    changes = 0
+    extra = len(pool)
+    for entry in mapping.values():
+        sections = [entry['section']] if 'section' in entry else SECTIONS
+        expected = {}
+        for course in entry['courses']:
+            for section in sections:
+                for idnumber in enrolled[course, section]:
+                    expected.setdefault(idnumber, set()).add(roles[idnumber, course, section])
+        roster = {}
+        for idnumber, roleids in expected.items():
+            if rng.random() < drift:
+                changes += len(roleids)
+            else:
+                roster[idnumber] = sorted(roleids)
+        for _ in range(sum(rng.random() < drift for _ in expected)):
+            extra += 1
+            roster[f'{extra:07d}'] = [STUDENT_ROLEID]
+            changes += 1
+        moodle[entry['id']] = roster
+    return rows, moodle, changes
+
+
+def write_powercampus(path, rows, term=TERM, year=YEAR, revised=REVISED):
+    """Write PowerCampus `rows` of `generate_enrollments` to a SQLite
+    database with the tables and columns the roster queries read. Every
+    row is stamped as revised at datetime `revised`, split like
+    PowerCampus into a REVISION_DATE day and a REVISION_TIME time of day
+    on 1900-01-01.
+    """
+    con = sqlite3.connect(path)
+    con.executescript('''
+        DROP TABLE IF EXISTS TRANSCRIPTDETAIL;
+        DROP TABLE IF EXISTS SECTIONS;
+        DROP TABLE IF EXISTS PEOPLE;
+        DROP TABLE IF EXISTS ACADEMIC;
+        CREATE TABLE TRANSCRIPTDETAIL (
+            PEOPLE_CODE_ID TEXT, EVENT_ID TEXT, SECTION TEXT, EVENT_LONG_NAME TEXT,
+            ACADEMIC_YEAR TEXT, ACADEMIC_TERM TEXT, ACADEMIC_SESSION TEXT,
+            ADD_DROP_WAIT TEXT, FINAL_GRADE TEXT, REVISION_DATE TEXT, REVISION_TIME TEXT);
+        CREATE TABLE SECTIONS (
+            EVENT_ID TEXT, SECTION TEXT, EVENT_LONG_NAME TEXT,
+            ACADEMIC_YEAR TEXT, ACADEMIC_TERM TEXT);
+        CREATE TABLE PEOPLE (PEOPLE_CODE_ID TEXT PRIMARY KEY, FIRST_NAME TEXT, LAST_NAME TEXT);
+        CREATE TABLE ACADEMIC (
+            PEOPLE_CODE_ID TEXT, ACADEMIC_YEAR TEXT, ACADEMIC_TERM TEXT,
+            ACADEMIC_SESSION TEXT, ENROLL_SEPARATION TEXT, CURRICULUM TEXT,
+            REVISION_DATE TEXT, REVISION_TIME TEXT);
+    ''')
+    revision = (f'{revised:%Y-%m-%d} 00:00:00', f'1900-01-01 {revised:%H:%M:%S}')
+    con.executemany('INSERT INTO TRANSCRIPTDETAIL VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((f'P{idnumber}', course, section, course, year, term, '', 'A', grade,
+                      *revision)
+                     for idnumber, course, section, grade in rows))
+    courses = sorted({course for _, course, _, _ in rows})
+    con.executemany('INSERT INTO SECTIONS VALUES (?, ?, ?, ?, ?)',
+                    ((course, '01', course, year, term) for course in courses))
+    people = sorted({idnumber for idnumber, _, _, _ in rows})
+    con.executemany('INSERT INTO PEOPLE VALUES (?, ?, ?)',
+                    ((f'P{idnumber}', 'First', 'Last') for idnumber in people))
+    con.executemany('INSERT INTO ACADEMIC VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((f'P{idnumber}', year, term, '', 'ENRL', PROGRAMS[i % len(PROGRAMS)],
+                      *revision)
+                     for i, idnumber in enumerate(people)))
+    con.execute('CREATE INDEX transcript_event ON TRANSCRIPTDETAIL (EVENT_ID, SECTION)')
+    con.commit()
+    con.close()
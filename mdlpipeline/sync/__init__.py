@@ -1,5 +1,14 @@
-from . import enrollments
-
-name = "sync"
-
-__all__ = ["enrollments"]
\ No newline at end of file
+from . import daemon
+from . import diff
+from . import enrollments
+from . import incremental
+from . import ledger
+from . import mapping
+from . import partition
+from . import rosters
+from . import runner
+from . import warm
+
+name = "sync"
+
+__all__ = ["daemon", "diff", "enrollments", "incremental", "ledger", "mapping", "partition", "rosters", "runner", "warm"]
\ No newline at end of file
@@ -0,0 +1,257 @@
+from mdlpipeline.utils import metrics, profiling
+
+from datetime import date, datetime
+from os import getenv
+import asyncio
+import os
+import signal
+import time
+
+# Seconds between cycles in normal operation
+INTERVAL = int(getenv('SYNC_INTERVAL', 15 * 60))
+# Seconds between cycles during add/drop periods or after a large diff
+MIN_INTERVAL = int(getenv('SYNC_MIN_INTERVAL', 5 * 60))
+# Upper bound the interval backs off to while nothing changes
+MAX_INTERVAL = int(getenv('SYNC_MAX_INTERVAL', 60 * 60))
+# Records in a cycle's diffs from which the next cycle runs after MIN_INTERVAL
+BUSY_CHANGES = 200
+# Add/drop periods as "YYYY-MM-DD/YYYY-MM-DD" ranges separated by ";"
+ADD_DROP_PERIODS = getenv('SYNC_ADD_DROP_PERIODS', '')
+
+CYCLE_SECONDS = metrics.histogram('sync_cycle_seconds', 'Duration of sync cycles')
+LAST_CYCLE_SECONDS = metrics.gauge('sync_last_cycle_seconds', 'Duration of the last sync cycle')
+LAST_CYCLE_CHANGES = metrics.gauge('sync_last_cycle_changes', 'Add/drop records of the last cycle')
+LAST_CYCLE_TIME = metrics.gauge('sync_last_cycle_timestamp_seconds',
+                                'Unix time the last sync cycle finished')
+INTERVAL_SECONDS = metrics.gauge('sync_interval_seconds', 'Seconds until the next sync cycle')
+CYCLES = metrics.counter('sync_cycles_total', 'Sync cycles run')
+OVERRUNS = metrics.counter('sync_cycle_overruns_total',
+                           'Sync cycles that took longer than their interval')
+FAILURES = metrics.counter('sync_cycle_failures_total', 'Sync cycles that failed')
+
+
+def parse_periods(periods):
+    """Parse "YYYY-MM-DD/YYYY-MM-DD;..." into a list of (start, end) dates.
+    """
+    return [tuple(date.fromisoformat(day.strip()) for day in period.split('/'))
+            for period in periods.split(';') if period.strip()]
+
+
+class SyncDaemon():
+    """Long-lived asyncio daemon running a `SyncRunner` on an adaptive
+    interval.
+
+    The Moodle HTTP session, Moodle roster snapshot, pending change ledger,
+    PowerCampus connection pool, Conduit SFTP session and every job's
+    mapping and PowerCampus cache stay open across cycles. Cycles never
+    overlap: a tick that comes due while a cycle is running is coalesced
+    into a single cycle started as soon as the running one finishes.
+
+    The interval is `min_interval` during add/drop periods and after a
+    cycle with at least `busy_changes` records, doubles up to
+    `max_interval` while cycles find nothing to change, and is `interval`
+    otherwise, including after a failed cycle.
+
+    SIGINT or SIGTERM stop the daemon once the running cycle finished; a
+    second signal cancels the running cycle. Resources are closed on exit.
+
+    Cycle metrics, and the stage, request and query metrics of the
+    pipeline, are written to `metrics_textfile` after every cycle and
+    served at /metrics on `metrics_port`, when set.
+
+    The first `profile_cycles` cycles are profiled with
+    `profiling.Profiler`, and so is the cycle after SIGUSR1, a call to
+    `profile_next` or the creation of the `profile_trigger` file, which is
+    removed when the cycle starts. Profiles are written under
+    `profile_dir`.
+
+    Args:
+        runner (SyncRunner): jobs run on every cycle
+        interval (float): seconds between cycles in normal operation
+        min_interval (float): seconds between cycles when busy
+        max_interval (float): maximum seconds between cycles when idle
+        busy_changes (int): records from which a cycle counts as busy
+        add_drop_periods (list): list of (start, end) dates, inclusive
+        metrics_textfile (str): Prometheus textfile to write, None for none
+        metrics_port (int): port of the metrics endpoint, 0 for none
+        profile_cycles (int): cycles to profile from the start
+        profile_trigger (str): file requesting a profile of the next cycle
+        profile_dir (str): directory profiles are written to
+
+    Attributes:
+        cycles (int): number of cycles run
+        next_interval (float): seconds until the next cycle
+    """
+    def __init__(self, runner, interval=INTERVAL, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, busy_changes=BUSY_CHANGES,
+                 add_drop_periods=None, metrics_textfile=metrics.TEXTFILE,
+                 metrics_port=metrics.PORT, profile_cycles=profiling.PROFILE_CYCLES,
+                 profile_trigger=profiling.PROFILE_TRIGGER,
+                 profile_dir=profiling.PROFILE_DIR):
+        self.runner = runner
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.busy_changes = busy_changes
+        self.add_drop_periods = (parse_periods(ADD_DROP_PERIODS) if add_drop_periods is None
+                                 else add_drop_periods)
+        self.metrics_textfile = metrics_textfile
+        self.metrics_port = metrics_port
+        self.profile_cycles = profile_cycles
+        self.profile_trigger = profile_trigger
+        self.profile_dir = profile_dir
+        self.cycles = 0
+        self.next_interval = interval
+        self._stop = None
+        self._wake = None
+        self._cycle = None
+
+    def in_add_drop(self, day=None):
+        day = day or date.today()
+        return any(start <= day <= end for start, end in self.add_drop_periods)
+
+    def get_interval(self, changes):
+        """Seconds to wait after a cycle that found `changes` records,
+        None if it failed.
+        """
+        if self.in_add_drop():
+            return self.min_interval
+        if changes is None:
+            # a failed cycle says nothing about how busy the term is
+            return self.interval
+        if changes >= self.busy_changes:
+            return self.min_interval
+        if changes == 0:
+            return min(self.max_interval, max(self.interval, self.next_interval * 2))
+        return self.interval
+
+    def trigger(self):
+        """Run a cycle now, or right after the running one.
+        """
+        self._wake.set()
+
+    def stop(self):
+        """Stop after the running cycle; cancel it if already stopping.
+        """
+        if self._stop.is_set() and self._cycle is not None:
+            self._cycle.cancel()
+        self._stop.set()
+        self._wake.set()
+
+    def profile_next(self):
+        """Profile the next cycle.
+        """
+        self.profile_cycles += 1
+
+    def take_profile(self):
+        """Whether to profile the cycle about to start.
+        """
+        if self.profile_trigger and os.path.exists(self.profile_trigger):
+            try:
+                os.remove(self.profile_trigger)
+            except OSError as err:
+                print(f'profile trigger not removed: {err!r}')
+            self.profile_next()
+        if self.profile_cycles > 0:
+            self.profile_cycles -= 1
+            return True
+        return False
+
+    async def open(self):
+        await self.runner.open()
+
+    async def close(self):
+        await self.runner.close()
+
+    async def run_cycle(self, profile=False):
+        """Run all jobs once, under a profiler if `profile`. A failing
+        cycle is reported and does not stop later cycles.
+
+        Returns:
+            int: number of add/drop records of all jobs, None if the
+            cycle failed
+        """
+        try:
+            if not profile:
+                return await self.runner.run()
+            async with profiling.Profiler(f'cycle{self.cycles + 1}',
+                                          self.profile_dir) as profiler:
+                changes = await self.runner.run()
+            print(f'cycle profile written to {profiler.path}')
+            return changes
+        except Exception as err:
+            print(f'sync cycle failed: {err!r}')
+            FAILURES.inc()
+            metrics.log_event('sync_cycle_failed', cycle=self.cycles + 1, error=repr(err))
+            return None
+
+    def record_cycle(self, changes, elapsed, interval):
+        """Record metrics of a cycle that took `elapsed` seconds out of
+        its `interval` and found `changes` records, None if it failed, and
+        write the metrics textfile.
+        """
+        CYCLES.inc()
+        CYCLE_SECONDS.observe(elapsed)
+        LAST_CYCLE_SECONDS.set(elapsed)
+        if changes is not None:
+            LAST_CYCLE_CHANGES.set(changes)
+        LAST_CYCLE_TIME.set(time.time())
+        INTERVAL_SECONDS.set(self.next_interval)
+        if elapsed > interval:
+            OVERRUNS.inc()
+        metrics.log_event('sync_cycle', cycle=self.cycles, changes=changes, seconds=elapsed,
+                          interval=interval, overrun=elapsed > interval,
+                          next_interval=self.next_interval)
+        if self.metrics_textfile:
+            try:
+                metrics.REGISTRY.write_textfile(self.metrics_textfile)
+            except OSError as err:
+                print(f'metrics textfile not written: {err!r}')
+
+    async def run(self):
+        """Run cycles until stopped.
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._wake = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        loop.add_signal_handler(signal.SIGUSR1, self.profile_next)
+        server = None
+        if self.metrics_port:
+            server = await metrics.REGISTRY.serve(self.metrics_port)
+        await self.open()
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                start = loop.time()
+                self._cycle = asyncio.ensure_future(self.run_cycle(self.take_profile()))
+                try:
+                    changes = await self._cycle
+                except asyncio.CancelledError:
+                    if self._stop.is_set():
+                        break
+                    raise
+                finally:
+                    self._cycle = None
+                self.cycles += 1
+                interval, self.next_interval = self.next_interval, self.get_interval(changes)
+                elapsed = loop.time() - start
+                self.record_cycle(changes, elapsed, interval)
+                print(f'cycle {self.cycles} at {datetime.now()}: '
+                      f'{"failed" if changes is None else f"{changes} changes"} in '
+                      f'{elapsed:.1f}s, next in {self.next_interval:.0f}s')
+                # a late tick runs right away, once, however many were missed
+                delay = max(0, self.next_interval - elapsed)
+                if self._wake.is_set():
+                    delay = 0
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+                loop.remove_signal_handler(signum)
+            await self.close()
+            if server is not None:
+                await server.cleanup()
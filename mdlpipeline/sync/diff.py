@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+CONDUIT_COLUMNS = ['action', 'shortname', 'idnumber', 'role']
+
+
+def expand_keys(pairs, key_codes, role_codes, idnumbers):
+    """Expand enrollments of roster keys to every Moodle course fed by the
+    key, combining cross-listed courses in one merge.
+
+    Args:
+        pairs (list): list of (key code, shortname code) tuples
+        key_codes, role_codes, idnumbers: arrays from `RosterStore.flatten`
+
+    Returns:
+        tuple: arrays of shortname codes, role codes and idnumbers
+    """
+    pairs = pd.DataFrame(pairs, columns=['key', 'shortname'], dtype=np.int64)
+    enrollments = pd.DataFrame({'key': key_codes, 'role': role_codes, 'idnumber': idnumbers})
+    expanded = enrollments.merge(pairs, on='key')
+    return (expanded.shortname.to_numpy(np.int64), expanded.role.to_numpy(np.int64),
+            expanded.idnumber.to_numpy())
+
+
+def diff_enrollments(shortnames, expected, actual, roles, drops=True, decode=None):
+    """Compute Conduit add/drop records for all courses and roles in one
+    pass. Each enrollment is encoded as a single integer over
+    (shortname, role, idnumber) and the two sides are anti-joined with
+    sorted set differences.
+
+    Args:
+        shortnames (list): Moodle shortnames indexed by shortname code
+        expected (tuple): arrays of shortname codes, role codes and
+        idnumbers (or idnumber codes) of enrollments that should exist
+        (PowerCampus)
+        actual (tuple): same for enrollments that do exist (Moodle)
+        roles (tuple): role names indexed by role code
+        drops (bool): False to only compute adds
+        decode (callable): maps idnumber codes back to idnumbers, if the
+        idnumbers of `expected` and `actual` are codes
+
+    Returns:
+        pandas.DataFrame: Containing add/drop records to submit to conduit
+    """
+    id_codes, id_uniques = pd.factorize(np.concatenate([expected[2], actual[2]]))
+    n_roles, n_ids = len(roles), max(len(id_uniques), 1)
+
+    def encode(side, id_side):
+        return np.unique((side[0] * n_roles + side[1]) * n_ids + id_side)
+
+    expected_codes = encode(expected, id_codes[:len(expected[2])])
+    actual_codes = encode(actual, id_codes[len(expected[2]):])
+    add_codes = np.setdiff1d(expected_codes, actual_codes, assume_unique=True)
+    drop_codes = (np.setdiff1d(actual_codes, expected_codes, assume_unique=True)
+                  if drops else np.empty(0, dtype=np.int64))
+
+    codes = np.concatenate([add_codes, drop_codes])
+    if decode is not None:
+        id_uniques = decode(np.asarray(id_uniques))
+    return pd.DataFrame({
+        'action': np.repeat(np.array(['add', 'drop'], dtype=object),
+                            [len(add_codes), len(drop_codes)]),
+        'shortname': np.asarray(shortnames, dtype=object)[codes // (n_roles * n_ids)],
+        'idnumber': np.asarray(id_uniques, dtype=object)[codes % n_ids],
+        'role': np.asarray(roles, dtype=object)[(codes // n_ids) % n_roles],
+    }, columns=CONDUIT_COLUMNS)
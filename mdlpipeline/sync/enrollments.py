@@ -1,275 +1,739 @@
-from mdlpipeline.utils.mdltools.mdl_connect import *
-from mdlpipeline.utils.sqltools.queries import *
-from mdlpipeline.utils.mdltools.conduit import put_conduit_file
-from mdlpipeline.utils.sqltools.pc_connect import PcConnect
-
-import pandas as pd
-import json
-from functools import reduce
-from datetime import datetime
-from urllib.error import HTTPError
-from aiohttp import ClientSession
-import asyncio
-
-TERM = 'Winter'
-YEAR = '2021'
-TERM_YEAR = TERM + YEAR
-
-class SyncEnrollments():
-    """SyncEnrollments contains a end-to-end ETL pipeline for syncronizing
-    enrollments from PowerCampus (SIS) and Moodle (LMS). First, it pulling
-    enrollment data from both a PowerCampus production database and Moodle
-    Web Services API, computing the difference in rosters, translating
-    results intoConduit CSV file format, and pushing a file to Moodles'
-    Conduit middleware system via SFTP.
-
-    Args:
-        mapping (dict) : Dictionary of JSON mapping file with Moodle
-        shortname as key and dictionary containing "courses" (list of str),
-        "section" (str), "id" (int) as key-values.
-
-    Attributes:
-        mapping (dict): Dictionary of JSON mapping file 
-        courseids (list): List of all Moodle courseids to syncronize
-        sync_audits (bool): True to sync auditing students, False otherwise.
-        wc_rosters (dict): Dictionary of course name and section as key and
-        dictionary with "students" and "auditingstudents" keys containing
-        sets of student idnumbers as values.
-        pc_rosters (dict):Dictionary with course and section name as key
-        and dictionary containing student roles as keys and
-        sets of student idnumbers as values.
-        conduit_dfs (dict): Dictionary of Pandas DataFrames to be pushed
-    """
-    def __init__(self, mapping):
-        self.mapping = mapping
-        self.courseids = [self.mapping[course]["id"] for course in self.mapping]
-        self.sync_audits = True
-        self.wc_pull_errors = []
-        self.wc_rosters = {}
-        self.pc_rosters = {}
-        self.conduit_dfs = {}
-
-    @classmethod
-    async def pull(cls, mapping):
-        """Primary class factory for creating a SyncEnrollments
-        instance and running extract methods for data pull.
-
-        Args:
-            mapping (dict) : Dictionary of JSON mapping file with Moodle
-            shortname as key and dictionary containing "courses" (list of str),
-            "section" (str), "id" (int) as key-values.
-
-        Returns:
-            SyncEnrollments: instance of class with  values for `pc_roster`,
-            `wc_roster`, and `conduit_dfs` attributes.
-        """
-        self = cls(mapping)
-        # pulls from Moodle WebServices API via asynchonous POST
-        self.wc_rosters = await self.get_wc_rosters()
-        # pulls from PowerCampus SQL database with pymssql handler
-        self.pc_rosters = self.get_pc_rosters()
-        self.conduit_dfs['enrollments'] = self.get_conduit_enrollments('student')
-
-        if self.sync_audits:
-            self.conduit_dfs['enrollments'] = pd.concat([
-                self.conduit_dfs['enrollments'],
-                self.get_conduit_enrollments('auditingstudent')])
-        return self
-
-    async def get_wc_rosters(self):
-        """Wrapper to get enrollment data from Moodle
-        WebServices API asynchronously.
-
-        Returns:
-            dict: Dictionary of courseid and as key and dictionary
-        with "students" and "auditingstudents" keys containing sets
-        of student idnumbers as values.
-
-        Example:
-            {4423: {"student": {0023} "auditingstudent": {}}}
-        """
-        wcr = WebCampusRosters(self.courseids)
-        rosters = await wcr.get_rosters()
-        self.wc_pull_errors = wcr.errors
-        return rosters
-
-    def get_courses(self):
-        """Get list of courses and list of sectioned courses
-
-        Returns:
-            tuple: tuple of lists first containing all course names
-            without sections and second containing all course names
-            with sections.
-        """
-        courses = [course for key in self.mapping
-                    for course in self.mapping[key]["courses"]
-                    if not self.mapping[key].get('section', False)]
-        sections = [course for key in self.mapping
-                    for course in self.mapping[key]["courses"]
-                    if self.mapping[key].get('section')]
-        return courses, sections
-
-    def transform_rosters(self, rosters):
-        """Transform Pandas DataFrame into dictionary with course
-        and section name as key and dictionary containing studnet
-        roles as keys and sets of student idnumbers as values.
-
-        Args:
-            rosters (DataFrame): Dataframe containg "course", "section",
-            "role", and "idnumber" as columns.
-
-        Returns:
-            dict: dictionary with course and section name as key
-            and dictionary containing student roles as keys and
-            sets of student idnumbers as values.
-
-        Example:
-            >>> self.transform_rosters(rosters)
-            {("Kniting", "01"): {"student": {0023} "auditingstudent": {}}}
-        """
-        rosters_grouped = rosters.groupby(['course', 'section', 'role'])
-        rosters_dict = {}
-        for (course, section, role), df in rosters_grouped:
-            if (course, section) in rosters_dict:
-                rosters_dict[(course, section)].update({role: set(df.idnumber)})
-            else:
-                rosters_dict[(course, section)] = {role: set(df.idnumber)}
-        return rosters_dict
-
-    def get_pc_rosters(self):
-        """Pulls all PowerCampus enrollment data for term
-        via SQL database with `pymssql` handler.
-
-        Returns:
-            dict: Dictionary of course name and section as key and
-        dictionary with "students" and "auditingstudents" keys containing
-        sets of student idnumbers as values.
-
-        Example:
-            >>> print(se.get_pc_rosters())
-            {("Kniting", "01"): {"student": {0023} "auditingstudent": {}}}
-        """
-        courses, sections = self.get_courses()
-        pc = PcConnect('prod')
-        rosters = get_all_rosters(pc, *courses, *sections, term=TERM, year=YEAR, print=False)
-        # remove sections for non-sectioned courses
-        rosters.loc[rosters.course.apply(lambda x: x in courses), ['section']] = ''
-        return self.transform_rosters(rosters)
-
-    def get_conduit_enrollments(self, role):
-        """Calculate roster discrepencies and
-        create Conduit enrollment table as Pandas DataFrame
-
-        Args:
-            role (str): Representing the Moodle role of students to enroll
-
-        Returns:
-            pandas.DataFrame: Containing add/drop records to submit to conduit
-        """
-        records = []
-
-        # Skip courses that have revieved error durring pull
-        courses = [course for course in self.mapping
-                   if self.mapping[course]["id"] not in self.wc_pull_errors]
-        for course in courses:
-            pc_roster = self.__combine_pc_course_rosters(course, role)
-            wc_roster = self.wc_rosters[self.mapping[course]["id"]][role]
-
-            missing_enroll = pc_roster - wc_roster
-            extra_enroll  = wc_roster - pc_roster
-
-            records += [{"action": "add", "shortname": course,
-                         "idnumber": idnumber, "role": role}
-                        for idnumber in missing_enroll]
-
-            records += [{"action": "drop", "shortname": course,
-                         "idnumber": idnumber, "role": role}
-                         for idnumber in  extra_enroll]
-        return pd.DataFrame(records)
-
-    def log_conduit(self):
-        """Log Conduit enrollment as CSV.
-        """
-        for df_key, df in self.conduit_dfs.items():
-            if not df.empty:
-                path = f'log/{df_key}-{datetime.now().strftime("%Y-%m-%d %H.%M.%S")}.csv'
-                df.to_csv(path, index=False)
-
-    def push_conduit(self):
-        """Push Conduit CSV via SFTP
-        """
-        for df_key, df in self.conduit_dfs.items():
-            if not df.empty:
-                put_conduit_file(df.to_csv(index=False), df_key + '.csv')
-                print(f'{df_key} pushed at {str(datetime.now())}')
-
-    def __combine_pc_course_rosters(self, course, role):
-        """Helper function to combine the roster of all courses that are
-        cross-listed in `self.mapping`.
-
-        Args:
-            course (str): course name
-            role (str): role of students to combine rosters for
-
-        Returns:
-           set: containg list of all students for all cross-listed courses
-        """
-        course_section = self.mapping[course].get('section', '')
-        crosslist_courses = self.mapping[course]["courses"]
-        crosslist_rosters = [self.pc_rosters.get((crosslist, course_section), {}).get(role, set())
-                            for crosslist in crosslist_courses]
-        return set(reduce(lambda x,y: x | y, crosslist_rosters))
-
-class SyncNonAcademicEnrollments(SyncEnrollments):
-    """Creates a ETL pipeline for syncronizing enrollments for
-    courses that all students in a particular program or college
-    must be enrolled.
-
-    Args:
-        mapping (dict) : Dictionary of JSON mapping file with Moodle
-        shortname as key and dictionary containing "program" (str),
-        and "id" (int) as keys.
-
-    Attributes:
-        mapping (dict): Dictionary of JSON mapping file 
-        courseids (list): List of all Moodle courseids to syncronize
-        sync_audits (bool): True to sync auditing students, False otherwise.
-        wc_rosters (dict): Dictionary of course name and section as key and
-        dictionary with "students" and "auditingstudents" keys containing
-        sets of student idnumbers as values.
-        pc_rosters (dict):Dictionary with course and section name as key
-        and dictionary containing student roles as keys and
-        sets of student idnumbers as values.
-        conduit_dfs (dict): Dictionary of Pandas DataFrames to be pushed.
-    """
-    def __init__(self, mapping):
-            super().__init__(mapping)
-            self.sync_audits = False
-
-    def get_pc_rosters(self):
-        """Pulls all PowerCampus enrollment data for term
-        via SQL database with `pymssql` handler.
-        """
-        pc = PcConnect('prod')
-        program_rosters = get_students_by_program(pc)
-        return {program: set(df.idnumber) for program, df in program_rosters.groupby('program')}
-
-    def get_conduit_enrollments(self, role):
-        """Calculate roster discrepencies and
-        create Conduit enrollment table as Pandas DataFrame
-
-        Args:
-            role (str): Representing the Moodle role of students to enroll
-
-        Returns:
-            pandas.DataFrame: Containing add/drop records to submit to conduit
-        """
-        records = []
-        for course in self.mapping:
-            pc_roster = self.pc_rosters[self.mapping[course]["program"]]
-            wc_roster = self.wc_rosters[self.mapping[course]["id"]][role]
-            missing_enroll = pc_roster - wc_roster           
-            records += [{"action": "add", "shortname": course,
-                         "idnumber": idnumber, "role": "student"}
-                        for idnumber in missing_enroll]
-        return pd.DataFrame(records)
+from mdlpipeline.utils.mdltools.mdl_connect import *
+from mdlpipeline.utils.sqltools.queries import *
+from mdlpipeline.utils.mdltools.conduit import ConduitSession, ConduitWriter, LOG_DIR
+from mdlpipeline.utils.mdltools.enrol import apply_enrolments
+from mdlpipeline.utils.sqltools.pc_connect import PcConnect
+from mdlpipeline.sync.diff import CONDUIT_COLUMNS, expand_keys, diff_enrollments
+from mdlpipeline.sync.rosters import IdInterner, RosterStore
+from mdlpipeline.sync.mapping import MappingIndex
+from mdlpipeline.sync.incremental import OVERLAP
+from mdlpipeline.utils import metrics, profiling
+
+import pandas as pd
+import numpy as np
+import json
+from datetime import datetime, timedelta
+from urllib.error import HTTPError
+from aiohttp import ClientSession
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+import asyncio
+import time
+
+TERM = 'Winter'
+YEAR = '2021'
+TERM_YEAR = TERM + YEAR
+# Rows per chunk streamed from PowerCampus, None to fetch all at once
+CHUNKSIZE = 50000
+# Number of parallel PowerCampus roster queries, each on its own connection
+SHARDS = int(getenv('PC_SHARDS', 1))
+# "python" to diff rosters pulled from both systems, "sql" to diff on
+# SQL Server against Moodle rosters uploaded to a temporary table
+DIFF_MODE = getenv('SYNC_DIFF_MODE', 'python')
+# "conduit" to push CSV files via SFTP, "webservice" to enrol directly
+PUSH_BACKEND = getenv('SYNC_PUSH_BACKEND', 'conduit')
+
+STAGE_SECONDS = metrics.histogram('sync_stage_seconds', 'Duration of sync pipeline stages',
+                                  ['pipeline', 'term', 'stage'])
+CHANGES = metrics.gauge('sync_changes', 'Add/drop records of the last diff',
+                        ['pipeline', 'term', 'action', 'role'])
+CHANGES_TOTAL = metrics.counter('sync_changes_total', 'Add/drop records of all diffs',
+                                ['pipeline', 'term', 'action', 'role'])
+PUSHED_ROWS = metrics.counter('conduit_rows_pushed_total', 'Records pushed to Conduit',
+                              ['pipeline', 'term'])
+
+class SyncEnrollments():
+    """SyncEnrollments contains a end-to-end ETL pipeline for syncronizing
+    enrollments from PowerCampus (SIS) and Moodle (LMS). First, it pulling
+    enrollment data from both a PowerCampus production database and Moodle
+    Web Services API, computing the difference in rosters, translating
+    results intoConduit CSV file format, and pushing a file to Moodles'
+    Conduit middleware system via SFTP.
+
+    Args:
+        mapping (dict) : Dictionary of JSON mapping file with Moodle
+        shortname as key and dictionary containing "courses" (list of str),
+        "section" (str), "id" (int) as key-values, or its `MappingIndex`.
+        session (aiohttp.ClientSession): Optional long-lived session used
+        for Moodle Web Services calls.
+        snapshot (RosterSnapshot): Optional store of last Moodle rosters
+        used to only fetch courses that changed.
+        db_h (PcConnect): Optional PowerCampus handler, defaults to the
+        shared "prod" connection pool.
+        pc_cache (IncrementalExtract): Optional cache of PowerCampus
+        rosters refreshed with deltas since a watermark.
+        conduit (ConduitSession): Optional SFTP session used to push,
+        defaults to the shared Conduit session.
+        ledger (PendingLedger): Optional ledger of pushed changes not yet
+        reflected in Moodle, which are left out of the diff.
+        term (str): PowerCampus academic term, e.g. "Winter"
+        year (str): PowerCampus academic year, e.g. "2021"
+
+    Attributes:
+        mapping (MappingIndex): Compiled JSON mapping file
+        courseids (list): List of all Moodle courseids to syncronize
+        session (aiohttp.ClientSession): Session shared across pulls or None
+        snapshot (RosterSnapshot): Store of last Moodle rosters or None
+        db_h (PcConnect): PowerCampus handler used for SQL extracts
+        pc_cache (IncrementalExtract): PowerCampus roster cache or None
+        conduit (ConduitSession): SFTP session used to push Conduit files
+        ledger (PendingLedger): Ledger of pending pushed changes or None
+        term (str): PowerCampus academic term
+        year (str): PowerCampus academic year
+        sync_audits (bool): True to sync auditing students, False otherwise.
+        sync_drops (bool): True to drop students missing from PowerCampus.
+        wc_rosters (RosterStore): Moodle courseid as key and mapping of
+        "student" and "auditingstudent" roles to sets of student
+        idnumbers as values.
+        pc_rosters (RosterStore): Course and section name as key and
+        mapping of student roles to sets of student idnumbers as values.
+        interner (IdInterner): idnumber codes shared by both rosters
+        conduit_dfs (dict): Dictionary of Pandas DataFrames to be pushed
+        chunksize (int): Rows per chunk streamed from PowerCampus
+        shards (int): Number of parallel PowerCampus roster queries
+        diff_mode (str): "python" or "sql", where the rosters are compared
+        push_backend (str): "conduit" or "webservice", how changes are applied
+        wc_userids (dict): idnumber as key and Moodle user id as value
+        push_results (DataFrame): per-record results of the last
+        "webservice" push
+        timings (dict): Seconds spent in each stage of the last pull
+    """
+    def __init__(self, mapping, session=None, snapshot=None, db_h=None, pc_cache=None,
+                 conduit=None, ledger=None, term=TERM, year=YEAR):
+        self.mapping = mapping if isinstance(mapping, MappingIndex) else MappingIndex(mapping)
+        self.courseids = self.mapping.courseids
+        self.session = session
+        self.snapshot = snapshot
+        self.db_h = db_h or PcConnect.shared('prod')
+        self.pc_cache = pc_cache
+        self.conduit = conduit or ConduitSession.shared()
+        self.ledger = ledger
+        self.term = term
+        self.year = year
+        self.sync_audits = True
+        self.sync_drops = True
+        self.wc_pull_errors = []
+        self.wc_rosters = {}
+        self.pc_rosters = {}
+        self.interner = IdInterner()
+        self.conduit_dfs = {}
+        self.chunksize = CHUNKSIZE
+        self.shards = SHARDS
+        self.diff_mode = DIFF_MODE
+        self.push_backend = PUSH_BACKEND
+        self.wc_userids = {}
+        self.push_results = None
+        self.timings = {}
+
+    @classmethod
+    async def pull(cls, mapping, session=None, snapshot=None, db_h=None, pc_cache=None,
+                   conduit=None, ledger=None, term=TERM, year=YEAR, executor=None):
+        """Primary class factory for creating a SyncEnrollments
+        instance and running extract methods for data pull.
+
+        Args:
+            mapping (dict) : Dictionary of JSON mapping file with Moodle
+            shortname as key and dictionary containing "courses" (list of str),
+            "section" (str), "id" (int) as key-values.
+            session (aiohttp.ClientSession): Optional session to keep open
+            across pulls (e.g. by the sync daemon).
+            snapshot (RosterSnapshot): Optional Moodle roster snapshot to
+            keep across pulls for incremental extraction.
+            db_h (PcConnect): Optional PowerCampus handler, defaults to the
+            shared "prod" connection pool.
+            pc_cache (IncrementalExtract): Optional PowerCampus roster cache
+            to keep across pulls for incremental extraction.
+            conduit (ConduitSession): Optional SFTP session to push with.
+            ledger (PendingLedger): Optional ledger of pushed changes to
+            keep across pulls so pending changes are not resent.
+            term (str): PowerCampus academic term, e.g. "Winter"
+            year (str): PowerCampus academic year, e.g. "2021"
+            executor (concurrent.futures.ProcessPoolExecutor): Optional
+            process pool to compute the Python diff in, so several pulls
+            can diff in parallel.
+
+        Returns:
+            SyncEnrollments: instance of class with  values for `pc_roster`,
+            `wc_roster`, and `conduit_dfs` attributes.
+        """
+        self = cls(mapping, session=session, snapshot=snapshot, db_h=db_h,
+                   pc_cache=pc_cache, conduit=conduit, ledger=ledger, term=term, year=year)
+        await self.extract()
+        start = time.perf_counter()
+        roles = ('student', 'auditingstudent') if self.sync_audits else ('student',)
+        if executor is not None and self.diff_mode == 'python':
+            df = await asyncio.get_running_loop().run_in_executor(
+                executor, get_conduit_diff, self, roles)
+        else:
+            df = self.get_conduit_diff(roles)
+        self.conduit_dfs['enrollments'] = self.subtract_pending(df)
+        self.record_stage('diff', time.perf_counter() - start)
+        self.invalidate_snapshot()
+        self.report_timings()
+        self.report_changes(roles)
+        return self
+
+    @classmethod
+    def warm_start(cls, mapping, state, session=None, db_h=None, conduit=None, ledger=None,
+                   term=TERM, year=YEAR):
+        """Class factory diffing the rosters of the last pull saved in
+        `state` instead of pulling, e.g. to push right after a restart.
+
+        PowerCampus rosters are brought up to date with one query of the
+        rows revised since they were pulled when their watermark is known,
+        so changes made in PowerCampus while the sync was down are found.
+        Moodle rosters are as of the last pull; changes pushed since are
+        left out of the diff by the `ledger`.
+
+        Args:
+            mapping (MappingIndex): compiled mapping of the current file
+            state (WarmState): saved rosters of the last pull
+
+        Returns:
+            SyncEnrollments: instance ready to push, None if `state` holds
+            no rosters valid for this pipeline
+        """
+        start = time.perf_counter()
+        self = cls(mapping, session=session, db_h=db_h, conduit=conduit, ledger=ledger,
+                   term=term, year=year)
+        if not state.restore(self):
+            return None
+        watermark = state.watermark()
+        if watermark is not None:
+            try:
+                self.apply_pc_roster_changes(
+                    self.pc_rosters, self.pull_pc_changes(watermark - timedelta(seconds=OVERLAP)))
+            except Exception as err:
+                print(f'PowerCampus changes not applied to warm rosters: {err!r}')
+        self.record_stage('warm_load', time.perf_counter() - start)
+        start = time.perf_counter()
+        roles = ('student', 'auditingstudent') if self.sync_audits else ('student',)
+        df = self.get_conduit_diff(roles)
+        if ledger is not None:
+            # Moodle rosters are older than the ledger, so none is confirmed,
+            # but records past their TTL are sent again
+            ledger.expire()
+            df = ledger.subtract(df)
+        self.conduit_dfs['enrollments'] = df
+        self.record_stage('diff', time.perf_counter() - start)
+        self.report_timings()
+        self.report_changes(roles)
+        return self
+
+    @classmethod
+    def merge(cls, pipelines):
+        """Combine pulled `pipelines`, e.g. of one mapping in several
+        terms, into one instance pushing all their Conduit DataFrames
+        together with the session, Conduit session and ledger of the first
+        pipeline. Records found by several pipelines are pushed once. The
+        mappings must not use a Moodle course id for different shortnames.
+
+        Returns:
+            SyncEnrollments: instance with the combined mapping and
+            `conduit_dfs` of `pipelines`
+        """
+        first = pipelines[0]
+        entries = {}
+        for se in pipelines:
+            entries.update(se.mapping.entries)
+        self = cls(entries, session=first.session, db_h=first.db_h, conduit=first.conduit,
+                   ledger=first.ledger, term=first.term, year=first.year)
+        self.push_backend = first.push_backend
+        frames = {}
+        for se in pipelines:
+            self.wc_userids.update(se.wc_userids)
+            for df_key, df in se.conduit_dfs.items():
+                frames.setdefault(df_key, []).append(df)
+        for df_key, dfs in frames.items():
+            self.conduit_dfs[df_key] = pd.concat(dfs, ignore_index=True).drop_duplicates(
+                ignore_index=True)
+        return self
+
+    def __getstate__(self):
+        # connections, sessions and caches stay in the parent process
+        state = self.__dict__.copy()
+        for name in ('session', 'snapshot', 'db_h', 'pc_cache', 'conduit', 'ledger'):
+            state[name] = None
+        return state
+
+    async def extract(self):
+        """Run the Moodle and PowerCampus extracts concurrently. The blocking
+        `pymssql` pull runs in the default executor while the Moodle requests
+        are in flight, so the extract takes about as long as the slower of
+        the two. In "sql" `diff_mode` PowerCampus rosters are not pulled.
+        """
+        start = time.perf_counter()
+        if self.diff_mode == 'sql':
+            self.wc_rosters = await self.time_stage('wc_pull', self.get_wc_rosters())
+            self.record_stage('extract', time.perf_counter() - start)
+            return
+        loop = asyncio.get_running_loop()
+        self.wc_rosters, self.pc_rosters = await asyncio.gather(
+            # pulls from Moodle WebServices API via asynchonous POST
+            self.time_stage('wc_pull', self.get_wc_rosters()),
+            # pulls from PowerCampus SQL database with pymssql handler
+            loop.run_in_executor(None, self.time_call, 'pc_pull', self.get_pc_rosters))
+        self.record_stage('extract', time.perf_counter() - start)
+
+    async def time_stage(self, stage, coro):
+        """Await `coro` and record its duration in `timings`.
+        """
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    def time_call(self, stage, func, *args):
+        """Call `func` and record its duration in `timings`.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    def metric_labels(self):
+        """Labels of the metrics of this pipeline.
+        """
+        return {'pipeline': type(self).__name__, 'term': f'{self.term}{self.year}'}
+
+    def record_stage(self, stage, seconds):
+        """Record the duration of `stage` in `timings` and the
+        `sync_stage_seconds` metric, and snapshot allocations when
+        profiling.
+        """
+        self.timings[stage] = seconds
+        STAGE_SECONDS.observe(seconds, stage=stage, **self.metric_labels())
+        profiling.mark(stage)
+
+    def report_timings(self):
+        """Print seconds spent in each stage of the last pull.
+        """
+        print(', '.join(f'{stage}: {seconds:.2f}s'
+                        for stage, seconds in self.timings.items()))
+        metrics.log_event('sync_pull', courses=len(self.courseids),
+                          pull_errors=len(self.wc_pull_errors), timings=self.timings,
+                          **self.metric_labels())
+
+    def report_changes(self, roles):
+        """Record add/drop counts per action and role of the last diff.
+        """
+        frames = [df for df in self.conduit_dfs.values() if not df.empty]
+        counts = (pd.concat(frames).groupby(['action', 'role']).size().to_dict()
+                  if frames else {})
+        for action in ('add', 'drop'):
+            for role in roles:
+                count = counts.get((action, role), 0)
+                CHANGES.set(count, action=action, role=role, **self.metric_labels())
+                CHANGES_TOTAL.inc(count, action=action, role=role, **self.metric_labels())
+        metrics.log_event('sync_changes', changes={f'{action}:{role}': count for
+                                                   (action, role), count in counts.items()},
+                          **self.metric_labels())
+
+    async def get_wc_rosters(self):
+        """Wrapper to get enrollment data from Moodle
+        WebServices API asynchronously.
+
+        Returns:
+            RosterStore: courseid as key and mapping of "student" and
+        "auditingstudent" roles to sets of student idnumbers as values.
+
+        Example:
+            {4423: {"student": {0023} "auditingstudent": {}}}
+        """
+        wcr = WebCampusRosters(self.courseids, session=self.session,
+                               snapshot=self.snapshot)
+        rosters = await wcr.get_rosters()
+        self.wc_pull_errors = wcr.errors
+        self.wc_userids.update(wcr.userids)
+        return RosterStore.from_rosters(rosters, self.interner)
+
+    def subtract_pending(self, df):
+        """Leave changes pushed earlier and not yet reflected in Moodle out
+        of Conduit DataFrame `df`. Ledger records confirmed by this pull or
+        older than the ledger TTL are dropped first.
+        """
+        if self.ledger is None:
+            return df
+        self.ledger.expire()
+        self.ledger.confirm(self.wc_rosters, {course: self.mapping.ids[course]
+                                              for course in self.get_diff_courses()})
+        return self.ledger.subtract(df)
+
+    def invalidate_snapshot(self):
+        """Force a full Moodle fetch on the next pull of every course
+        with new or pending add/drops, since role changes do not alter the
+        enrolled users probed by `WebCampusRosters`.
+        """
+        if self.snapshot is None:
+            return
+        shortnames = set() if self.ledger is None else self.ledger.shortnames()
+        for df in self.conduit_dfs.values():
+            if not df.empty:
+                shortnames.update(df.shortname)
+        # the ledger is shared by pipelines of other mappings and partitions
+        self.snapshot.invalidate(self.mapping.ids[course] for course in shortnames
+                                 if course in self.mapping.ids)
+        self.snapshot.save()
+
+    def get_courses(self):
+        """Get list of courses and list of sectioned courses
+
+        Returns:
+            tuple: tuple of lists first containing all course names
+            without sections and second containing all course names
+            with sections.
+        """
+        courses = [course for course, section in self.mapping.course_keys if not section]
+        sections = [course for course, section in self.mapping.course_keys if section]
+        return courses, sections
+
+    def get_course_keys(self):
+        """Get deduplicated list of PowerCampus (course, section) keys of
+        the mapping, with a None section for non-sectioned courses.
+
+        Returns:
+            list: list of (course, section) tuples
+        """
+        return self.mapping.course_keys
+
+    def transform_rosters(self, rosters, store=None):
+        """Transform Pandas DataFrame into a roster store with course
+        and section name as key and mapping of studnet roles to sets
+        of student idnumbers as values.
+
+        Args:
+            rosters (DataFrame): Dataframe containg "course", "section",
+            "role", and "idnumber" as columns, or an iterable of such
+            DataFrames which is consumed one chunk at a time.
+            store (RosterStore): Optional existing store to add to.
+
+        Returns:
+            RosterStore: course and section name as key and mapping of
+            student roles to sets of student idnumbers as values.
+
+        Example:
+            >>> self.transform_rosters(rosters)
+            {("Kniting", "01"): {"student": {0023} "auditingstudent": {}}}
+        """
+        if isinstance(rosters, pd.DataFrame):
+            rosters = [rosters]
+        if store is None:
+            store = RosterStore(self.interner)
+        for chunk in rosters:
+            store.add_frame(chunk, ['course', 'section'])
+        return store
+
+    def get_pc_rosters(self):
+        """Pulls all PowerCampus enrollment data for term
+        via SQL database with `pymssql` handler.
+
+        Returns:
+            RosterStore: course name and section as key and mapping of
+        "student" and "auditingstudent" roles to sets of student
+        idnumbers as values.
+
+        Example:
+            >>> print(se.get_pc_rosters())
+            {("Kniting", "01"): {"student": {0023} "auditingstudent": {}}}
+        """
+        keys = self.get_course_keys()
+        if self.pc_cache is None:
+            return self.pull_pc_rosters(keys)
+        return self.pc_cache.pull(
+            self.db_h, lambda: self.pull_pc_rosters(keys), self.pull_pc_changes,
+            self.apply_pc_roster_changes, signature=(self.term, self.year, tuple(keys)))
+
+    def pull_pc_changes(self, since):
+        """Pulls PowerCampus roster rows of the mapping revised since
+        datetime `since`, for `apply_pc_roster_changes`.
+        """
+        return get_mapped_roster_changes(self.db_h, self.get_course_keys(), since,
+                                         term=self.term, year=self.year, print=False)
+
+    def pull_pc_rosters(self, keys):
+        """Pulls PowerCampus enrollment data for all `keys`, split in
+        `shards` parallel queries.
+
+        Returns:
+            RosterStore: same structure as `get_pc_rosters`
+        """
+        shards = max(1, min(self.shards, len(keys)))
+        if shards == 1:
+            return self.get_shard_rosters(keys)
+
+        # each shard runs on its own pooled connection and all shards
+        # intern into the same codes, so merging needs no translation
+        store = RosterStore(self.interner)
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            for shard_rosters in executor.map(self.get_shard_rosters,
+                                              [keys[i::shards] for i in range(shards)]):
+                store.update(shard_rosters)
+        return store
+
+    def get_shard_rosters(self, keys):
+        """Pulls PowerCampus enrollment data for a subset of the
+        mapping's (course, section) `keys`.
+
+        Returns:
+            RosterStore: same structure as `get_pc_rosters`
+        """
+        rosters = get_mapped_rosters(self.db_h, keys, term=self.term, year=self.year,
+                                     print=False, chunksize=self.chunksize, dtype=ROSTER_DTYPES)
+        return self.transform_rosters(rosters)
+
+    def apply_pc_roster_changes(self, rosters, changes):
+        """Apply rows from `get_mapped_roster_changes` to cached `rosters`
+        in place. Every changed student is removed from all sections and
+        roles of the changed course, then added back where still eligible.
+        """
+        if changes.empty:
+            return
+        keys_by_course = {}
+        for course_section in rosters:
+            keys_by_course.setdefault(course_section[0], []).append(course_section)
+        codes = rosters.interner.encode(changes.idnumber.to_numpy(object))
+        for course, positions in changes.groupby('course').indices.items():
+            changed = np.unique(codes[positions])
+            for course_section in keys_by_course.get(course, ()):
+                rosters.discard(course_section, changed)
+        self.transform_rosters(changes.dropna(subset=['role']), rosters)
+
+    def get_conduit_enrollments(self, role):
+        """Calculate roster discrepencies and
+        create Conduit enrollment table as Pandas DataFrame
+
+        Args:
+            role (str): Representing the Moodle role of students to enroll
+
+        Returns:
+            pandas.DataFrame: Containing add/drop records to submit to conduit
+        """
+        return self.get_conduit_diff((role,))
+
+    def get_conduit_diff(self, roles):
+        """Calculate roster discrepencies of all courses and `roles` in one
+        vectorized pass and create Conduit enrollment table as Pandas
+        DataFrame.
+
+        Args:
+            roles (tuple): Moodle roles of students to enroll
+
+        Returns:
+            pandas.DataFrame: Containing add/drop records to submit to conduit
+        """
+        if self.diff_mode == 'sql':
+            return self.get_sql_conduit_diff(roles)
+        courses = self.get_diff_courses()
+
+        # PowerCampus rosters, expanded once to every cross-listed course
+        pc_store = RosterStore.from_rosters(self.get_pc_role_rosters(), self.interner)
+        keys, key_codes, role_codes, id_codes = pc_store.flatten(roles)
+        key_index = {key: code for code, key in enumerate(keys)}
+        pairs = [(key_index[key], code) for code, course in enumerate(courses)
+                 for key in self.get_pc_keys(course) if key in key_index]
+        expected = expand_keys(pairs, key_codes, role_codes, id_codes)
+
+        # Moodle rosters, key codes are shortname codes; idnumber codes
+        # are translated should the stores not share an interner
+        wc_store = RosterStore.from_rosters(self.wc_rosters, pc_store.interner)
+        _, wc_key_codes, wc_role_codes, wc_id_codes = wc_store.flatten(
+            roles, keys=[self.mapping.ids[course] for course in courses])
+        translation = pc_store.interner.translate(wc_store.interner)
+        actual = (wc_key_codes, wc_role_codes, translation[wc_id_codes])
+
+        return diff_enrollments(courses, expected, actual, roles, drops=self.sync_drops,
+                                decode=pc_store.interner.decode)
+
+    def get_sql_conduit_diff(self, roles):
+        """Calculate roster discrepencies on SQL Server. Moodle rosters
+        and the mapped keys are bulk loaded into temporary tables and
+        compared with PowerCampus enrollments in one set based query, so
+        only add/drop records are transferred.
+
+        Args:
+            roles (tuple): Moodle roles of students to enroll
+
+        Returns:
+            pandas.DataFrame: Containing add/drop records to submit to conduit
+        """
+        courses = self.get_diff_courses()
+        courseids = [self.mapping.ids[course] for course in courses]
+        key_rows = [(self.mapping.ids[course], course, crosslist, section or None)
+                    for course in courses for crosslist, section in self.get_pc_keys(course)]
+        wc_store = RosterStore.from_rosters(self.wc_rosters, self.interner)
+        _, key_codes, role_codes, id_codes = wc_store.flatten(roles, keys=courseids)
+        wc_rows = list(zip(np.asarray(courseids, dtype=np.int64)[key_codes].tolist(),
+                           wc_store.interner.decode(id_codes).tolist(),
+                           np.asarray(roles, dtype=object)[role_codes].tolist()))
+        df = get_roster_diff(self.db_h, key_rows, wc_rows, roles=roles, drops=self.sync_drops,
+                             term=self.term, year=self.year, print=False)
+        return df[CONDUIT_COLUMNS]
+
+    def get_diff_courses(self):
+        """Moodle shortnames to diff, skipping courses that have revieved
+        error durring pull.
+        """
+        pull_errors = set(self.wc_pull_errors)
+        return [course for course, courseid in self.mapping.ids.items()
+                if courseid not in pull_errors and courseid in self.wc_rosters]
+
+    def get_pc_keys(self, course):
+        """Keys of `pc_rosters` feeding Moodle course `course`, one per
+        cross-listed PowerCampus course.
+        """
+        return self.mapping.pc_keys(course)
+
+    def get_pc_role_rosters(self):
+        """PowerCampus rosters as mapping of key and mapping of role and
+        set of idnumbers.
+        """
+        return self.pc_rosters
+
+    def write_conduit(self, log=True, push=True):
+        """Encode each Conduit DataFrame to CSV once and stream it to the
+        log directory and, via SFTP over the persistent `conduit` session,
+        to Conduit, split by `ConduitWriter` in files of bounded size.
+
+        Args:
+            log (bool): write the log copy
+            push (bool): push to Conduit
+        """
+        for df_key, df in self.conduit_dfs.items():
+            if not df.empty:
+                with ConduitWriter(df_key, conduit=self.conduit if push else None,
+                                   log_dir=LOG_DIR if log else None) as writer:
+                    writer.write(df)
+                if writer.pushed_rows:
+                    PUSHED_ROWS.inc(writer.pushed_rows, **self.metric_labels())
+                if self.ledger is not None and writer.pushed_rows:
+                    self.ledger.record(df.iloc[:writer.pushed_rows])
+                    self.ledger.save()
+                if writer.pushed:
+                    print(f'{", ".join(writer.pushed)} pushed at {str(datetime.now())}')
+
+    async def push(self):
+        """Log the Conduit DataFrames and apply them with `push_backend`.
+        Blocking SFTP pushes run in the default executor.
+        """
+        start = time.perf_counter()
+        try:
+            if self.push_backend == 'webservice':
+                self.log_conduit()
+                await self.push_webservice()
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, self.write_conduit)
+        finally:
+            self.record_stage('push', time.perf_counter() - start)
+
+    async def push_webservice(self):
+        """Apply Conduit DataFrames directly with Moodle Web Services
+        enrol/unenrol calls instead of Conduit, and report failed records.
+
+        Returns:
+            pandas.DataFrame: add/drop records with "status" and "message"
+        """
+        frames = [df for df in self.conduit_dfs.values() if not df.empty]
+        if not frames:
+            return None
+        df = pd.concat(frames, ignore_index=True)
+        results = await apply_enrolments(df, self.mapping.ids, self.wc_userids,
+                                         session=self.session)
+        counts = results.status.value_counts()
+        print(', '.join(f'{status}: {count}' for status, count in counts.items())
+              + f' enrolments applied at {str(datetime.now())}')
+        for record in results[results.status != 'ok'].itertuples(index=False):
+            print(f'{record.action} {record.idnumber} {record.role} in {record.shortname}'
+                  f' {record.status}: {record.message}')
+        self.push_results = results
+        return results
+
+    def log_conduit(self):
+        """Log Conduit enrollment as CSV.
+        """
+        self.write_conduit(push=False)
+
+    def push_conduit(self):
+        """Push Conduit CSV via SFTP
+        """
+        self.write_conduit(log=False)
+
+class SyncNonAcademicEnrollments(SyncEnrollments):
+    """Creates a ETL pipeline for syncronizing enrollments for
+    courses that all students in a particular program or college
+    must be enrolled. Program rosters are always compared in Python,
+    whatever the `diff_mode`.
+
+    Args:
+        mapping (dict) : Dictionary of JSON mapping file with Moodle
+        shortname as key and dictionary containing "program" (str),
+        and "id" (int) as keys.
+
+    Attributes:
+        mapping (MappingIndex): Compiled JSON mapping file
+        courseids (list): List of all Moodle courseids to syncronize
+        sync_audits (bool): True to sync auditing students, False otherwise.
+        sync_drops (bool): True to drop students missing from PowerCampus.
+        wc_rosters (RosterStore): Moodle courseid as key and mapping of
+        "student" and "auditingstudent" roles to sets of student
+        idnumbers as values.
+        pc_rosters (RosterStore): Program as key and mapping of "student"
+        role to set of student idnumbers as values.
+        conduit_dfs (dict): Dictionary of Pandas DataFrames to be pushed.
+    """
+    def __init__(self, mapping, session=None, snapshot=None, db_h=None, pc_cache=None,
+                 conduit=None, ledger=None, term=TERM, year=YEAR):
+            super().__init__(mapping, session=session, snapshot=snapshot, db_h=db_h,
+                             pc_cache=pc_cache, conduit=conduit, ledger=ledger,
+                             term=term, year=year)
+            self.sync_audits = False
+            self.sync_drops = False
+            self.diff_mode = 'python'
+
+    def get_pc_rosters(self):
+        """Pulls all PowerCampus enrollment data for term
+        via SQL database with `pymssql` handler.
+        """
+        if self.pc_cache is None:
+            return self.pull_pc_rosters()
+        return self.pc_cache.pull(
+            self.db_h, self.pull_pc_rosters, self.pull_pc_changes,
+            self.apply_pc_roster_changes, signature=(self.term, self.year))
+
+    def pull_pc_changes(self, since):
+        return get_students_by_program_changes(self.db_h, since, term=self.term,
+                                               year=self.year, print=False)
+
+    def pull_pc_rosters(self):
+        # never from the query cache, the incremental pull stamps the
+        # rosters as current at the server time of this read
+        program_rosters = get_students_by_program(self.db_h, term=self.term, year=self.year,
+                                                  print=False, cache_ttl=0)
+        store = RosterStore(self.interner)
+        store.add_frame(program_rosters.assign(role='student'), ['program'])
+        return store
+
+    def apply_pc_roster_changes(self, rosters, changes):
+        """Apply rows from `get_students_by_program_changes` to cached
+        program `rosters` in place.
+        """
+        if changes.empty:
+            return
+        changed = np.unique(rosters.interner.encode(changes.idnumber.to_numpy(object)))
+        for program in rosters:
+            rosters.discard(program, changed)
+        rosters.add_frame(changes.dropna(subset=['program']).assign(role='student'), ['program'])
+
+    def get_pc_role_rosters(self):
+        if isinstance(self.pc_rosters, RosterStore):
+            return self.pc_rosters
+        # plain dictionaries of program and set of idnumbers are accepted too
+        return {program: {'student': idnumbers}
+                for program, idnumbers in self.pc_rosters.items()}
+
+def get_conduit_diff(se, roles):
+    """`SyncEnrollments.get_conduit_diff` as a picklable function, to run
+    in a process pool.
+    """
+    return se.get_conduit_diff(roles)
@@ -0,0 +1,111 @@
+import os
+import pickle
+from datetime import timedelta
+
+CACHE_DIR = 'cache'
+# Seconds between full PowerCampus pulls guarding against drift
+FULL_REFRESH = 6 * 60 * 60
+# Seconds the watermark is moved back to catch late committed revisions
+OVERLAP = 5 * 60
+# Bumped when the layout of cached rosters changes, older caches are ignored
+VERSION = 2
+
+
+class IncrementalExtract():
+    """Cached PowerCampus extract kept current by applying deltas of rows
+    revised since a persisted watermark.
+
+    The watermark is read from the database server clock before each pull,
+    so it is immune to clock skew on the sync host. Deltas are re-read with
+    an `overlap` and must be idempotent. A full pull replaces the cache on
+    the first run, when the extract `signature` (e.g. the mapped course
+    keys) changes, and every `full_refresh` seconds, which also picks up
+    hard-deleted rows that deltas cannot see.
+
+    Args:
+        name (str): name of the extract, used for the cache file name
+        path (str): location of the pickled cache, defaults to
+        `CACHE_DIR/<name>.pkl`
+        full_refresh (float): seconds between full pulls
+        overlap (float): seconds to move the watermark back on delta pulls
+
+    Attributes:
+        rosters: cached result of the extract
+        watermark (datetime): server time the cache is current as of
+        refreshed (datetime): server time of the last full pull
+        signature: signature of the extract the cache was built for
+        last_pull (str): "full" or "delta"
+    """
+    def __init__(self, name, path=None, full_refresh=FULL_REFRESH, overlap=OVERLAP):
+        self.path = path or os.path.join(CACHE_DIR, f'{name}.pkl')
+        self.full_refresh = timedelta(seconds=full_refresh)
+        self.overlap = timedelta(seconds=overlap)
+        self.rosters = None
+        self.watermark = None
+        self.refreshed = None
+        self.signature = None
+        self.last_pull = None
+        self.load()
+
+    def load(self):
+        """Load cached rosters and watermark from `path` if it exists.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != VERSION:
+            return
+        self.__dict__.update({key: state[key] for key in
+                              ('rosters', 'watermark', 'refreshed', 'signature')})
+
+    def save(self):
+        """Atomically write cached rosters and watermark to `path`.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        state = {'version': VERSION, 'rosters': self.rosters, 'watermark': self.watermark,
+                 'refreshed': self.refreshed, 'signature': self.signature}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def needs_full_refresh(self, now, signature):
+        return (self.rosters is None or self.watermark is None
+                or signature != self.signature
+                or now - self.refreshed >= self.full_refresh)
+
+    def pull(self, db_h, full_pull, delta_pull, apply_delta, signature=None):
+        """Bring the cache up to date and return the cached rosters.
+
+        Args:
+            db_h (PcConnect): database handler used to read the server time
+            full_pull (callable): returns freshly extracted rosters
+            delta_pull (callable): takes a datetime and returns the rows
+            changed since then
+            apply_delta (callable): takes the cached rosters and the result
+            of `delta_pull` and updates the rosters in place
+            signature: any picklable value identifying the extract
+
+        Returns:
+            cached rosters, current as of the start of this pull
+        """
+        now = db_h.get_value('SELECT GETDATE()')
+        try:
+            if self.needs_full_refresh(now, signature):
+                self.rosters = full_pull()
+                self.refreshed = now
+                self.last_pull = 'full'
+            else:
+                apply_delta(self.rosters, delta_pull(self.watermark - self.overlap))
+                self.last_pull = 'delta'
+        except Exception:
+            # a partially applied delta leaves the cache unusable
+            self.rosters = None
+            raise
+        self.watermark = now
+        self.signature = signature
+        self.save()
+        return self.rosters
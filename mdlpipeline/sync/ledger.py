@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from os import getenv
+
+import pandas as pd
+
+from .diff import CONDUIT_COLUMNS
+
+LEDGER_PATH = 'cache/conduit_ledger.json'
+# Seconds a pushed change suppresses the same change before it is resent
+TTL = int(getenv('LEDGER_TTL', 2 * 60 * 60))
+
+
+class PendingLedger():
+    """Persisted ledger of add/drop records pushed to Conduit and not yet
+    reflected in Moodle.
+
+    Conduit applies files asynchronously, so a sync running before Moodle
+    reflects the last file would push the same changes again. Records in
+    the ledger are subtracted from the next diffs until a Moodle pull
+    confirms them or they are older than `ttl`, after which they are sent
+    again.
+
+    The ledger is shared by pipelines diffing on the event loop and
+    pushes recording in executor threads, so its methods hold a lock.
+
+    Args:
+        path (str): location of the JSON ledger file
+        ttl (float): seconds a record stays pending without confirmation
+
+    Attributes:
+        entries (dict): (action, shortname, idnumber, role) tuple as key
+        and submission time as value
+    """
+    def __init__(self, path=LEDGER_PATH, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.entries)
+
+    def load(self):
+        """Load pending records from `path` if it exists.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            records = json.load(f)
+        with self._lock:
+            self.entries = {tuple(record[:-1]): record[-1] for record in records}
+
+    def save(self):
+        """Atomically write pending records to `path`.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                json.dump([list(key) + [submitted] for key, submitted in self.entries.items()],
+                          f)
+            os.replace(tmp_path, self.path)
+
+    def record(self, df, now=None):
+        """Add records of Conduit DataFrame `df` that were pushed.
+        """
+        now = time.time() if now is None else now
+        records = dict.fromkeys(df[CONDUIT_COLUMNS].itertuples(index=False, name=None), now)
+        with self._lock:
+            self.entries.update(records)
+
+    def expire(self, now=None):
+        """Drop records pending for longer than `ttl`.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self.entries = {key: submitted for key, submitted in self.entries.items()
+                            if now - submitted < self.ttl}
+
+    def confirm(self, rosters, courseids):
+        """Drop records Moodle `rosters` reflect: adds of enrolled and
+        drops of unenrolled students.
+
+        Args:
+            rosters (RosterStore): Moodle rosters of the last pull
+            courseids (dict): shortname as key and courseid as value of
+            every course pulled without error
+        """
+        members = {}
+        with self._lock:
+            confirmed = []
+            for key in self.entries:
+                action, shortname, idnumber, role = key
+                if shortname not in courseids:
+                    continue
+                course_role = (courseids[shortname], role)
+                if course_role not in members:
+                    members[course_role] = rosters.get(course_role[0], {}).get(role, set())
+                if (idnumber in members[course_role]) == (action == 'add'):
+                    confirmed.append(key)
+            for key in confirmed:
+                del self.entries[key]
+
+    def keep_pending(self, shortnames, pending):
+        """Drop records of Moodle `shortnames` except `pending` ones, e.g.
+        after another process confirmed the records of those courses.
+        """
+        shortnames, pending = set(shortnames), set(pending)
+        with self._lock:
+            self.entries = {key: submitted for key, submitted in self.entries.items()
+                            if key[1] not in shortnames or key in pending}
+
+    def subtract(self, df):
+        """Conduit DataFrame `df` without the records still pending.
+        """
+        with self._lock:
+            keys = list(self.entries)
+        if not keys or df.empty:
+            return df
+        pending = pd.MultiIndex.from_tuples(keys, names=CONDUIT_COLUMNS)
+        keep = ~pd.MultiIndex.from_frame(df[CONDUIT_COLUMNS]).isin(pending)
+        return df[keep].reset_index(drop=True)
+
+    def shortnames(self):
+        """Moodle shortnames with pending records.
+        """
+        with self._lock:
+            return {shortname for _, shortname, _, _ in self.entries}
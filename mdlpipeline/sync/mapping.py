@@ -0,0 +1,156 @@
+from collections.abc import Mapping
+import hashlib
+import json
+import os
+
+
+class MappingError(ValueError):
+    """Raised when a mapping file has invalid entries.
+    """
+
+
+class MappingIndex(Mapping):
+    """Validated mapping of Moodle courses to PowerCampus rosters with the
+    lookups used by the sync precomputed once.
+
+    The index is a read-only mapping of Moodle shortname to mapping entry,
+    so it can be used wherever the JSON dictionary was used before.
+
+    Args:
+        entries (dict): Dictionary of JSON mapping file with Moodle
+        shortname as key and dictionary containing "courses" (list of str)
+        and optional "section" (str), or "program" (str), and "id" (int)
+        as key-values.
+        path (str): file the entries were read from, used in errors
+        digest (str): hash of the file the entries were read from
+
+    Attributes:
+        ids (dict): Moodle shortname as key and courseid as value
+        shortnames (dict): Moodle courseid as key and shortname as value
+        courseids (list): all Moodle courseids in mapping order
+        key_shortnames (dict): PowerCampus (course, section) key as used
+        in `pc_rosters`, or program, as key and list of Moodle shortnames
+        fed by it as value
+        course_keys (list): deduplicated PowerCampus (course, section)
+        keys for SQL, with a None section for non-sectioned courses
+
+    Example:
+        >>> index = MappingIndex(entries)
+        >>> index.key_shortnames[("COUN6552", "02")]
+        ["COUN6552COUN855202Winter2021"]
+    """
+    def __init__(self, entries, path=None, digest=None):
+        self.entries = entries
+        self.path = path
+        self.digest = digest
+        self.validate()
+        self.ids = {shortname: entry["id"] for shortname, entry in entries.items()}
+        self.shortnames = {courseid: shortname for shortname, courseid in self.ids.items()}
+        self.courseids = list(self.ids.values())
+        self._pc_keys = {shortname: self.entry_keys(entry)
+                         for shortname, entry in entries.items()}
+        self.key_shortnames = {}
+        for shortname, keys in self._pc_keys.items():
+            for key in keys:
+                self.key_shortnames.setdefault(key, []).append(shortname)
+        self.course_keys = list(dict.fromkeys(
+            (course, entry.get('section') or None)
+            for entry in entries.values() for course in entry.get("courses", ())))
+
+    @classmethod
+    def from_file(cls, path):
+        """Read, validate and index the JSON mapping file at `path`.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        return cls(json.loads(data), path=path, digest=hashlib.sha256(data).hexdigest())
+
+    def __getitem__(self, shortname):
+        return self.entries[shortname]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def validate(self):
+        """Check every entry has an integer courseid used only once and
+        either a non-empty list of PowerCampus courses or a program.
+
+        Raises:
+            MappingError: listing every invalid entry
+        """
+        problems = []
+        seen = {}
+        for shortname, entry in self.entries.items():
+            if not isinstance(entry, dict):
+                problems.append(f'{shortname}: entry is not an object')
+                continue
+            courseid = entry.get("id")
+            if not isinstance(courseid, int) or isinstance(courseid, bool):
+                problems.append(f'{shortname}: "id" must be an integer')
+            elif courseid in seen:
+                problems.append(f'{shortname}: "id" {courseid} already used by {seen[courseid]}')
+            else:
+                seen[courseid] = shortname
+            courses = entry.get("courses")
+            if "program" in entry:
+                if not isinstance(entry["program"], str):
+                    problems.append(f'{shortname}: "program" must be a string')
+            elif (not isinstance(courses, list) or not courses
+                  or not all(isinstance(course, str) for course in courses)):
+                problems.append(f'{shortname}: "courses" must be a non-empty list of strings')
+            if not isinstance(entry.get('section', ''), str):
+                problems.append(f'{shortname}: "section" must be a string')
+        if problems:
+            raise MappingError(f'Invalid mapping {self.path or ""}: ' + '; '.join(problems))
+
+    @staticmethod
+    def entry_keys(entry):
+        if "program" in entry:
+            return [entry["program"]]
+        section = entry.get('section', '')
+        return [(course, section) for course in entry["courses"]]
+
+    def pc_keys(self, shortname):
+        """Keys of `pc_rosters` feeding Moodle course `shortname`, one per
+        cross-listed PowerCampus course, or its program.
+        """
+        return self._pc_keys[shortname]
+
+
+class MappingFile():
+    """Mapping file compiled into a `MappingIndex` once and recompiled
+    only when the file changes. The file is stat'ed on every `load`, and
+    only re-read when its modification time or size changed; it is
+    re-indexed only if its content hash changed too.
+
+    Args:
+        path (str): location of the JSON mapping file
+
+    Attributes:
+        index (MappingIndex): last compiled mapping
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self._stat = None
+
+    def load(self):
+        """Return the compiled mapping, recompiling it if the file changed.
+
+        Returns:
+            MappingIndex: compiled mapping of the current file
+        """
+        stat = os.stat(self.path)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if self.index is not None and stat == self._stat:
+            return self.index
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.index is None or digest != self.index.digest:
+            self.index = MappingIndex(json.loads(data), path=self.path, digest=digest)
+        self._stat = stat
+        return self.index
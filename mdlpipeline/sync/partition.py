@@ -0,0 +1,406 @@
+from mdlpipeline.utils.mdltools.conduit import ConduitSession
+from mdlpipeline.utils.mdltools.mdl_connect import create_session
+from mdlpipeline.utils.mdltools.snapshot import RosterSnapshot
+from mdlpipeline.utils.sqltools.pc_connect import PcConnect
+from .enrollments import SyncEnrollments, TERM, YEAR
+from .incremental import IncrementalExtract
+from .ledger import PendingLedger, LEDGER_PATH
+from .mapping import MappingFile
+
+from os import getenv
+import asyncio
+import importlib
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import time
+import uuid
+import zlib
+
+import pandas as pd
+
+CACHE_DIR = 'cache'
+QUEUE_PATH = os.path.join(CACHE_DIR, 'sync_queue.sqlite')
+# Partitions a mapping is split into
+PARTITIONS = int(getenv('SYNC_PARTITIONS', 4))
+# Seconds after which a partition claimed by a silent worker is handed out again
+LEASE = int(getenv('SYNC_LEASE', 15 * 60))
+# Claims of a partition before it is marked failed
+MAX_ATTEMPTS = 3
+# Seconds between queue polls of a waiting coordinator
+POLL = 0.5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY, mapping_path TEXT, term TEXT, year TEXT,
+    sync_class TEXT, partitions INTEGER, partition_by TEXT, created REAL);
+CREATE TABLE IF NOT EXISTS tasks (
+    run TEXT, partition INTEGER, status TEXT, worker TEXT, attempts INTEGER,
+    claimed REAL, finished REAL, result TEXT, error TEXT,
+    PRIMARY KEY (run, partition));
+'''
+
+
+def partition_of(shortname, courseid, partitions, by='hash'):
+    """Deterministic partition of a Moodle course, the same on every node
+    and run for the same number of `partitions`.
+
+    Args:
+        shortname (str): Moodle shortname
+        courseid (int): Moodle courseid
+        partitions (int): number of partitions
+        by (str): "hash" of the shortname or "courseid" modulo `partitions`
+
+    Returns:
+        int: partition in range(partitions)
+    """
+    if by == 'courseid':
+        return int(courseid) % partitions
+    if by == 'hash':
+        return zlib.crc32(shortname.encode()) % partitions
+    raise ValueError(f'Unknown partitioning {by!r}, expected "hash" or "courseid"')
+
+
+def partition_mapping(entries, partitions, by='hash'):
+    """Split mapping `entries` into `partitions` mappings.
+
+    Returns:
+        list: list of mapping dictionaries, one per partition
+    """
+    parts = [{} for _ in range(partitions)]
+    for shortname, entry in entries.items():
+        parts[partition_of(shortname, entry['id'], partitions, by)][shortname] = entry
+    return parts
+
+
+def class_path(cls):
+    return f'{cls.__module__}.{cls.__qualname__}'
+
+
+def import_class(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+class WorkQueue():
+    """SQLite work queue of mapping partitions shared by a coordinator
+    and its workers on one machine or, over a shared file system, on
+    several nodes.
+
+    A run records the mapping file, term, year and sync class, so workers
+    need nothing but the queue to pull their partition. Submitting a run
+    cancels the unfinished partitions of earlier runs of the same mapping
+    file and term. Claims take the database write lock, so each partition
+    goes to one worker at a time; the worker renews its lease while it
+    pulls, and a partition whose worker stays silent for `lease` seconds
+    is handed out again, up to `MAX_ATTEMPTS` times.
+
+    Args:
+        path (str): location of the SQLite database
+        lease (float): seconds a claimed partition stays with its worker
+    """
+    def __init__(self, path=QUEUE_PATH, lease=LEASE):
+        self.path = path
+        self.lease = lease
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        con = sqlite3.connect(path, timeout=60)
+        con.executescript(SCHEMA)
+        con.close()
+
+    def connect(self):
+        return _Connection(self.path)
+
+    def submit(self, mapping_path, term=TERM, year=YEAR, sync_class=SyncEnrollments,
+               partitions=PARTITIONS, by='hash'):
+        """Queue every partition of a mapping file, cancelling what is left
+        of earlier runs of the same file and term.
+
+        Returns:
+            str: run id
+        """
+        run = f'{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        with self.connect() as con:
+            con.execute("UPDATE tasks SET status = 'cancelled', error = ? "
+                        "WHERE status IN ('queued', 'running') AND run IN ("
+                        "SELECT run FROM runs WHERE mapping_path = ? AND term = ? AND year = ?)",
+                        (f'superseded by {run}', mapping_path, term, year))
+            con.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (run, mapping_path, term, year, class_path(sync_class),
+                         partitions, by, time.time()))
+            con.executemany("INSERT INTO tasks VALUES (?, ?, 'queued', NULL, 0, NULL, NULL, "
+                            "NULL, NULL)", [(run, partition) for partition in range(partitions)])
+        return run
+
+    def claim(self, worker, run=None):
+        """Claim the oldest queued or expired partition, of `run` only if
+        given.
+
+        Returns:
+            dict: run and partition columns, or None when nothing is left
+        """
+        now = time.time()
+        with self.connect() as con:
+            con.execute("UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                        "WHERE status = 'running' AND claimed < ? AND attempts >= ?",
+                        (now - self.lease, MAX_ATTEMPTS))
+            row = con.execute(
+                "SELECT t.run, t.partition, r.mapping_path, r.term, r.year, r.sync_class, "
+                "r.partitions, r.partition_by FROM tasks t JOIN runs r ON r.run = t.run "
+                "WHERE (t.status = 'queued' OR (t.status = 'running' AND t.claimed < ?)) "
+                "AND (? IS NULL OR t.run = ?) "
+                "ORDER BY r.created, t.partition LIMIT 1",
+                (now - self.lease, run, run)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE tasks SET status = 'running', worker = ?, claimed = ?, "
+                        "attempts = attempts + 1 WHERE run = ? AND partition = ?",
+                        (worker, now, row[0], row[1]))
+        return dict(zip(('run', 'partition', 'mapping_path', 'term', 'year', 'sync_class',
+                         'partitions', 'partition_by'), row))
+
+    def renew(self, run, partition, worker):
+        """Extend the lease of `worker` on a running partition.
+
+        Returns:
+            bool: whether `worker` still holds the partition
+        """
+        with self.connect() as con:
+            cursor = con.execute("UPDATE tasks SET claimed = ? WHERE run = ? AND partition = ? "
+                                 "AND status = 'running' AND worker = ?",
+                                 (time.time(), run, partition, worker))
+        return cursor.rowcount == 1
+
+    def finish(self, run, partition, result=None, error=None, worker=None):
+        """Mark a partition "done" with its `result` file or "failed". With
+        `worker`, only while that worker holds the running partition, so a
+        worker which lost its lease or run does not overwrite the outcome.
+
+        Returns:
+            bool: whether the partition was marked
+        """
+        with self.connect() as con:
+            cursor = con.execute(
+                'UPDATE tasks SET status = ?, finished = ?, result = ?, error = ? '
+                "WHERE run = ? AND partition = ? AND (? IS NULL OR (status = 'running' "
+                'AND worker = ?))',
+                ('failed' if error else 'done', time.time(), result, error,
+                 run, partition, worker, worker))
+        return cursor.rowcount == 1
+
+    def tasks(self, run):
+        """Returns:
+            pandas.DataFrame: partitions of `run` and their status
+        """
+        with self.connect() as con:
+            rows = con.execute('SELECT partition, status, worker, attempts, result, error '
+                               'FROM tasks WHERE run = ? ORDER BY partition', (run,)).fetchall()
+        return pd.DataFrame(rows, columns=['partition', 'status', 'worker', 'attempts',
+                                           'result', 'error'])
+
+    def run_info(self, run):
+        with self.connect() as con:
+            row = con.execute('SELECT mapping_path, term, year, sync_class FROM runs '
+                              'WHERE run = ?', (run,)).fetchone()
+        return dict(zip(('mapping_path', 'term', 'year', 'sync_class'), row))
+
+    def wait(self, run, timeout=None, poll=POLL):
+        """Block until every partition of `run` is done, failed or
+        cancelled.
+
+        Returns:
+            bool: False if `timeout` seconds passed first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.tasks(run).status.isin(['done', 'failed', 'cancelled']).all():
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+
+
+class _Connection():
+    """SQLite connection in autocommit mode whose block runs in one
+    immediate transaction, taking the write lock up front.
+    """
+    def __init__(self, path):
+        self.con = sqlite3.connect(path, timeout=60, isolation_level=None)
+
+    def __enter__(self):
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        self.con.execute('ROLLBACK' if exc_type else 'COMMIT')
+        self.con.close()
+
+
+async def pull_partition(task, session, cache_dir=CACHE_DIR, ledger_path=LEDGER_PATH):
+    """Pull and diff the partition of a claimed `task`.
+
+    The partition keeps its own Moodle roster snapshot and PowerCampus
+    cache. Pending ledger records are subtracted read-only; the records
+    still pending after confirmation are returned for the merge step.
+
+    Returns:
+        dict: "conduit_dfs", "wc_userids", "shortnames" of the partition
+        and "pending" ledger records
+    """
+    mapping = MappingFile(task['mapping_path']).load()
+    entries = partition_mapping(mapping.entries, task['partitions'],
+                                task['partition_by'])[task['partition']]
+    if not entries:
+        return {'conduit_dfs': {}, 'wc_userids': {}, 'shortnames': [], 'pending': []}
+    sync_class = import_class(task['sync_class'])
+    stem = os.path.basename(task['mapping_path']).rsplit('.', 1)[0]
+    label = f"{task['partition']}of{task['partitions']}"
+    name = f"{stem}_{task['term']}{task['year']}_{label}"
+    ledger = PendingLedger(ledger_path)
+    se = await sync_class.pull(
+        entries, session=session, ledger=ledger, term=task['term'], year=task['year'],
+        snapshot=RosterSnapshot(os.path.join(cache_dir, f'wc_roster_snapshot_{label}.json')),
+        pc_cache=IncrementalExtract(f'pc_rosters_{name}',
+                                    path=os.path.join(cache_dir, f'pc_rosters_{name}.pkl')))
+    return {'conduit_dfs': se.conduit_dfs, 'wc_userids': se.wc_userids,
+            'shortnames': list(entries),
+            'pending': [key for key in ledger.entries if key[1] in entries]}
+
+
+def work(queue_path=QUEUE_PATH, cache_dir=CACHE_DIR, ledger_path=LEDGER_PATH, worker=None,
+         run=None, lease=LEASE):
+    """Worker loop: claim partitions, of `run` only if given, pull and diff
+    them and store their result next to the queue until no partition is
+    left. The lease of a partition is renewed every third of `lease`
+    seconds while it is pulled.
+
+    Returns:
+        int: number of partitions processed
+    """
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    queue = WorkQueue(queue_path, lease=lease)
+
+    async def heartbeat(task):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(queue.lease / 3)
+            if not await loop.run_in_executor(None, queue.renew, task['run'],
+                                              task['partition'], worker):
+                print(f"partition {task['partition']} of {task['run']} taken from {worker}")
+                return
+
+    async def run_tasks():
+        done = 0
+        session = create_session()
+        try:
+            while True:
+                task = queue.claim(worker, run)
+                if task is None:
+                    return done
+                result_path = os.path.join(os.path.dirname(queue.path) or '.',
+                                           f"{task['run']}-{task['partition']}.pkl")
+                renewing = asyncio.ensure_future(heartbeat(task))
+                try:
+                    result = await pull_partition(task, session, cache_dir, ledger_path)
+                    with open(result_path + '.tmp', 'wb') as f:
+                        pickle.dump(result, f)
+                    os.replace(result_path + '.tmp', result_path)
+                    queue.finish(task['run'], task['partition'], result=result_path,
+                                 worker=worker)
+                except Exception as err:
+                    print(f"partition {task['partition']} of {task['run']} failed: {err!r}")
+                    queue.finish(task['run'], task['partition'], error=repr(err), worker=worker)
+                finally:
+                    renewing.cancel()
+                done += 1
+        finally:
+            await session.close()
+
+    try:
+        return asyncio.run(run_tasks())
+    finally:
+        PcConnect.close_shared()
+
+
+def merge_partitions(queue, run, ledger=None, conduit=None, timeout=None):
+    """Assemble the partition results of `run` into one pipeline to push,
+    once every partition finished.
+
+    Partitions that failed or were cancelled are reported and left out.
+    Ledger records of merged partitions that their worker confirmed are
+    dropped from `ledger`.
+
+    Args:
+        timeout (float): seconds to wait for running partitions, None to
+        wait until they finish
+
+    Returns:
+        SyncEnrollments: pipeline of the whole mapping with the merged
+        `conduit_dfs`, ready to push once
+
+    Raises:
+        TimeoutError: if partitions are still running after `timeout`
+    """
+    if not queue.wait(run, timeout):
+        raise TimeoutError(f'partitions of {run} still running after {timeout}s')
+    info = queue.run_info(run)
+    tasks = queue.tasks(run)
+    se = import_class(info['sync_class'])(MappingFile(info['mapping_path']).load(),
+                                          conduit=conduit, ledger=ledger,
+                                          term=info['term'], year=info['year'])
+    frames = {}
+    for task in tasks.itertuples():
+        if task.status != 'done':
+            print(f'partition {task.partition} of {run} {task.status}: {task.error}')
+            continue
+        with open(task.result, 'rb') as f:
+            result = pickle.load(f)
+        os.remove(task.result)
+        for df_key, df in result['conduit_dfs'].items():
+            frames.setdefault(df_key, []).append(df)
+        se.wc_userids.update(result['wc_userids'])
+        if ledger is not None:
+            ledger.keep_pending(result['shortnames'], result['pending'])
+    se.conduit_dfs = {df_key: pd.concat(dfs, ignore_index=True)
+                      for df_key, dfs in frames.items()}
+    return se
+
+
+def run_local(mapping_path, workers=PARTITIONS, term=TERM, year=YEAR,
+              sync_class=SyncEnrollments, partitions=PARTITIONS, by='hash',
+              queue_path=QUEUE_PATH, cache_dir=CACHE_DIR, ledger_path=LEDGER_PATH,
+              push=True):
+    """Sync one mapping with `workers` local worker processes, then merge
+    and push one Conduit file.
+
+    Partitions of the run still held by workers on other nodes are waited
+    for; those whose worker went silent are pulled again in this process
+    once their lease expired.
+
+    Returns:
+        SyncEnrollments: merged pipeline
+    """
+    queue = WorkQueue(queue_path)
+    run = queue.submit(mapping_path, term, year, sync_class, partitions, by)
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=work, args=(queue_path, cache_dir, ledger_path),
+                                 kwargs={'run': run})
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    while not queue.wait(run, timeout=queue.lease):
+        work(queue_path, cache_dir, ledger_path, run=run)
+    ledger = PendingLedger(ledger_path)
+    se = merge_partitions(queue, run, ledger=ledger)
+    if push:
+        try:
+            asyncio.run(se.push())
+        finally:
+            ConduitSession.close_shared()
+        ledger.save()
+    return se
@@ -0,0 +1,227 @@
+from collections.abc import Mapping
+from itertools import islice
+import threading
+
+import numpy as np
+import pandas as pd
+
+ROLES = ('student', 'auditingstudent')
+# Code of null and empty idnumbers, which are left out of rosters
+MISSING = -1
+
+
+class IdInterner():
+    """Thread-safe mapping of idnumber strings to dense integer codes.
+
+    Attributes:
+        codes (dict): idnumber as key and code as value
+        idnumbers (list): idnumbers indexed by code
+    """
+    def __init__(self):
+        self.codes = {}
+        self.idnumbers = []
+        self._lock = threading.Lock()
+        self._decoder = np.empty(0, dtype=object)
+
+    def __len__(self):
+        return len(self.idnumbers)
+
+    def __getstate__(self):
+        return {'idnumbers': self.idnumbers}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.idnumbers = state['idnumbers']
+        self.codes = {idnumber: code for code, idnumber in enumerate(self.idnumbers)}
+
+    def encode(self, idnumbers):
+        """Codes of `idnumbers`, interning new ones. Each distinct value is
+        looked up once. Null and empty idnumbers are not interned and get
+        the code `MISSING`.
+
+        Returns:
+            numpy.ndarray: int64 codes in the order of `idnumbers`
+        """
+        if not isinstance(idnumbers, (np.ndarray, pd.Series, list)):
+            idnumbers = list(idnumbers)
+        # nulls are factorized to position -1
+        positions, uniques = pd.factorize(np.asarray(idnumbers, dtype=object))
+        with self._lock:
+            codes = self.codes
+            setdefault = codes.setdefault
+            unique_codes = np.fromiter((MISSING if idnumber == '' else setdefault(idnumber, len(codes))
+                                        for idnumber in uniques),
+                                       dtype=np.int64, count=len(uniques))
+            if len(codes) > len(self.idnumbers):
+                self.idnumbers.extend(islice(codes, len(self.idnumbers), None))
+        result = np.full(len(positions), MISSING, dtype=np.int64)
+        found = positions >= 0
+        result[found] = unique_codes[positions[found]]
+        return result
+
+    def decode(self, codes):
+        """idnumber strings of integer `codes`.
+
+        Returns:
+            numpy.ndarray: object array of idnumbers
+        """
+        if len(self._decoder) != len(self.idnumbers):
+            self._decoder = np.asarray(self.idnumbers, dtype=object)
+        return self._decoder[codes]
+
+    def translate(self, other):
+        """Array mapping codes of interner `other` to codes of this one.
+        """
+        if other is self:
+            return np.arange(len(self), dtype=np.int64)
+        return self.encode(other.idnumbers)
+
+
+class RosterStore(Mapping):
+    """Compact roster store holding every (key, role) roster as a sorted
+    array of interned idnumber codes, e.g. 4 bytes per enrollment instead
+    of a set of strings.
+
+    The store is a read-only mapping of key to a mapping of role to set of
+    idnumbers, so it can stand in for the previous dictionary of
+    dictionary of sets. Sets returned by the view are copies; use `add`,
+    `add_frame` and `discard` to change the store.
+
+    Args:
+        interner (IdInterner): optional interner to share between stores
+
+    Example:
+        >>> store = RosterStore()
+        >>> store.add(("Kniting", "01"), "student", ["0023"])
+        >>> store[("Kniting", "01")]["student"]
+        {"0023"}
+    """
+    def __init__(self, interner=None):
+        self.interner = interner if interner is not None else IdInterner()
+        self.rosters = {}
+
+    @classmethod
+    def from_rosters(cls, rosters, interner=None):
+        """Build a store from a dictionary of key and dictionary of role
+        and iterable of idnumbers.
+        """
+        if isinstance(rosters, RosterStore):
+            return rosters
+        store = cls(interner)
+        for key, roles in rosters.items():
+            for role, idnumbers in roles.items():
+                store.add(key, role, idnumbers)
+        return store
+
+    def __getitem__(self, key):
+        return RoleView(self, key, self.rosters[key])
+
+    def __iter__(self):
+        return iter(self.rosters)
+
+    def __len__(self):
+        return len(self.rosters)
+
+    def codes(self, key, role):
+        """Sorted idnumber codes of a roster, empty if missing.
+        """
+        return self.rosters.get(key, {}).get(role, np.empty(0, dtype=np.int32))
+
+    def add(self, key, role, idnumbers):
+        """Add iterable of idnumbers to the roster of `key` and `role`.
+        """
+        codes = self.interner.encode(idnumbers)
+        self.add_codes(key, role, np.unique(codes[codes != MISSING]))
+
+    def add_codes(self, key, role, codes):
+        """Add sorted unique `codes` to the roster of `key` and `role`.
+        """
+        roles = self.rosters.setdefault(key, {})
+        current = roles.get(role)
+        codes = np.asarray(codes, dtype=np.int32)
+        roles[role] = codes if current is None else np.union1d(current, codes)
+
+    def add_frame(self, df, key_columns, role_column='role', id_column='idnumber'):
+        """Add long format enrollments, interning the whole idnumber column
+        at once and grouping rows by key and role.
+
+        Args:
+            df (DataFrame): enrollments with `key_columns`, `role_column`
+            and `id_column` columns, rows with a null or empty idnumber
+            are skipped
+            key_columns (list): columns forming the key, a single column
+            gives scalar keys
+        """
+        if df.empty:
+            return
+        codes = self.interner.encode(df[id_column].to_numpy(object))
+        found = codes != MISSING
+        if not found.all():
+            df, codes = df[found], codes[found]
+        groups = df.groupby(list(key_columns) + [role_column], observed=True, sort=False).indices
+        for group, positions in groups.items():
+            key, role = (group[:-1], group[-1])
+            key = key[0] if len(key_columns) == 1 else tuple(key)
+            self.add_codes(key, role, np.unique(codes[positions]))
+
+    def discard(self, key, codes):
+        """Remove sorted `codes` from every role roster of `key`.
+        """
+        for role, current in self.rosters.get(key, {}).items():
+            self.rosters[key][role] = np.setdiff1d(current, codes, assume_unique=True)
+
+    def update(self, other):
+        """Union the rosters of store `other` into this store.
+        """
+        translation = self.interner.translate(other.interner)
+        for key, roles in other.rosters.items():
+            for role, codes in roles.items():
+                self.add_codes(key, role, np.sort(translation[codes]))
+
+    def flatten(self, roles=ROLES, keys=None):
+        """Flatten rosters into parallel arrays, one entry per enrollment.
+
+        Args:
+            roles (tuple): roles to keep, in the order of their codes
+            keys (list): keys to keep, in the order of their codes,
+            defaults to every key of the store
+
+        Returns:
+            tuple: list of keys, array of key codes (index in keys), array
+            of role codes (index in roles), array of idnumber codes
+        """
+        keys = list(self.rosters) if keys is None else list(keys)
+        key_parts, role_parts, id_parts = [], [], []
+        for key_code, key in enumerate(keys):
+            for role_code, role in enumerate(roles):
+                codes = self.codes(key, role)
+                if len(codes):
+                    key_parts.append(np.full(len(codes), key_code, dtype=np.int64))
+                    role_parts.append(np.full(len(codes), role_code, dtype=np.int64))
+                    id_parts.append(codes.astype(np.int64))
+        if not key_parts:
+            empty = np.empty(0, dtype=np.int64)
+            return keys, empty, empty.copy(), empty.copy()
+        return (keys, np.concatenate(key_parts), np.concatenate(role_parts),
+                np.concatenate(id_parts))
+
+
+class RoleView(Mapping):
+    """Read-only mapping of role to set of idnumbers for one store key.
+    """
+    def __init__(self, store, key, roles):
+        self.store = store
+        self.key = key
+        self.roles = roles
+
+    def __getitem__(self, role):
+        return set(self.store.interner.decode(self.roles[role]))
+
+    def __iter__(self):
+        return iter(self.roles)
+
+    def __len__(self):
+        return len(self.roles)
+
+    def __repr__(self):
+        return repr(dict(self))
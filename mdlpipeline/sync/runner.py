@@ -0,0 +1,265 @@
+from mdlpipeline.utils.mdltools.conduit import ConduitSession
+from mdlpipeline.utils.mdltools.mdl_connect import create_session
+from mdlpipeline.utils.mdltools.snapshot import RosterSnapshot
+from mdlpipeline.utils.sqltools.pc_connect import PcConnect
+from .enrollments import TERM, YEAR
+from .incremental import IncrementalExtract
+from .ledger import PendingLedger
+from .mapping import MappingFile
+from .warm import WarmState, WARM_DIR, WARM_START
+from mdlpipeline.utils import metrics
+
+from concurrent.futures import ProcessPoolExecutor
+from os import getenv
+import asyncio
+import os
+import time
+
+# Worker processes for the Python diff, 0 diffs on the event loop thread
+PROCESSES = int(getenv('SYNC_DIFF_PROCESSES', 0))
+
+JOB_FAILURES = metrics.counter('sync_job_failures_total', 'Sync jobs that failed to pull',
+                               ['job'])
+WARM_PUSH_SECONDS = metrics.gauge('sync_warm_push_seconds',
+                                  'Seconds from the first run to the push of saved rosters')
+
+
+class SyncJob():
+    """A sync pipeline of one mapping and term, with the state it keeps
+    warm across runs.
+
+    Args:
+        sync_class (type): `SyncEnrollments` or a subclass
+        mapping_path (str): location of the JSON mapping file
+        term (str): PowerCampus academic term, e.g. "Winter"
+        year (str): PowerCampus academic year, e.g. "2021"
+        name (str): name of the job, used for its PowerCampus cache and
+        warm state; defaults to the mapping file name, term and year
+        warm_dir (str): parent directory of the warm state, None to not
+        save rosters
+
+    Attributes:
+        mapping_file (MappingFile): mapping recompiled when the file changes
+        pc_cache (IncrementalExtract): PowerCampus roster cache of the job
+        warm (WarmState): rosters of the last pull, or None
+        last (SyncEnrollments): pipeline of the last run
+    """
+    def __init__(self, sync_class, mapping_path, term=TERM, year=YEAR, name=None,
+                 warm_dir=WARM_DIR):
+        self.sync_class = sync_class
+        self.term = term
+        self.year = year
+        if name is None:
+            stem = mapping_path.replace('\\', '/').rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            name = f'{stem}_{term}{year}'
+        self.name = name
+        self.mapping_file = MappingFile(mapping_path)
+        self.pc_cache = IncrementalExtract(f'pc_rosters_{name}')
+        self.warm = WarmState(os.path.join(warm_dir, name)) if warm_dir else None
+        self.last = None
+
+    async def pull(self, session, snapshot, ledger, executor=None):
+        """Pull and diff once, and save the pulled rosters for a warm
+        start before they are pushed.
+
+        Returns:
+            SyncEnrollments: pulled pipeline, ready to push
+        """
+        se = await self.sync_class.pull(self.mapping_file.load(), session=session,
+                                        snapshot=snapshot, pc_cache=self.pc_cache,
+                                        ledger=ledger, term=self.term, year=self.year,
+                                        executor=executor)
+        self.last = se
+        if self.warm is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.warm.save, se)
+            except (OSError, ValueError) as err:
+                print(f'{self.name} warm state not saved: {err!r}')
+        return se
+
+    async def warm_pull(self, session, ledger):
+        """Diff the rosters saved by the last pull, see
+        `SyncEnrollments.warm_start`. The blocking PowerCampus query and
+        the diff run in the default executor.
+
+        Returns:
+            SyncEnrollments: pipeline ready to push, None without a valid
+            warm state
+        """
+        if self.warm is None:
+            return None
+        mapping = self.mapping_file.load()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.sync_class.warm_start(mapping, self.warm, session=session,
+                                                     ledger=ledger, term=self.term,
+                                                     year=self.year))
+
+
+class SyncRunner():
+    """Run several sync jobs, e.g. of overlapping terms or cohorts,
+    concurrently and push their changes together.
+
+    Jobs share the Moodle HTTP session, Moodle roster snapshot, pending
+    change ledger, PowerCampus connection pool and Conduit SFTP session.
+    Pulls run concurrently on the event loop, so a run takes about as long
+    as its slowest job; with `processes` the Python diffs of the jobs run
+    in a process pool instead of one after the other on the loop thread.
+    The diffs of the jobs that pulled without error are merged per
+    pipeline class and mapping file, without duplicate records, and the
+    merged diffs are pushed one after the other, so jobs never race for
+    the same Conduit file.
+
+    With `warm_start`, the first run pushes the diff of the rosters each
+    job saved on its last pull, typically seconds after a restart, while
+    the fresh pull runs in the background; the fresh diff is pushed when
+    it is ready. Changes of the warm push are recorded in the ledger and
+    left out of the fresh diff, which is pushed after the warm push
+    finished even when the fresh pull finishes first.
+
+    Args:
+        jobs (list): list of `SyncJob`
+        processes (int): worker processes for diffing, 0 for none
+        warm_start (bool): push from saved rosters on the first run
+
+    Attributes:
+        last (list): merged pipelines pushed by the last run
+        failures (dict): job name as key and exception as value of the
+        jobs that failed in the last run
+    """
+    def __init__(self, jobs, processes=PROCESSES, warm_start=WARM_START):
+        self.jobs = jobs
+        self.processes = processes
+        self.warm_start = warm_start
+        self.session = None
+        self.snapshot = None
+        self.ledger = None
+        self.executor = None
+        self.last = None
+        self.failures = {}
+
+    async def open(self):
+        self.session = create_session()
+        self.snapshot = RosterSnapshot()
+        self.ledger = PendingLedger()
+        if self.processes:
+            self.executor = ProcessPoolExecutor(self.processes)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, PcConnect.close_shared)
+        await loop.run_in_executor(None, ConduitSession.close_shared)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def pull(self):
+        """Pull and diff all jobs concurrently. A failing job is reported
+        and does not affect the other jobs.
+
+        Returns:
+            list: pulled pipelines of the jobs that did not fail
+        """
+        results = await asyncio.gather(
+            *(job.pull(self.session, self.snapshot, self.ledger, self.executor)
+              for job in self.jobs), return_exceptions=True)
+        pipelines = []
+        self.failures = {}
+        for job, result in zip(self.jobs, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                print(f'{job.name} sync failed: {result!r}')
+                JOB_FAILURES.inc(job=job.name)
+                metrics.log_event('sync_job_failed', job=job.name, error=repr(result))
+                self.failures[job.name] = result
+            else:
+                pipelines.append(result)
+        return pipelines
+
+    async def push(self, pipelines):
+        """Merge `pipelines` of the same class and mapping, e.g. of several
+        terms, and push each merged pipeline in turn. A failing push is
+        reported and raised once the others were pushed.
+
+        Returns:
+            int: number of add/drop records pushed
+        """
+        groups = {}
+        for se in pipelines:
+            # mappings read from different files may reuse Moodle course ids
+            mapping = se.mapping.digest if se.mapping.digest is not None else id(se.mapping)
+            groups.setdefault((type(se), mapping), []).append(se)
+        self.last = []
+        changes = 0
+        error = None
+        for group in groups.values():
+            se = group[0] if len(group) == 1 else type(group[0]).merge(group)
+            try:
+                await se.push()
+            except Exception as err:
+                print(f'push of {len(group)} pipelines failed: {err!r}')
+                error = error or err
+                continue
+            self.last.append(se)
+            changes += sum(len(df) for df in se.conduit_dfs.values())
+        if error is not None:
+            raise error
+        return changes
+
+    async def run(self):
+        """Pull all jobs and push their merged changes, after
+        pushing from saved rosters on the first run with `warm_start`.
+
+        Returns:
+            int: number of add/drop records of all jobs
+        """
+        if self.warm_start:
+            self.warm_start = False
+            return await self.run_warm()
+        return await self.push(await self.pull())
+
+    async def run_warm(self):
+        """Push the diff of the saved rosters of every job while pulling
+        fresh rosters, then push the fresh diff.
+
+        Returns:
+            int: number of add/drop records of both pushes
+        """
+        start = time.perf_counter()
+        fresh = asyncio.ensure_future(self.pull())
+        try:
+            results = await asyncio.gather(
+                *(job.warm_pull(self.session, self.ledger) for job in self.jobs),
+                return_exceptions=True)
+            pipelines = []
+            for job, result in zip(self.jobs, results):
+                if isinstance(result, asyncio.CancelledError):
+                    raise result
+                if isinstance(result, Exception):
+                    print(f'{job.name} warm start failed: {result!r}')
+                elif result is not None:
+                    pipelines.append(result)
+            changes = 0
+            if pipelines:
+                try:
+                    changes = await self.push(pipelines)
+                except Exception as err:
+                    print(f'warm push failed: {err!r}')
+                else:
+                    seconds = time.perf_counter() - start
+                    WARM_PUSH_SECONDS.set(seconds)
+                    metrics.log_event('sync_warm_push', jobs=len(pipelines), changes=changes,
+                                      seconds=seconds)
+                    print(f'{changes} changes pushed from saved rosters in {seconds:.1f}s')
+            pipelines = await fresh
+            if self.ledger is not None:
+                # the fresh diff may have been taken before the warm push
+                # recorded its changes
+                for se in pipelines:
+                    se.conduit_dfs['enrollments'] = self.ledger.subtract(
+                        se.conduit_dfs['enrollments'])
+            return changes + await self.push(pipelines)
+        finally:
+            fresh.cancel()
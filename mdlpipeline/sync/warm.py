@@ -0,0 +1,187 @@
+from .rosters import IdInterner, RosterStore
+
+from datetime import datetime
+from os import getenv
+import json
+import os
+import time
+
+import numpy as np
+
+WARM_DIR = 'cache/warm'
+# 1 to push from the last pulled rosters on startup while a fresh pull runs
+WARM_START = int(getenv('SYNC_WARM_START', 1))
+# Seconds after which saved rosters are too old to push from
+MAX_AGE = 6 * 60 * 60
+# Bumped when the layout of saved rosters changes, older states are ignored
+VERSION = 1
+
+
+def encode_key(key):
+    return list(key) if isinstance(key, tuple) else key
+
+
+def decode_key(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+class WarmState():
+    """Rosters of the last pull of a pipeline saved as memory-mapped NumPy
+    arrays, to diff and push right after a restart without pulling.
+
+    Each roster store is saved as one array of idnumber codes of all its
+    rosters and an array of offsets, with the (key, role) of each roster
+    in meta.json, along with the interned idnumbers, the Moodle user ids
+    and what the state is valid for. Loading maps the arrays read-only
+    and slices them, so it costs about as much as reading meta.json.
+
+    Arrays are written under a new generation name and meta.json is
+    replaced last, so a crash while saving leaves the previous state.
+
+    Args:
+        path (str): directory of the state
+        max_age (float): seconds a saved state may be restored
+
+    Attributes:
+        meta (dict): metadata of the last saved or loaded state
+    """
+    def __init__(self, path, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.meta = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def save_array(self, name, generation, array):
+        file_name = f'{name}.{generation}.npy'
+        np.save(self.file(file_name), array, allow_pickle=False)
+        return file_name
+
+    def load_array(self, file_name):
+        return np.load(self.file(file_name), mmap_mode='r', allow_pickle=False)
+
+    def save_store(self, name, generation, store, interner):
+        # codes are saved as codes of `interner`, shared by all stores
+        translation = None if store.interner is interner else interner.translate(store.interner)
+        rosters, offsets, parts = [], [0], []
+        for key, roles in store.rosters.items():
+            for role, codes in roles.items():
+                if translation is not None:
+                    codes = np.sort(translation[codes])
+                rosters.append([encode_key(key), role])
+                parts.append(np.asarray(codes, dtype=np.int32))
+                offsets.append(offsets[-1] + len(codes))
+        codes = np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
+        return {'rosters': rosters,
+                'codes': self.save_array(f'{name}_codes', generation, codes),
+                'offsets': self.save_array(f'{name}_offsets', generation,
+                                           np.asarray(offsets, dtype=np.int64))}
+
+    def load_store(self, meta, interner):
+        codes = self.load_array(meta['codes'])
+        offsets = self.load_array(meta['offsets'])
+        store = RosterStore(interner)
+        for (key, role), start, end in zip(meta['rosters'], offsets[:-1], offsets[1:]):
+            # read-only views, store changes replace arrays instead of
+            # writing to them
+            store.rosters.setdefault(decode_key(key), {})[role] = codes[start:end]
+        return store
+
+    def save(self, se):
+        """Save the rosters pulled by `se`. Pipelines without PowerCampus
+        rosters, i.e. diffed in SQL, or without a mapping file are skipped.
+
+        Returns:
+            bool: whether the state was saved
+        """
+        if not isinstance(se.pc_rosters, RosterStore) or se.mapping.digest is None:
+            return False
+        os.makedirs(self.path, exist_ok=True)
+        previous = self.read_meta()
+        generation = (previous or {}).get('generation', 0) + 1
+        interner = se.pc_rosters.interner
+        wc = self.save_store('wc', generation, se.wc_rosters, interner)
+        pc = self.save_store('pc', generation, se.pc_rosters, interner)
+        userids = sorted(se.wc_userids.items())
+        watermark = getattr(se.pc_cache, 'watermark', None)
+        meta = {
+            'version': VERSION,
+            'pipeline': type(se).__name__,
+            'term': se.term,
+            'year': se.year,
+            'mapping_digest': se.mapping.digest,
+            'saved': time.time(),
+            'watermark': watermark.isoformat() if watermark else None,
+            'generation': generation,
+            'idnumbers': self.save_array('idnumbers', generation,
+                                         np.asarray(interner.idnumbers, dtype=str)),
+            'userid_idnumbers': self.save_array(
+                'userid_idnumbers', generation,
+                np.asarray([idnumber for idnumber, _ in userids], dtype=str)),
+            'userids': self.save_array('userids', generation,
+                                       np.asarray([userid for _, userid in userids],
+                                                  dtype=np.int64)),
+            'wc': wc,
+            'pc': pc,
+        }
+        tmp_path = self.file('meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.file('meta.json'))
+        self.meta = meta
+        self.remove_stale(generation)
+        return True
+
+    def remove_stale(self, generation):
+        for file_name in os.listdir(self.path):
+            if file_name.endswith('.npy') and not file_name.endswith(f'.{generation}.npy'):
+                try:
+                    os.remove(self.file(file_name))
+                except OSError:
+                    # still mapped, e.g. on Windows; removed after the next save
+                    pass
+
+    def read_meta(self):
+        try:
+            with open(self.file('meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            print(f'warm state {self.path} not read: {err!r}')
+            return None
+
+    def restore(self, se):
+        """Load the saved rosters into `se` if they were saved by the same
+        pipeline class for the same term and mapping file, at most
+        `max_age` seconds ago.
+
+        Returns:
+            bool: whether the rosters were restored
+        """
+        meta = self.read_meta()
+        if (meta is None or meta.get('version') != VERSION
+                or meta['pipeline'] != type(se).__name__
+                or (meta['term'], meta['year']) != (se.term, se.year)
+                or meta['mapping_digest'] != se.mapping.digest
+                or time.time() - meta['saved'] > self.max_age):
+            return False
+        interner = IdInterner()
+        interner.__setstate__({'idnumbers': self.load_array(meta['idnumbers']).tolist()})
+        se.interner = interner
+        se.wc_rosters = self.load_store(meta['wc'], interner)
+        se.pc_rosters = self.load_store(meta['pc'], interner)
+        se.wc_userids = dict(zip(self.load_array(meta['userid_idnumbers']).tolist(),
+                                 self.load_array(meta['userids']).tolist()))
+        self.meta = meta
+        return True
+
+    def watermark(self):
+        """Returns:
+            datetime: PowerCampus server time the restored PowerCampus
+            rosters are current as of, None if unknown
+        """
+        if not self.meta or not self.meta.get('watermark'):
+            return None
+        return datetime.fromisoformat(self.meta['watermark'])
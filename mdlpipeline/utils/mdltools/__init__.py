@@ -1,6 +1,8 @@
-from . import conduit
-from . import mdl_connect
-
-name = "mdl_tools"
-
-__all__ = ["conduit", "mdl_connect"]
\ No newline at end of file
+from . import conduit
+from . import enrol
+from . import mdl_connect
+from . import snapshot
+
+name = "mdl_tools"
+
+__all__ = ["conduit", "enrol", "mdl_connect", "snapshot"]
\ No newline at end of file
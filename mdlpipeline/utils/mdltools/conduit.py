@@ -1,56 +1,358 @@
-import pandas as pd
-import pysftp #0.2.8
-from io import StringIO
-import os
-
-SFTP_HOST = os.getenv('SFTP_HOST')
-SFTP_USER = 'uws'
-SFTP_PW = os.getenv('SFTP_PW')
-
-def sftp_file_exists(sftp, filename):
-    try:
-        sftp.get(filename)
-        return True
-    except FileNotFoundError:
-        return False
-
-def put_conduit_file(string, fn):
-    with pysftp.Connection(SFTP_HOST,
-                           username=SFTP_USER,
-                           password=SFTP_PW,
-                           port=22222) as sftp:
-        if not sftp_file_exists(sftp,'webcampus.uws.edu/conduit/' + fn):
-            string_buf = StringIO(string)
-            string_buf.seek(0)
-            sftp.putfo(string_buf, 'webcampus.uws.edu/conduit/' + fn)
-
-def transform_provision_df(obj, rename_map={}, action='create', **kwargs):
-    # read data
-    if isinstance(obj, str):
-        pc_df = pd.read_excel(path, dtype=object)
-    elif isinstance(obj, pd.DataFrame):
-        pc_df = obj.copy()
-
-    # Filter columns, rename columns, and drop empty rows
-    if rename_map:
-        pc_df = pc_df[list(rename_map.keys())].rename(columns=rename_map)
-    else: 
-         pc_df = pc_df[['idnumber']]
-
-    # Drop empty rows
-    pc_df.dropna(axis=0, how='all', inplace=True)
-
-    # Create columns with default values
-    pc_df['action'] = action
-    
-    # Add columns with default values
-    for kwarg in kwargs:
-        pc_df[kwarg] = kwargs[kwarg]
-
-    # modify column data
-    pc_df['idnumber'] = pc_df.idnumber.apply(lambda s: s.replace('P', '') if isinstance(s, str) else str(s))
-    
-    if 'email' in pc_df.columns:
-        pc_df['username'] = pc_df.email.copy()
-
+import pandas as pd
+import pysftp #0.2.8
+import paramiko
+from datetime import datetime
+import threading
+import gzip
+import os
+
+SFTP_HOST = os.getenv('SFTP_HOST')
+SFTP_USER = 'uws'
+SFTP_PW = os.getenv('SFTP_PW')
+SFTP_PORT = 22222
+CONDUIT_DIR = 'webcampus.uws.edu/conduit/'
+# Seconds between SSH keepalives so idle sessions survive between cycles
+KEEPALIVE = 30
+# Rows per Conduit file, larger outputs are split in sequenced files (0 to never split)
+MAX_ROWS = int(os.getenv('CONDUIT_MAX_ROWS', 10000))
+# Rows encoded to CSV at a time while streaming
+CHUNK_ROWS = 5000
+# Gzip the local log copy of Conduit files
+LOG_COMPRESS = bool(int(os.getenv('CONDUIT_LOG_GZIP', 0)))
+LOG_DIR = 'log'
+# Errors after which the session is reopened and the push retried
+CONNECTION_ERRORS = (OSError, EOFError, paramiko.SSHException, pysftp.ConnectionException)
+
+def sftp_file_exists(sftp, filename):
+    try:
+        sftp.stat(filename)
+        return True
+    except FileNotFoundError:
+        return False
+
+class ConduitSession():
+    """Authenticated SFTP session to the Conduit drop directory kept open
+    across pushes and sync cycles. The session is opened on first use and
+    reopened once when a push fails on a dropped connection.
+
+    Files are streamed into a temporary name and renamed when complete,
+    so Conduit never picks up a partial file, and a file is not pushed
+    while the previous one with the same name is still waiting to be
+    processed.
+
+    Args:
+        host (str): SFTP host, defaults to `SFTP_HOST`
+        username (str): SFTP user
+        password (str): SFTP password, defaults to `SFTP_PW`
+        port (int): SFTP port
+        directory (str): Conduit drop directory
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, host=SFTP_HOST, username=SFTP_USER, password=SFTP_PW,
+                 port=SFTP_PORT, directory=CONDUIT_DIR):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.directory = directory
+        self._sftp = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide Conduit session, creating it on first use.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def close_shared(cls):
+        """Close the process-wide Conduit session.
+        """
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+                cls._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        sftp = pysftp.Connection(self.host, username=self.username,
+                                 password=self.password, port=self.port)
+        sftp.sftp_client.get_channel().get_transport().set_keepalive(KEEPALIVE)
+        return sftp
+
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = self.connect()
+        return self._sftp
+
+    def close(self):
+        if self._sftp is not None:
+            try:
+                self._sftp.close()
+            except CONNECTION_ERRORS:
+                pass
+            self._sftp = None
+
+    def exists(self, filename):
+        """Whether `filename` is in the Conduit directory, with a single
+        stat request.
+        """
+        return sftp_file_exists(self.sftp, self.directory + filename)
+
+    def open(self, filename):
+        """Open `filename` in the Conduit directory for streaming writes
+        under its temporary name, unless the file is already there. Call
+        `commit` once the returned file is closed.
+
+        Returns:
+            paramiko.SFTPFile: writable remote file or None if it existed
+        """
+        with self._lock:
+            try:
+                return self._open(filename)
+            except CONNECTION_ERRORS as err:
+                print(f'Conduit push of {filename} failed, reconnecting: {err}')
+                self.close()
+                return self._open(filename)
+
+    def commit(self, filename):
+        """Publish a file written with `open` under its final name.
+        """
+        with self._lock:
+            self._commit(filename)
+
+    def put(self, data, filename):
+        """Stream `data` to `filename` in the Conduit directory unless the
+        file is already there.
+
+        Args:
+            data: DataFrame written as CSV without index, or str or bytes
+            filename (str): name of the file in the Conduit directory
+
+        Returns:
+            bool: True if the file was pushed, False if it already existed
+        """
+        with self._lock:
+            try:
+                return self._put(data, filename)
+            except CONNECTION_ERRORS as err:
+                print(f'Conduit push of {filename} failed, reconnecting: {err}')
+                self.close()
+                return self._put(data, filename)
+
+    def _open(self, filename):
+        path = self.directory + filename
+        if sftp_file_exists(self.sftp, path):
+            return None
+        f = self.sftp.open(path + '.part', 'wb')
+        # do not wait for the server to acknowledge every write
+        f.set_pipelined(True)
+        return f
+
+    def _commit(self, filename):
+        path = self.directory + filename
+        self.sftp.rename(path + '.part', path)
+
+    def _put(self, data, filename):
+        f = self._open(filename)
+        if f is None:
+            return False
+        with f:
+            if isinstance(data, pd.DataFrame):
+                data.to_csv(f, index=False)
+            else:
+                f.write(data)
+        self._commit(filename)
+        return True
+
+class ConduitWriter():
+    """Streaming Conduit CSV output. Records are encoded to CSV once, a
+    chunk at a time, and the encoded bytes are teed to a local log file
+    and to the Conduit upload.
+
+    Uploads with more than `max_rows` records are split in sequenced
+    files ("enrollments.csv", "enrollments-2.csv", ...), each with its own
+    header, and every file is published as soon as it is full so Conduit
+    can start processing while the rest is written. If a file of the
+    sequence is still waiting to be processed the remaining records are
+    not pushed; they are found again by the next sync's diff.
+
+    Args:
+        name (str): Conduit file type, e.g. "enrollments"
+        conduit (ConduitSession): session to push with, None to only log
+        log_dir (str): directory of the log copy, None to not log
+        compress (bool): gzip the log copy
+        max_rows (int): records per Conduit file, 0 to never split
+        chunk_rows (int): records encoded at a time
+
+    Attributes:
+        rows (int): records written
+        pushed (list): names of the Conduit files pushed
+        pushed_rows (int): records in the files pushed, always the first
+        records written
+        skipped (bool): True if records were not pushed because a file
+        was still pending
+        log_path (str): path of the log copy
+
+    Example:
+        >>> with ConduitWriter('enrollments', ConduitSession.shared()) as writer:
+        ...     writer.write(df)
+    """
+    def __init__(self, name, conduit=None, log_dir=LOG_DIR, compress=LOG_COMPRESS,
+                 max_rows=MAX_ROWS, chunk_rows=CHUNK_ROWS):
+        self.name = name
+        self.conduit = conduit
+        self.log_dir = log_dir
+        self.compress = compress
+        self.max_rows = max_rows
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self.pushed = []
+        self.pushed_rows = 0
+        self.skipped = False
+        self.log_path = None
+        self._header = None
+        self._log = None
+        self._part = None
+        self._part_number = 1
+        self._part_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def part_name(self, number):
+        return f'{self.name}.csv' if number == 1 else f'{self.name}-{number}.csv'
+
+    def write(self, df):
+        """Encode and write the records of DataFrame `df`.
+        """
+        if self._header is None:
+            self._header = df.head(0).to_csv(index=False).encode()
+            self.open_log()
+        start = 0
+        while start < len(df):
+            if self._part is None and self._part_rows == 0:
+                self.open_part()
+            size = self.chunk_rows
+            if self.max_rows:
+                size = min(size, self.max_rows - self._part_rows)
+            chunk = df.iloc[start:start + size]
+            data = chunk.to_csv(header=False, index=False).encode()
+            if self._log is not None:
+                self._log.write(data)
+            if self._part is not None:
+                self._part.write(data)
+            start += len(chunk)
+            self.rows += len(chunk)
+            self._part_rows += len(chunk)
+            if self.max_rows and self._part_rows >= self.max_rows:
+                self.finish_part()
+
+    def open_log(self):
+        if self.log_dir is None:
+            return
+        os.makedirs(self.log_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H.%M.%S")
+        self.log_path = os.path.join(self.log_dir, f'{self.name}-{timestamp}.csv')
+        if self.compress:
+            self.log_path += '.gz'
+            self._log = gzip.open(self.log_path, 'wb')
+        else:
+            self._log = open(self.log_path, 'wb')
+        self._log.write(self._header)
+
+    def open_part(self):
+        if self.conduit is None or self.skipped:
+            return
+        self._part = self.conduit.open(self.part_name(self._part_number))
+        if self._part is None:
+            self.skipped = True
+            print(f'{self.part_name(self._part_number)} not pushed, previous file not yet processed')
+            return
+        self._part.write(self._header)
+
+    def finish_part(self):
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+            self.conduit.commit(self.part_name(self._part_number))
+            self.pushed.append(self.part_name(self._part_number))
+            self.pushed_rows += self._part_rows
+        self._part_number += 1
+        self._part_rows = 0
+
+    def close(self):
+        """Publish the last Conduit file and close the log copy.
+        """
+        if self._part_rows:
+            self.finish_part()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def abort(self):
+        """Close without publishing the Conduit file being written.
+        """
+        if self._part is not None:
+            try:
+                self._part.close()
+            except CONNECTION_ERRORS:
+                pass
+            self._part = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+def put_conduit_file(data, fn):
+    """Push `data` (a DataFrame, str or bytes) as `fn` with the shared
+    Conduit session.
+    """
+    return ConduitSession.shared().put(data, fn)
+
+def transform_provision_df(obj, rename_map={}, action='create', **kwargs):
+    # read data
+    if isinstance(obj, str):
+        pc_df = pd.read_excel(path, dtype=object)
+    elif isinstance(obj, pd.DataFrame):
+        pc_df = obj.copy()
+
+    # Filter columns, rename columns, and drop empty rows
+    if rename_map:
+        pc_df = pc_df[list(rename_map.keys())].rename(columns=rename_map)
+    else: 
+         pc_df = pc_df[['idnumber']]
+
+    # Drop empty rows
+    pc_df.dropna(axis=0, how='all', inplace=True)
+
+    # Create columns with default values
+    pc_df['action'] = action
+    
+    # Add columns with default values
+    for kwarg in kwargs:
+        pc_df[kwarg] = kwargs[kwarg]
+
+    # modify column data
+    pc_df['idnumber'] = pc_df.idnumber.apply(lambda s: s.replace('P', '') if isinstance(s, str) else str(s))
+    
+    if 'email' in pc_df.columns:
+        pc_df['username'] = pc_df.email.copy()
+
     return pc_df[['action'] + list(rename_map.values()) + list(kwargs.keys())]
\ No newline at end of file
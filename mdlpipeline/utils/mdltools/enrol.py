@@ -0,0 +1,151 @@
+from .mdl_connect import (MdlWebServicesClient, STUDENT_ROLEID, AUDITING_ROLEID,
+                          CONCURRENCY)
+import pandas as pd
+from os import getenv
+
+# Enrolments sent per enrol_manual_enrol_users / enrol_manual_unenrol_users call
+ENROL_BATCH = int(getenv('MDL_ENROL_BATCH', 100))
+# idnumbers looked up per core_user_get_users_by_field call
+LOOKUP_BATCH = 100
+ROLEIDS = {'student': STUDENT_ROLEID, 'auditingstudent': AUDITING_ROLEID}
+WSFUNCTIONS = {'add': 'enrol_manual_enrol_users', 'drop': 'enrol_manual_unenrol_users'}
+
+
+class MoodleUserLookup(MdlWebServicesClient):
+    """Look up Moodle user ids by idnumber with
+    core_user_get_users_by_field, `batch_size` idnumbers per call.
+
+    Args:
+        idnumbers (list): list of student idnumbers
+        batch_size (int): idnumbers per call
+        **kwargs: client options passed to `MdlWebServicesClient`
+    """
+    def __init__(self, idnumbers, batch_size=LOOKUP_BATCH, **kwargs):
+        batches = [tuple(idnumbers[i:i + batch_size])
+                   for i in range(0, len(idnumbers), batch_size)]
+        super().__init__('core_user_get_users_by_field', 'values', batches, **kwargs)
+
+    def request_parameters(self, value, options=None):
+        parameters = super().request_parameters(list(value), options)
+        parameters['field'] = 'idnumber'
+        return parameters
+
+    async def get_userids(self):
+        """Returns:
+            dict: idnumber as key and Moodle user id as value, for every
+            idnumber found
+        """
+        responses = await self.fetch_all()
+        return {user['idnumber']: user['id']
+                for users in responses.values() for user in users}
+
+
+class WebCampusEnrolments(MdlWebServicesClient):
+    """Apply enrolments directly with enrol_manual_enrol_users or
+    enrol_manual_unenrol_users, `batch_size` enrolments per call.
+
+    A failed call is rolled back by Moodle as a whole, so the enrolments of
+    failed batches are retried one per call to tell the bad records from
+    the good ones.
+
+    Args:
+        action (str): "add" or "drop"
+        enrolments (list): list of (userid, courseid, roleid) tuples
+        batch_size (int): enrolments per call
+        **kwargs: client options passed to `MdlWebServicesClient`
+
+    Attributes:
+        errors (list): list of batches that recieved error on call
+        messages (dict): failed batch as key and error message as value
+    """
+    def __init__(self, action, enrolments, batch_size=ENROL_BATCH, **kwargs):
+        batches = [tuple(enrolments[i:i + batch_size])
+                   for i in range(0, len(enrolments), batch_size)]
+        super().__init__(WSFUNCTIONS[action], 'enrolments', batches, **kwargs)
+        self.action = action
+        self.messages = {}
+        self.client_kwargs = kwargs
+
+    def request_parameters(self, value, options=None):
+        enrolments = [{'roleid': roleid, 'userid': userid, 'courseid': courseid}
+                      for userid, courseid, roleid in value]
+        return super().request_parameters(enrolments, options)
+
+    def validate_response(self, response):
+        if isinstance(response, dict) and response.get('exception'):
+            raise ValueError(f"{response.get('exception')}: {response.get('message')}")
+
+    async def fetch(self, session, value):
+        try:
+            response_json = await self.request(session, value)
+            return {self.param_key: value, 'results': response_json}
+        except Exception as err:
+            self.errors.append(value)
+            self.messages[value] = str(err) or repr(err)
+            print(f"{self.wsfunction} failed for {len(value)} enrolments: {err!r}")
+
+    async def apply(self):
+        """Send all batches and retry the enrolments of failed batches one
+        at a time.
+
+        Returns:
+            dict: (userid, courseid, roleid) as key and None on success or
+            the error message as value
+        """
+        results = {}
+        for batch in await self.fetch_all():
+            results.update(dict.fromkeys(batch))
+        failed = [enrolment for batch in self.errors for enrolment in batch]
+        if len(failed) and len(self.errors) < len(failed):
+            single = WebCampusEnrolments(self.action, failed, batch_size=1, **self.client_kwargs)
+            results.update(await single.apply())
+        else:
+            for batch in self.errors:
+                results.update(dict.fromkeys(batch, self.messages[batch]))
+        return results
+
+
+async def apply_enrolments(df, courseids, userids=None, batch_size=ENROL_BATCH,
+                           concurrency=CONCURRENCY, **kwargs):
+    """Apply a Conduit add/drop DataFrame directly through Moodle Web
+    Services. Unknown Moodle user ids are looked up in batches, drops are
+    applied before adds so role changes end with the new role, and each
+    action is sent in batches of `batch_size` enrolments.
+
+    Args:
+        df (DataFrame): "action", "shortname", "idnumber" and "role" columns
+        courseids (dict): Moodle shortname as key and courseid as value
+        userids (dict): idnumber as key and Moodle user id as value, e.g.
+        collected by `WebCampusRosters`; updated with looked up ids
+        batch_size (int): enrolments per call
+        concurrency (int): maximum number of calls in flight
+        **kwargs: client options passed to `MdlWebServicesClient`
+
+    Returns:
+        pandas.DataFrame: `df` with a "status" column ("ok", "failed" or
+        "unknown user") and a "message" column of errors
+    """
+    userids = {} if userids is None else userids
+    missing = list(set(df.idnumber) - set(userids))
+    if missing:
+        userids.update(await MoodleUserLookup(missing, concurrency=concurrency,
+                                              **kwargs).get_userids())
+
+    results = df.copy()
+    results['status'] = 'unknown user'
+    results['message'] = None
+    for action in ('drop', 'add'):
+        rows = results[(results.action == action) & results.idnumber.isin(userids.keys())]
+        if rows.empty:
+            continue
+        enrolments = [(userids[idnumber], courseids[shortname], ROLEIDS[role])
+                      for shortname, idnumber, role
+                      in zip(rows.shortname, rows.idnumber, rows.role)]
+        client = WebCampusEnrolments(action, list(dict.fromkeys(enrolments)),
+                                     batch_size=batch_size, concurrency=concurrency, **kwargs)
+        outcome = await client.apply()
+        messages = [outcome.get(enrolment, 'not sent') for enrolment in enrolments]
+        results.loc[rows.index, 'message'] = messages
+        results.loc[rows.index, 'status'] = ['ok' if message is None else 'failed'
+                                             for message in messages]
+    return results
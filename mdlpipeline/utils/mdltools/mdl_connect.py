@@ -1,134 +1,490 @@
-from urllib.error import HTTPError
-from aiohttp import ClientSession
-import asyncio
-import json
-from os import getenv
-
-TOKEN = getenv('MDL_TOKEN')
-URL = "https://webcampus.uws.edu/"
-ENDPOINT = "webservice/rest/server.php"
-
-class MdlWebServicesClient():
-    """Make asynchronous API calls on Moodle Web Services REST API.
-    
-    Args:
-        wsfunction (str): name of Moodle Web Service function
-        param_key (str): name of required API argument
-        param_values (list): list of `param_key` values to call asyncronously
-
-     Attributes:
-        wsfunction (str): name of Moodle Web Service function
-        param_key (str): name of required API argument
-        param_values (list): list of `param_key` values to call asyncronously
-        errors (list): list of param_values that recieved error on call.
-    """
-    def __init__(self, wsfunction, param_key, param_values):
-        self.param_key = param_key
-        self.param_values = param_values
-        self.wsfunction = wsfunction
-        self.errors = []
-
-    def rest_api_parameters(self, in_args, prefix='', out_dict=None):
-        """Transform dictionary/array structure to a flat dictionary, with key names
-        defining the structure.
-
-        Example usage:
-        >>> rest_api_parameters({'courses':[{'id':1,'name': 'course1'}]})
-        {'courses[0][id]':1,
-         'courses[0][name]':'course1'}"""
-        if out_dict==None:
-            out_dict = {}
-        if not type(in_args) in (list, dict):
-            out_dict[prefix] = in_args
-            return out_dict
-        if prefix == '':
-            prefix = prefix + '{0}'
-        else:
-            prefix = prefix + '[{0}]'
-        if type(in_args)==list:
-            for idx, item in enumerate(in_args):
-                self.rest_api_parameters(item, prefix.format(idx), out_dict)
-        elif type(in_args)==dict:
-            for key, item in in_args.items():
-                self.rest_api_parameters(item, prefix.format(key), out_dict)
-        return out_dict
-
-    def validate_response(self, response):
-        if isinstance(response, dict):
-            if response.get('exception'):
-                raise ValueError(response.get('exception'))
-
-    async def fetch(self, session, value):
-        """Make single POST request to Moodle Web Services API
-        within asynchronous ClientSession.
-        """
-        parameters = self.rest_api_parameters({self.param_key: value})
-        parameters.update({"wstoken": TOKEN, 'moodlewsrestformat': 'json',
-                           "wsfunction": self.wsfunction})
-        try:
-            response = await session.post(url=URL+ENDPOINT, data=parameters)
-            response.raise_for_status()
-            response_json = await response.json()
-            self.validate_response(response_json)
-            return {self.param_key: value,
-                    'results': response_json}
-        except HTTPError as http_err:
-            self.errors.append(value)
-            print(f"HTTP error occurred: {http_err}")
-        except Exception as err:
-            self.errors.append(value)
-            print(f"An error ocurred: {err}")
-
-    async def fetch_all(self):
-        """Gather all asynchronously POST opperations in a ClientSession
-        on Moodle WebServices API.
-        """
-        async with ClientSession() as session:
-            tasks = [self.fetch(session, value)
-                     for value in self.param_values]
-
-            responses = await asyncio.gather(*tasks)
-
-        return {response[self.param_key]: response['results']
-                for response in responses if response}
-
-class WebCampusRosters(MdlWebServicesClient):
-	"""Class to make asyncronous calls to Moodle Web Service
-	API function core_enrol_get_enrolled_users.
-
-	Args:
-        wsfunction (str): name of Moodle Web Service function
-        param_key (str): name of required API argument
-        param_values (list): list of `param_key` values to call asyncronously
-
-     Attributes:
-        wsfunction (str): name of Moodle Web Service function
-        param_key (str): name of required API argument
-        param_values (list): list of `param_key` values to call asyncronously
-        errors (list): list of param_values that recieved error on call
-	"""
-    def __init__(self, param_values, param_key='courseid',
-    	         wsfunction='core_enrol_get_enrolled_users'):
-        super().__init__(wsfunction, param_key, param_values)
-
-    async def get_rosters(self):
-        """Wrapper to run get enrollment data from Moodle
-        WebServices API asynchronously.
-        """
-        responses = await self.fetch_all()
-        return {key: {'student': self.__flatten_roster(responses[key], roleid=5),
-                      'auditingstudent': self.__flatten_roster(responses[key], roleid=14)}
-                for key in responses}
-
-    def __flatten_roster(self, response, roleid=5):
-        """Helper function to return set of enrolled students from nested dictionary
-        """
-        return set(user.get('idnumber') for user in response
-                   if user.get('idnumber') and self.__has_role(user.get('roles'), roleid))
-
-    def __has_role(self, roles, roleid):
-        """Helper function to determin whether an enrolled user in a nested dictionary
-        has a role
-        """
-        return any(map(lambda role: True if role.get('roleid') == roleid
-                       else False, roles))
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp import ClientError, ClientResponseError
+from mdlpipeline.utils import metrics
+import asyncio
+import codecs
+import hashlib
+import json
+import random
+import re
+import time
+from os import getenv
+
+TOKEN = getenv('MDL_TOKEN')
+URL = "https://webcampus.uws.edu/"
+ENDPOINT = "webservice/rest/server.php"
+
+# Maximum number of requests in flight for a single `fetch_all`
+CONCURRENCY = int(getenv('MDL_CONCURRENCY', 16))
+# Maximum number of pooled keep-alive connections to webcampus
+LIMIT_PER_HOST = int(getenv('MDL_LIMIT_PER_HOST', 16))
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 120
+# Retry policy for transient errors (exponential backoff with full jitter)
+RETRIES = 4
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# Seconds a single `fetch_all` may spend, including retries
+TIME_BUDGET = float(getenv('MDL_TIME_BUDGET', 10 * 60))
+STUDENT_ROLEID = 5
+AUDITING_ROLEID = 14
+# Users requested per core_enrol_get_enrolled_users call, 0 for no paging
+PAGE_SIZE = int(getenv('MDL_PAGE_SIZE', 1000))
+# Bytes read from a response stream at a time
+CHUNK_SIZE = 64 * 1024
+# Text ending an item of a JSON array and the whitespace allowed before it
+DELIMITER = re.compile(r'[,\]]')
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+REQUEST_SECONDS = metrics.histogram('moodle_request_seconds',
+                                    'Latency of Moodle Web Services requests', ['wsfunction'])
+REQUEST_ERRORS = metrics.counter('moodle_request_errors_total',
+                                 'Failed Moodle Web Services requests by error',
+                                 ['wsfunction', 'error'])
+REQUEST_RETRIES = metrics.counter('moodle_request_retries_total',
+                                  'Retried Moodle Web Services requests', ['wsfunction'])
+
+
+def create_session(limit_per_host=LIMIT_PER_HOST,
+                   keepalive_timeout=KEEPALIVE_TIMEOUT,
+                   timeout=REQUEST_TIMEOUT):
+    """Create a ClientSession over a pooled keep-alive TCP connector.
+
+    The session should be created from within a running event loop and
+    may be shared by any number of `MdlWebServicesClient` instances, e.g.
+    kept open by the sync daemon across cycles.
+
+    Args:
+        limit_per_host (int): maximum number of open connections to Moodle
+        keepalive_timeout (int): seconds to keep idle connections open
+        timeout (int): total seconds allowed for a single request
+
+    Returns:
+        aiohttp.ClientSession: session to be closed by the caller
+    """
+    connector = TCPConnector(limit=limit_per_host,
+                             limit_per_host=limit_per_host,
+                             keepalive_timeout=keepalive_timeout)
+    return ClientSession(connector=connector,
+                         timeout=ClientTimeout(total=timeout))
+
+
+def roster_signature(userids):
+    """Signature of the set of Moodle user ids enrolled in a course.
+    """
+    ids = sorted(userids)
+    digest = hashlib.sha1(','.join(map(str, ids)).encode()).hexdigest()
+    return f'{len(ids)}:{digest}'
+
+
+async def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """Incrementally decode the items of a top-level JSON array from an
+    aiohttp `StreamReader`, holding at most one chunk and one item in
+    memory. A top-level value which is not an array (e.g. a Moodle
+    exception) is yielded whole.
+
+    An item is only decoded once the text after it holds the `,` or `]`
+    ending it, so numbers and literals split across chunks are not cut
+    short, and only when a chunk brings such a delimiter.
+
+    Raises:
+        json.JSONDecodeError: if the body is empty, the array is not
+        closed, e.g. a truncated response, or other text follows an item
+        or the array, e.g. a PHP notice
+
+    Example:
+        >>> async for user in iter_json_array(response.content):
+        ...     print(user['id'])
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    # start of the next item and end of the text searched for its end
+    pos = scanned = 0
+    in_array = None
+    closed = False
+    async for chunk in stream.iter_chunked(chunk_size):
+        if in_array and pos > len(buffer) // 2:
+            # drop decoded items once they are most of the buffer, which
+            # keeps appending chunks linear
+            buffer, scanned, pos = buffer[pos:], scanned - pos, 0
+        buffer += utf8.decode(chunk)
+        if in_array is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                continue
+            in_array = stripped[0] == '['
+            pos = scanned = len(buffer) - len(stripped) + in_array
+        if not in_array or closed:
+            continue
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                closed = True
+                pos += 1
+                break
+            if not DELIMITER.search(buffer, max(pos, scanned)):
+                scanned = len(buffer)
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                end = WHITESPACE.match(buffer, end).end()
+            except json.JSONDecodeError:
+                end = len(buffer)
+            if end == len(buffer):
+                # incomplete, the delimiter found was inside the item
+                scanned = len(buffer)
+                break
+            if buffer[end] not in ',]':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, end)
+            yield item
+            pos = scanned = end
+    buffer += utf8.decode(b'', final=True)
+    if in_array is None:
+        raise json.JSONDecodeError('Expecting value', buffer, len(buffer))
+    if in_array is False:
+        yield json.loads(buffer)
+    elif not closed:
+        # a truncated body or an item that never decodes
+        raise json.JSONDecodeError("Expecting ',' delimiter or ']'", buffer, pos)
+    elif WHITESPACE.match(buffer, pos).end() != len(buffer):
+        raise json.JSONDecodeError('Extra data', buffer, pos)
+
+
+class MdlWebServicesClient():
+    """Make asynchronous API calls on Moodle Web Services REST API.
+
+    Args:
+        wsfunction (str): name of Moodle Web Service function
+        param_key (str): name of required API argument
+        param_values (list): list of `param_key` values to call asyncronously
+        session (aiohttp.ClientSession): optional long-lived session to
+        reuse. A temporary session is opened per `fetch_all` otherwise.
+        concurrency (int): maximum number of requests in flight
+        retries (int): maximum number of retries for transient errors
+        backoff (float): base delay in seconds of the exponential backoff
+        time_budget (float): seconds `fetch_all` may spend before giving
+        up on outstanding requests, None for no limit.
+        options (list): optional list of {"name", "value"} dictionaries
+        sent as the `options` argument of `wsfunction`.
+
+     Attributes:
+        wsfunction (str): name of Moodle Web Service function
+        param_key (str): name of required API argument
+        param_values (list): list of `param_key` values to call asyncronously
+        errors (list): list of param_values that recieved error on call.
+    """
+    def __init__(self, wsfunction, param_key, param_values, session=None,
+                 concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF,
+                 time_budget=TIME_BUDGET, options=None):
+        self.param_key = param_key
+        self.param_values = param_values
+        self.wsfunction = wsfunction
+        self.session = session
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.time_budget = time_budget
+        self.options = options
+        self.errors = []
+        self._semaphore = None
+        self._deadline = None
+
+    def rest_api_parameters(self, in_args, prefix='', out_dict=None):
+        """Transform dictionary/array structure to a flat dictionary, with key names
+        defining the structure.
+
+        Example usage:
+        >>> rest_api_parameters({'courses':[{'id':1,'name': 'course1'}]})
+        {'courses[0][id]':1,
+         'courses[0][name]':'course1'}"""
+        if out_dict==None:
+            out_dict = {}
+        if not type(in_args) in (list, dict):
+            out_dict[prefix] = in_args
+            return out_dict
+        if prefix == '':
+            prefix = prefix + '{0}'
+        else:
+            prefix = prefix + '[{0}]'
+        if type(in_args)==list:
+            for idx, item in enumerate(in_args):
+                self.rest_api_parameters(item, prefix.format(idx), out_dict)
+        elif type(in_args)==dict:
+            for key, item in in_args.items():
+                self.rest_api_parameters(item, prefix.format(key), out_dict)
+        return out_dict
+
+    def validate_response(self, response):
+        if isinstance(response, dict):
+            if response.get('exception'):
+                raise ValueError(response.get('exception'))
+
+    def is_transient(self, err):
+        """Whether a failed request is worth retrying.
+        """
+        if isinstance(err, ClientResponseError):
+            return err.status in RETRY_STATUSES
+        return isinstance(err, (ClientError, asyncio.TimeoutError))
+
+    def error_kind(self, err):
+        """Short label of a failed request: the HTTP status or the
+        exception class.
+        """
+        if isinstance(err, ClientResponseError):
+            return str(err.status)
+        return type(err).__name__
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff with full jitter for retry `attempt`.
+        """
+        return random.uniform(0, min(BACKOFF_MAX, self.backoff * 2 ** attempt))
+
+    async def parse_response(self, response):
+        """Decode the body of a successful response.
+        """
+        return await response.json()
+
+    async def post(self, session, parameters, parse=None):
+        """POST `parameters` to the Moodle Web Services endpoint, retrying
+        transient errors with backoff until the retries or the time budget
+        of the current `fetch_all` run out. The response is decoded by
+        `parse` if given, `parse_response` otherwise.
+        """
+        parse = parse or self.parse_response
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                # checked once a slot is free, requests may queue for long
+                if self._deadline and time.monotonic() > self._deadline:
+                    raise asyncio.TimeoutError('time budget exhausted')
+                try:
+                    with REQUEST_SECONDS.time(wsfunction=self.wsfunction):
+                        async with session.post(url=URL+ENDPOINT, data=parameters) as response:
+                            response.raise_for_status()
+                            return await parse(response)
+                except Exception as err:
+                    error = err
+            # backoff happens outside the semaphore so it does not hold a slot
+            REQUEST_ERRORS.inc(wsfunction=self.wsfunction, error=self.error_kind(error))
+            if attempt >= self.retries or not self.is_transient(error):
+                raise error
+            delay = self.backoff_delay(attempt)
+            if self._deadline and time.monotonic() + delay > self._deadline:
+                raise error
+            attempt += 1
+            REQUEST_RETRIES.inc(wsfunction=self.wsfunction)
+            await asyncio.sleep(delay)
+
+    def request_parameters(self, value, options=None):
+        """Flattened POST parameters calling `wsfunction` on `value`.
+        """
+        args = {self.param_key: value}
+        options = self.options if options is None else options
+        if options:
+            args['options'] = options
+        parameters = self.rest_api_parameters(args)
+        parameters.update({"wstoken": TOKEN, 'moodlewsrestformat': 'json',
+                           "wsfunction": self.wsfunction})
+        return parameters
+
+    async def request(self, session, value):
+        """Call `wsfunction` on a single `value` and return the
+        validated results.
+        """
+        response_json = await self.post(session, self.request_parameters(value))
+        self.validate_response(response_json)
+        return response_json
+
+    async def fetch(self, session, value):
+        """Make single POST request to Moodle Web Services API
+        within asynchronous ClientSession.
+        """
+        try:
+            response_json = await self.request(session, value)
+            return {self.param_key: value,
+                    'results': response_json}
+        except ClientResponseError as http_err:
+            self.errors.append(value)
+            print(f"HTTP error occurred: {http_err}")
+            metrics.log_event('moodle_request_failed', wsfunction=self.wsfunction,
+                              value=value, error=str(http_err))
+        except Exception as err:
+            self.errors.append(value)
+            print(f"An error ocurred: {err!r}")
+            metrics.log_event('moodle_request_failed', wsfunction=self.wsfunction,
+                              value=value, error=repr(err))
+
+    async def fetch_all(self):
+        """Gather all asynchronously POST opperations in a ClientSession
+        on Moodle WebServices API, at most `concurrency` at a time.
+        """
+        self.errors = []
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._deadline = (time.monotonic() + self.time_budget
+                          if self.time_budget else None)
+        if self.session is not None:
+            responses = await self.gather(self.session)
+        else:
+            async with create_session() as session:
+                responses = await self.gather(session)
+
+        return {response[self.param_key]: response['results']
+                for response in responses if response}
+
+    async def gather(self, session):
+        tasks = [self.fetch(session, value)
+                 for value in self.param_values]
+        return await asyncio.gather(*tasks)
+
+class RosterProbe(MdlWebServicesClient):
+    """Cheap change probe for core_enrol_get_enrolled_users which only
+    requests the Moodle user ids of each course and reduces them to a
+    `roster_signature`.
+
+    Args:
+        param_values (list): list of Moodle courseids to probe
+        **kwargs: client options passed to `MdlWebServicesClient`
+    """
+    def __init__(self, param_values, **kwargs):
+        super().__init__('core_enrol_get_enrolled_users', 'courseid', param_values,
+                         options=[{'name': 'userfields', 'value': 'id'}], **kwargs)
+
+    async def parse_response(self, response):
+        users = await response.json()
+        self.validate_response(users)
+        return roster_signature(user['id'] for user in users)
+
+class WebCampusRosters(MdlWebServicesClient):
+    """Class to make asyncronous calls to Moodle Web Service
+    API function core_enrol_get_enrolled_users.
+
+    Only the `idnumber` and `roles` user fields are requested, in pages of
+    `page_size` users, and each response is parsed incrementally from the
+    stream straight into sets of student and auditingstudent idnumbers.
+
+    When a `RosterSnapshot` is given, every course is first probed with a
+    `RosterProbe` and only courses whose enrolled users changed (or whose
+    snapshot entry is stale or missing) are fetched in full. Unchanged
+    courses are served from the snapshot.
+
+    Args:
+        param_values (list): list of `param_key` values to call asyncronously
+        param_key (str): name of required API argument
+        wsfunction (str): name of Moodle Web Service function
+        snapshot (RosterSnapshot): optional store of previously fetched rosters
+        page_size (int): users requested per call, 0 to disable paging
+        **kwargs: client options passed to `MdlWebServicesClient`
+
+     Attributes:
+        wsfunction (str): name of Moodle Web Service function
+        param_key (str): name of required API argument
+        param_values (list): list of `param_key` values to call asyncronously
+        errors (list): list of param_values that recieved error on call
+        fetched (list): list of param_values fetched in full on last call
+        userids (dict): idnumber as key and Moodle user id as value of
+        every user fetched in full
+    """
+    roleids = {STUDENT_ROLEID: 'student', AUDITING_ROLEID: 'auditingstudent'}
+
+    def __init__(self, param_values, param_key='courseid',
+                 wsfunction='core_enrol_get_enrolled_users', snapshot=None,
+                 page_size=PAGE_SIZE, **kwargs):
+        super().__init__(wsfunction, param_key, param_values,
+                         options=[{'name': 'userfields', 'value': 'idnumber,roles'}],
+                         **kwargs)
+        self.snapshot = snapshot
+        self.page_size = page_size
+        self.fetched = []
+        self.userids = {}
+        self.client_kwargs = kwargs
+
+    async def get_rosters(self):
+        """Wrapper to run get enrollment data from Moodle
+        WebServices API asynchronously.
+        """
+        if self.snapshot is None:
+            self.fetched = list(self.param_values)
+            responses = await self.fetch_all()
+            return {key: self.__roles(responses[key]) for key in responses}
+
+        if self.session is not None:
+            return await self.get_changed_rosters()
+        async with create_session() as session:
+            self.session = session
+            try:
+                return await self.get_changed_rosters()
+            finally:
+                self.session = None
+
+    async def get_changed_rosters(self):
+        """Probe all courses and fetch in full only the ones that changed
+        since they were stored in `snapshot`.
+        """
+        kwargs = dict(self.client_kwargs, session=self.session)
+        signatures = await RosterProbe(self.param_values, **kwargs).fetch_all()
+        all_values = self.param_values
+        self.fetched = [value for value in all_values
+                        if not self.snapshot.is_current(value, signatures.get(value))]
+        self.param_values = self.fetched
+        try:
+            responses = await self.fetch_all()
+        finally:
+            self.param_values = all_values
+
+        for key, roster in responses.items():
+            self.snapshot.update(key, self.__roles(roster),
+                                 roster_signature(roster['userids']))
+        self.snapshot.save()
+        print(f'{len(self.fetched)} of {len(all_values)} rosters changed')
+        return {key: self.snapshot.get(key) for key in all_values
+                if key not in self.errors and key in self.snapshot.entries}
+
+    async def request(self, session, value):
+        """Fetch the roster of course `value` page by page.
+
+        Returns:
+            dict: "student" and "auditingstudent" sets of idnumbers and
+            "userids" set of all enrolled Moodle user ids.
+        """
+        roster = {'student': set(), 'auditingstudent': set(), 'userids': set()}
+        parse = lambda response: self.parse_roster(response, roster)
+        limitfrom = 0
+        while True:
+            options = self.options
+            if self.page_size:
+                options = options + [{'name': 'limitfrom', 'value': limitfrom},
+                                     {'name': 'limitnumber', 'value': self.page_size}]
+            count = await self.post(session, self.request_parameters(value, options), parse)
+            if not self.page_size or count < self.page_size:
+                return roster
+            limitfrom += self.page_size
+
+    async def parse_roster(self, response, roster):
+        """Stream enrolled users from `response` into `roster` and
+        return the number of users on the page.
+        """
+        count = 0
+        async for user in iter_json_array(response.content):
+            self.validate_response(user)
+            count += 1
+            roster['userids'].add(user.get('id'))
+            idnumber = user.get('idnumber')
+            if not idnumber:
+                continue
+            self.userids[idnumber] = user.get('id')
+            for role in user.get('roles') or ():
+                role_name = self.roleids.get(role.get('roleid'))
+                if role_name:
+                    roster[role_name].add(idnumber)
+        return count
+
+    def __roles(self, roster):
+        """Helper function to drop the user ids of a fetched roster
+        """
+        return {'student': roster['student'],
+                'auditingstudent': roster['auditingstudent']}
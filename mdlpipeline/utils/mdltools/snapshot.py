@@ -0,0 +1,90 @@
+import json
+import os
+import time
+
+SNAPSHOT_PATH = 'cache/wc_roster_snapshot.json'
+# Seconds before a course is fully re-fetched even if its probe is unchanged
+MAX_AGE = 6 * 60 * 60
+ROLES = ('student', 'auditingstudent')
+
+
+class RosterSnapshot():
+    """Persisted store of the last Moodle roster fetched for every course,
+    used by `WebCampusRosters` to skip full downloads of unchanged courses.
+
+    Each entry holds the roster, the signature of the enrolled user ids it
+    was fetched with, and the time it was fetched. A course is re-fetched in
+    full when its probed signature differs, when the entry is older than
+    `max_age`, or after it has been invalidated.
+
+    Args:
+        path (str): location of the JSON snapshot file
+        max_age (float): seconds an entry may be reused without a full fetch
+
+    Attributes:
+        path (str): location of the JSON snapshot file
+        max_age (float): seconds an entry may be reused without a full fetch
+        entries (dict): courseid as key and dictionary with "signature",
+        "fetched" and role keys as values.
+    """
+    def __init__(self, path=SNAPSHOT_PATH, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """Load snapshot entries from `path` if it exists.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            entries = json.load(f)
+        self.entries = {int(courseid): entry for courseid, entry in entries.items()}
+
+    def save(self):
+        """Atomically write snapshot entries to `path`.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({str(courseid): entry for courseid, entry in self.entries.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, courseid, signature):
+        """Whether the stored roster of `courseid` can be reused.
+
+        Args:
+            courseid (int): Moodle courseid
+            signature (str): signature returned by the latest probe, None
+            if the probe failed
+
+        Returns:
+            bool: True if the entry matches `signature` and is not stale
+        """
+        entry = self.entries.get(courseid)
+        if entry is None or signature is None:
+            return False
+        return (entry['signature'] == signature
+                and time.time() - entry['fetched'] < self.max_age)
+
+    def get(self, courseid):
+        """Return stored roster of `courseid` in `wc_rosters` format.
+        """
+        entry = self.entries[courseid]
+        return {role: set(entry[role]) for role in ROLES}
+
+    def update(self, courseid, roster, signature):
+        """Store freshly fetched `roster` of `courseid`.
+        """
+        entry = {role: sorted(roster.get(role, ())) for role in ROLES}
+        entry.update({'signature': signature, 'fetched': time.time()})
+        self.entries[courseid] = entry
+
+    def invalidate(self, courseids):
+        """Force a full fetch of `courseids` on the next pull.
+        """
+        for courseid in courseids:
+            self.entries.pop(courseid, None)
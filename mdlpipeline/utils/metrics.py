@@ -0,0 +1,212 @@
+from aiohttp import web
+from contextlib import contextmanager
+from os import getenv
+import json
+import logging
+import os
+import threading
+import time
+
+# Prometheus textfile rewritten after every sync cycle, e.g. for the
+# node_exporter textfile collector
+TEXTFILE = getenv('METRICS_TEXTFILE')
+# Port of the HTTP /metrics endpoint served by the sync daemon
+PORT = int(getenv('METRICS_PORT', 0))
+# Upper bounds in seconds of histogram buckets, from one request to a cycle
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900)
+
+logger = logging.getLogger('mdlpipeline')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric():
+    """Metric with a value per combination of label values, safe to
+    update from several threads.
+
+    Args:
+        name (str): metric name
+        help (str): description shown in the exposition
+        labels (list): label names
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        if not self.labels and self.type != 'histogram':
+            # unlabeled counters and gauges are exported from the start
+            self.values[()] = 0
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels))
+
+    def samples(self):
+        """Returns:
+            list: list of (suffix, label pairs, value) tuples
+        """
+        return [('', format_labels(self.labels, key), value)
+                for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            samples = self.samples()
+        lines += [f'{self.name}{suffix}{labels} {value:g}' for suffix, labels, value in samples]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Histogram of observations in cumulative `buckets`, with their sum
+    and count.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the block, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        for key, counts in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                samples.append(('_bucket', format_labels(self.labels, key, [('le', bound)]),
+                                count))
+            samples.append(('_sum', format_labels(self.labels, key), counts[-1]))
+            samples.append(('_count', format_labels(self.labels, key), counts[-2]))
+        return samples
+
+
+class Registry():
+    """Collection of metrics rendered in the Prometheus text format.
+
+    Metrics are created once, typically at module level, and returned
+    again when a module asks for the same name.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, cls, name, help, labels=(), **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError(f'{name} is already registered as another metric')
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """Returns:
+            str: all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+    def write_textfile(self, path):
+        """Atomically write `render` to `path`.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    async def serve(self, port, host='0.0.0.0'):
+        """Serve `render` at http://host:port/metrics from the running
+        event loop.
+
+        Returns:
+            aiohttp.web.AppRunner: runner to clean up on shutdown
+        """
+        async def handle(request):
+            return web.Response(text=self.render(),
+                                content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def log_event(event, **fields):
+    """Log `event` with `fields` as one JSON line on the "mdlpipeline"
+    logger, e.g. for shipping to a log aggregator.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({'time': time.time(), 'event': event, **fields}, default=str))
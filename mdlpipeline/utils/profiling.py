@@ -0,0 +1,272 @@
+from collections import Counter
+from datetime import datetime
+from os import getenv
+import asyncio
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+# Directory profiles are written to, one subdirectory per profiled run
+PROFILE_DIR = getenv('SYNC_PROFILE_DIR', 'log/profiles')
+# Number of daemon cycles to profile from startup
+PROFILE_CYCLES = int(getenv('SYNC_PROFILE', 0))
+# File whose creation makes the running daemon profile its next cycle
+PROFILE_TRIGGER = getenv('SYNC_PROFILE_TRIGGER', 'cache/profile_next_cycle')
+# Seconds between wall-clock samples of every thread and task
+SAMPLE_INTERVAL = float(getenv('SYNC_PROFILE_INTERVAL', 0.005))
+# Seconds between event loop lag probes
+LAG_INTERVAL = 0.05
+# Frames kept per traced allocation
+TRACE_FRAMES = 10
+# Lines kept in the text reports
+TOP = 40
+
+_active = None
+
+
+def active():
+    """Returns:
+        Profiler: the running profiler, None when not profiling
+    """
+    return _active
+
+
+def mark(stage):
+    """Take an allocation snapshot of the finished `stage` when profiling.
+    """
+    profiler = _active
+    if profiler is not None:
+        profiler.mark(stage)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{getattr(code, "co_qualname", code.co_name)}'
+
+
+def frame_stack(frame):
+    """Names of `frame` and its callers, outermost first.
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return names[::-1]
+
+
+def task_stack(task):
+    """Names of the coroutines `task` is suspended in, outermost first,
+    ending with what the innermost one awaits.
+    """
+    names = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            if not hasattr(coro, 'cr_frame') and not hasattr(coro, 'gi_frame'):
+                # a future or another awaitable without frames
+                names.append(type(coro).__name__)
+            break
+        names.append(frame_name(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return names
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Profiler():
+    """Profile the block it wraps: cProfile of the calling thread,
+    wall-clock samples of every thread and asyncio task, tracemalloc
+    snapshots at the end of every stage passed to `mark`, and event loop
+    lag when used with `async with`.
+
+    Results are written on exit to a new directory under `directory`:
+    cprofile.pstats and cprofile.txt, wall.folded and tasks.folded in the
+    collapsed stack format of flame graph tools, tracemalloc-NN-stage.snap
+    and .txt with the top allocations and their growth since the previous
+    stage, loop_lag.json and a summary.json of the run.
+
+    Args:
+        label (str): name of the profiled run, appended to the directory
+        directory (str): parent directory of the profiles
+        interval (float): seconds between wall-clock samples
+        lag_interval (float): seconds between event loop lag probes
+
+    Attributes:
+        path (str): directory the profile is written to
+
+    Example:
+        >>> async with Profiler('pull'):
+        ...     se = await SyncEnrollments.pull(mapping)
+    """
+    def __init__(self, label='run', directory=PROFILE_DIR, interval=SAMPLE_INTERVAL,
+                 lag_interval=LAG_INTERVAL):
+        self.label = label
+        self.path = os.path.join(directory, f'{datetime.now():%Y%m%d-%H%M%S}-{label}')
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self.wall = Counter()
+        self.tasks = Counter()
+        self.samples = 0
+        self.lags = []
+        self.snapshots = []
+        self._loop = None
+        self._lag_task = None
+
+    def start(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError(f'already profiling {_active.label}')
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        self._start = time.perf_counter()
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+        _active = self
+
+    def stop(self):
+        global _active
+        self.cprofile.disable()
+        self.duration = time.perf_counter() - self._start
+        self._stop.set()
+        self._sampler.join()
+        self.mark('end')
+        if self._tracing:
+            tracemalloc.stop()
+        _active = None
+        self.write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def __aenter__(self):
+        self.start()
+        self._lag_task = asyncio.ensure_future(self._probe_lag())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._lag_task.cancel()
+        try:
+            await self._lag_task
+        except asyncio.CancelledError:
+            pass
+        self.stop()
+
+    def mark(self, stage):
+        """Snapshot allocations at the end of `stage`.
+        """
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        current, peak = tracemalloc.get_traced_memory()
+        self.snapshots.append((stage, time.perf_counter() - self._start, current, peak, snapshot))
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                # pool threads are numbered differently from run to run
+                names[thread.ident] = re.sub(r'[-_]?\d+', '', thread.name)
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = [names.get(ident, str(ident))] + frame_stack(frame)
+                self.wall[';'.join(stack)] += 1
+            if self._loop is not None:
+                try:
+                    tasks = list(asyncio.all_tasks(self._loop))
+                except RuntimeError:
+                    # the loop changed its tasks while they were listed
+                    tasks = []
+                for task in tasks:
+                    if task is self._lag_task:
+                        continue
+                    stack = task_stack(task)
+                    if stack:
+                        self.tasks[';'.join(stack)] += 1
+            self.samples += 1
+
+    async def _probe_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(max(0.0, loop.time() - start - self.lag_interval))
+
+    def lag_stats(self):
+        return {
+            'probes': len(self.lags),
+            'mean': sum(self.lags) / len(self.lags) if self.lags else 0.0,
+            'p50': percentile(self.lags, 0.5),
+            'p99': percentile(self.lags, 0.99),
+            'max': max(self.lags, default=0.0),
+        }
+
+    def write(self):
+        """Write the collected profiles to `path`.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        stats = pstats.Stats(self.cprofile)
+        stats.dump_stats(os.path.join(self.path, 'cprofile.pstats'))
+        stream = io.StringIO()
+        pstats.Stats(self.cprofile, stream=stream).sort_stats('cumulative').print_stats(TOP)
+        self.write_text('cprofile.txt', stream.getvalue())
+
+        for name, counts in (('wall.folded', self.wall), ('tasks.folded', self.tasks)):
+            self.write_text(name, ''.join(f'{stack} {count}\n'
+                                          for stack, count in sorted(counts.items())))
+
+        previous = None
+        stages = []
+        for i, (stage, elapsed, current, peak, snapshot) in enumerate(self.snapshots):
+            name = f'tracemalloc-{i:02d}-{stage}'
+            snapshot.dump(os.path.join(self.path, name + '.snap'))
+            lines = [f'{stage}: {current / 2 ** 20:.1f} MiB traced, {peak / 2 ** 20:.1f} MiB peak',
+                     '', 'Top allocations:']
+            lines += [str(stat) for stat in snapshot.statistics('lineno')[:TOP]]
+            if previous is not None:
+                lines += ['', 'Growth since the previous stage:']
+                lines += [str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:TOP]]
+            self.write_text(name + '.txt', '\n'.join(lines) + '\n')
+            previous = snapshot
+            stages.append({'stage': stage, 'elapsed': elapsed,
+                           'traced_mb': current / 2 ** 20, 'peak_mb': peak / 2 ** 20})
+
+        with open(os.path.join(self.path, 'loop_lag.json'), 'w') as f:
+            json.dump({**self.lag_stats(), 'interval': self.lag_interval,
+                       'lags': self.lags}, f)
+        with open(os.path.join(self.path, 'summary.json'), 'w') as f:
+            json.dump({'label': self.label, 'started': self._started, 'seconds': self.duration,
+                       'samples': self.samples, 'sample_interval': self.interval,
+                       'stages': stages, 'loop_lag': self.lag_stats()}, f, indent=2)
+
+    def write_text(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
@@ -1,7 +1,8 @@
-from . import pc_connect
-from . import queries
-from . import query_tools
-
-name = "sql_tools"
-
-__all__ = ["pc_connect", "queries", "query_tools"]
\ No newline at end of file
+from . import pc_connect
+from . import queries
+from . import query_tools
+from . import query_cache
+
+name = "sql_tools"
+
+__all__ = ["pc_connect", "queries", "query_tools", "query_cache"]
\ No newline at end of file
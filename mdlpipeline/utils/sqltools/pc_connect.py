@@ -1,17 +1,97 @@
 import pymssql
 import pandas as pd
+from .query_tools import Query
+from .query_cache import default_cache
+from mdlpipeline.utils import metrics
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from os import getenv
 
+# Maximum number of open connections per PcConnect
+POOL_SIZE = int(getenv('MS_POOL_SIZE', 4))
+# Seconds to wait for a free pooled connection
+POOL_TIMEOUT = 5 * 60
+# Seconds a connection may sit idle before it is health checked on reuse
+HEALTH_CHECK_AFTER = 60
+# Rows fetched per round trip when streaming results
+BATCH_SIZE = 10000
+# Rows per INSERT statement when loading temporary tables (SQL Server max)
+INSERT_BATCH = 1000
+
+QUERY_SECONDS = metrics.histogram('pc_query_seconds',
+                                  'Duration of PowerCampus queries including fetching', ['query'])
+QUERY_ROWS = metrics.counter('pc_query_rows_total', 'Rows fetched from PowerCampus', ['query'])
+
+
+def query_name(query):
+    return getattr(query, 'name', None) or 'sql'
+
 
 class PcConnect:
     """Database handler class for runninf quiries on
     PowerCampus databases.
+
+    Connections are kept in a bounded pool and reused across queries.
+    Idle connections are health checked before reuse and replaced if they
+    were dropped by the server. Use `PcConnect.shared` to get one pool per
+    environment for the life of the process, and `close` (or the context
+    manager protocol) to release the connections.
+
+    Results of queries declared with `query_tools.cache_ttl` are served
+    from `query_cache`, the process-wide `query_cache.default_cache` when
+    `PC_QUERY_CACHE_MB` is set, and otherwise always run on the database.
+
+    Args:
+        environment (str): "prod" or "test"
+        user (str): database user, defaults to `MS_USER`
+        password (str): database password, defaults to `MS_PW`
+        pool_size (int): maximum number of open connections
+        query_cache (QueryCache): cache of query results, None for the
+        default cache
     """
-    def __init__(self, environment, user='', password=''):
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, environment, user='', password='', pool_size=POOL_SIZE,
+                 query_cache=None):
         self.user = user or getenv('MS_USER')
         self.password = password or getenv('MS_PW')
         self.db_name = self.get_db_name(environment)
         self.db_host = self.get_db_host(environment)
+        self.pool_size = pool_size
+        self.query_cache = query_cache or default_cache()
+        self._pool = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def shared(cls, environment, **kwargs):
+        """Return the process-wide pooled handler for `environment`,
+        creating it on first use.
+        """
+        with cls._shared_lock:
+            db_h = cls._shared.get(environment)
+            if db_h is None or db_h._closed:
+                db_h = cls._shared[environment] = cls(environment, **kwargs)
+            return db_h
+
+    @classmethod
+    def close_shared(cls):
+        """Close all process-wide pooled handlers.
+        """
+        with cls._shared_lock:
+            for db_h in cls._shared.values():
+                db_h.close()
+            cls._shared.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def get_db_name(self, environment):
         return {
@@ -29,43 +109,182 @@ class PcConnect:
         }.get(environment)
 
 
+    def cache_scope(self):
+        """Identity of the database in query cache keys.
+        """
+        return f'{self.db_host}/{self.db_name}'
+
     def get_connection(self):
-        host = self.db_host
+        """Open a new connection to the database.
+        """
         try:
-            conn = pymssql.connect(
+            return pymssql.connect(
                 server=self.db_host,
                 database=self.db_name,
                 user=self.user,
                 password=self.password)
+        except pymssql.Error as err:
+            print(f"Unable to connect to the database: {err}")
+            raise
+
+    def is_healthy(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchall()
+            return True
+        except pymssql.Error:
+            return False
 
-        except EnvironmentError:
-            print(f"Unable to connect to the database: {EnvironmentError}")
-        return conn
+    def acquire(self):
+        """Borrow a healthy connection from the pool, opening a new one
+        while fewer than `pool_size` are open.
+        """
+        if self._closed:
+            raise RuntimeError('PcConnect pool is closed')
+        while True:
+            try:
+                conn, last_used = self._pool.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    create = self._opened < self.pool_size
+                    if create:
+                        self._opened += 1
+                if create:
+                    try:
+                        return self.get_connection()
+                    except Exception:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                try:
+                    conn, last_used = self._pool.get(timeout=POOL_TIMEOUT)
+                except queue.Empty:
+                    raise TimeoutError('Timed out waiting for a database connection')
+            if time.monotonic() - last_used < HEALTH_CHECK_AFTER or self.is_healthy(conn):
+                return conn
+            self.discard(conn)
 
+    def release(self, conn):
+        """Return a borrowed connection to the pool.
+        """
+        if self._closed:
+            self.discard(conn)
+        else:
+            self._pool.put((conn, time.monotonic()))
+
+    def discard(self, conn):
+        """Close a connection and free its slot in the pool.
+        """
+        try:
+            conn.close()
+        except pymssql.Error:
+            pass
+        with self._lock:
+            self._opened -= 1
+
+    def close(self):
+        """Close all idle connections; borrowed connections are closed
+        when they are released.
+        """
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager borrowing a pooled connection. The connection
+        is rolled back before it returns to the pool, ending the
+        transaction pymssql implicitly opened along with its temporary
+        tables, and discarded if it is no longer usable.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            # also reached when a streaming generator is closed early
+            try:
+                conn.rollback()
+            except pymssql.Error:
+                self.discard(conn)
+            else:
+                self.release(conn)
+
+    @contextmanager
     def connect_to_db(self):
-        connection = self.get_connection()
-        cur = connection.cursor()
-        return cur
+        with self.connection() as connection:
+            with connection.cursor() as cur:
+                yield cur
 
-    def get_records(self, query):
+    @contextmanager
+    def query_cursor(self, query):
+        """Context manager running `query` on a pooled connection and
+        yielding the cursor holding its results. The temporary tables of
+        the query are dropped once the results have been read.
+        """
         with self.connect_to_db() as cursor:
+            self.execute(cursor, query)
+            yield cursor
+            for table in getattr(query, 'tables', ()):
+                self.drop_table(cursor, table.name)
+
+    def execute(self, cursor, query):
+        """Execute a query string or a `Query`, loading its temporary
+        tables first and passing its parameters through `sp_executesql`.
+        """
+        if not isinstance(query, Query):
             cursor.execute(query)
+            return
+        for table in query.tables:
+            self.load_table(cursor, table)
+        if not query.params:
+            cursor.execute(query.sql)
+            return
+        declarations = ', '.join(f'@{name} {sql_type}' for name, sql_type, _ in query.params)
+        assignments = ', '.join(f'@{name}=%s' for name, _, _ in query.params)
+        cursor.execute(f'EXEC sp_executesql %s, %s, {assignments}',
+                       (query.sql, declarations, *(value for _, _, value in query.params)))
+
+    def load_table(self, cursor, table):
+        """(Re)create temporary `table` and insert its rows in batches.
+        """
+        self.drop_table(cursor, table.name)
+        columns = ', '.join(f'{name} {sql_type}' for name, sql_type in table.columns)
+        cursor.execute(f'CREATE TABLE {table.name} ({columns})')
+        row_sql = '(' + ', '.join(['%s'] * len(table.columns)) + ')'
+        for i in range(0, len(table.rows), INSERT_BATCH):
+            batch = table.rows[i:i + INSERT_BATCH]
+            cursor.execute(f'INSERT INTO {table.name} VALUES ' + ', '.join([row_sql] * len(batch)),
+                           tuple(value for row in batch for value in row))
+
+    def drop_table(self, cursor, name):
+        """Drop temporary table `name` if it exists.
+        """
+        cursor.execute(f"IF OBJECT_ID('tempdb..{name}') IS NOT NULL DROP TABLE {name}")
+
+    def get_records(self, query):
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
             records = cursor.fetchall()
+            QUERY_ROWS.inc(len(records), query=query_name(query))
             # list of records as tuples
             return records
 
     def get_record(self, query, result=0):
-        with self.connect_to_db() as cursor:
-            cursor.execute(query)
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
             # tuple containing first record
             record = cursor.fetchone()
+            QUERY_ROWS.inc(0 if record is None else 1, query=query_name(query))
             return record
 
     def get_value(self, query, result=0):
-        with self.connect_to_db() as cursor:
-            cursor.execute(query)
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
             # tuple containing first record
             record = cursor.fetchone()
+            QUERY_ROWS.inc(0 if record is None else 1, query=query_name(query))
             if len(record) == 1:
                 record = record[0]
                 return record
@@ -74,15 +293,42 @@ class PcConnect:
                                  ' {record}'.format(record=record))
 
     def get_list(self, query, result=0):
-        with self.connect_to_db() as cursor:
-            cursor.execute(query)
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
             # tuple containing first record
             records = cursor.fetchall()
+            QUERY_ROWS.inc(len(records), query=query_name(query))
             return list(map(lambda record: record[0], records))
 
     def get_df(self, query):
-        with self.connect_to_db() as cursor:
-            cursor.execute(query)
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
             names = [item[0] for item in cursor.description]
             records = cursor.fetchall()
+            QUERY_ROWS.inc(len(records), query=query_name(query))
             return pd.DataFrame(records, columns=names)
+
+    def iter_records(self, query, batch_size=BATCH_SIZE):
+        """Stream query results in lists of at most `batch_size` records
+        fetched with `fetchmany`. The pooled connection is held until the
+        generator is exhausted or closed.
+        """
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    return
+                QUERY_ROWS.inc(len(records), query=query_name(query))
+                yield records
+
+    def iter_df(self, query, batch_size=BATCH_SIZE, dtype=None):
+        """Stream query results as Pandas DataFrames of at most
+        `batch_size` rows, cast to `dtype` if given.
+        """
+        with QUERY_SECONDS.time(query=query_name(query)), self.query_cursor(query) as cursor:
+            names = [item[0] for item in cursor.description]
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    return
+                QUERY_ROWS.inc(len(records), query=query_name(query))
+                df = pd.DataFrame.from_records(records, columns=names)
+                yield df.astype(dtype) if dtype else df
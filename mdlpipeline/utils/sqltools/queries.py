@@ -5,7 +5,97 @@ TERM = 'Winter'
 YEAR = '2021'
 TERM_YEAR = TERM + YEAR
 
+# Seconds results of reference queries may be served from a handler's
+# query cache: the term's sections and the program memberships, which the
+# sync itself reads uncached
+COURSES_TTL = 6 * 60 * 60
+PROGRAMS_TTL = 60 * 60
+
+# Column types of roster results (idnumbers keep their leading zeros)
+ROSTER_DTYPES = {'idnumber': 'object', 'course': 'category',
+                 'section': 'category', 'role': 'category'}
+
+# Enrolled students of the courses and sections loaded in #course_keys,
+# with the SQL expression of the reported section to fill in. A NULL key
+# section matches every section of the course; mapped rosters report it
+# as '' so non-sectioned Moodle courses get one combined roster.
+ROSTERS_SQL = """SELECT DISTINCT REPLACE(PEOPLE.PEOPLE_CODE_ID,'P','') as idnumber,
+                SECTIONS.EVENT_ID as course, {section} as section,
+                CASE
+                    WHEN dbo.TRANSCRIPTDETAIL.FINAL_GRADE=N'AU' THEN 'auditingstudent'
+                    ELSE 'student'
+                END AS role
+                FROM dbo.TRANSCRIPTDETAIL
+                INNER JOIN #course_keys AS course_keys
+                    ON course_keys.EVENT_ID = dbo.TRANSCRIPTDETAIL.EVENT_ID
+                        AND (course_keys.SECTION IS NULL
+                             OR course_keys.SECTION = dbo.TRANSCRIPTDETAIL.SECTION)
+                INNER JOIN dbo.SECTIONS
+                    ON dbo.TRANSCRIPTDETAIL.ACADEMIC_YEAR = dbo.SECTIONS.ACADEMIC_YEAR
+                        AND dbo.TRANSCRIPTDETAIL.ACADEMIC_TERM = dbo.SECTIONS.ACADEMIC_TERM
+                        AND dbo.TRANSCRIPTDETAIL.EVENT_ID = dbo.SECTIONS.EVENT_ID
+                    LEFT OUTER JOIN dbo.PEOPLE
+                        ON dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID = dbo.PEOPLE.PEOPLE_CODE_ID
+                    LEFT OUTER JOIN dbo.ACADEMIC
+                        ON dbo.ACADEMIC.PEOPLE_CODE_ID = dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID AND
+                        dbo.ACADEMIC.academic_year = dbo.TRANSCRIPTDETAIL.academic_year AND
+                        dbo.ACADEMIC.academic_term = dbo.TRANSCRIPTDETAIL.academic_term AND
+                        dbo.ACADEMIC.academic_session = dbo.TRANSCRIPTDETAIL.academic_session
+                WHERE dbo.SECTIONS.ACADEMIC_YEAR = @year
+                    AND dbo.SECTIONS.ACADEMIC_TERM = @term
+                    AND dbo.TRANSCRIPTDETAIL.ADD_DROP_WAIT = N'A'
+                    AND (dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'W' AND dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'WA')
+                    AND (dbo.ACADEMIC.ENROLL_SEPARATION != 'LOA' AND dbo.ACADEMIC.ENROLL_SEPARATION != 'WITH'
+                        AND dbo.ACADEMIC.ENROLL_SEPARATION != 'AWIT')"""
+MAPPED_ROSTERS_SQL = ROSTERS_SQL.format(section="COALESCE(course_keys.SECTION, '')")
+
+
+def term_params(term, year):
+    """`Query` parameters for the academic term and year.
+    """
+    return [('term', 'nvarchar(20)', term), ('year', 'nvarchar(4)', year)]
+
+def revised_since(table):
+    """Condition selecting rows of `table` revised at or after the @since
+    parameter. REVISION_DATE holds the day of a revision and REVISION_TIME
+    its time of day, stored with a placeholder date which is ignored, so
+    rows revised on either side of midnight compare by day first. The
+    comparison on REVISION_DATE can use an index.
+    """
+    return ("(CAST({0}.REVISION_DATE AS date) > CAST(@since AS date)"
+            " OR (CAST({0}.REVISION_DATE AS date) = CAST(@since AS date)"
+            " AND CAST({0}.REVISION_TIME AS time) >= CAST(@since AS time)))").format(table)
+
+def course_keys_table(keys):
+    """Temporary table of (EVENT_ID, SECTION) keys, a None section
+    standing for all sections of the course.
+    """
+    return TempTable('#course_keys',
+                     [('EVENT_ID', 'nvarchar(20) NOT NULL'), ('SECTION', 'nvarchar(10) NULL')],
+                     keys)
+
+def mapping_keys_table(rows):
+    """Temporary table of (COURSEID, SHORTNAME, EVENT_ID, SECTION) rows
+    linking Moodle courses to the PowerCampus keys feeding them.
+    """
+    return TempTable('#mapping_keys',
+                     [('COURSEID', 'int NOT NULL'),
+                      ('SHORTNAME', 'nvarchar(255) COLLATE DATABASE_DEFAULT NOT NULL'),
+                      ('EVENT_ID', 'nvarchar(20) COLLATE DATABASE_DEFAULT NOT NULL'),
+                      ('SECTION', 'nvarchar(10) COLLATE DATABASE_DEFAULT NULL')],
+                     rows)
+
+def wc_rosters_table(rows):
+    """Temporary table of (COURSEID, IDNUMBER, ROLE) Moodle enrollments.
+    """
+    return TempTable('#wc_rosters',
+                     [('COURSEID', 'int NOT NULL'),
+                      ('IDNUMBER', 'nvarchar(20) COLLATE DATABASE_DEFAULT NOT NULL'),
+                      ('ROLE', 'nvarchar(20) COLLATE DATABASE_DEFAULT NOT NULL')],
+                     rows)
+
 @query_to_df
+@cache_ttl(COURSES_TTL)
 def get_courses(db_h, term=TERM, year=YEAR):
     return """SELECT distinct sxn.EVENT_ID,sxn.EVENT_LONG_NAME 
               FROM SECTIONS sxn 
@@ -21,6 +111,8 @@ def get_roster(db_h, *args, term=TERM, year=YEAR, print=True):
                 EA.Email, REPLACE(PEOPLE.PEOPLE_CODE_ID,'P','') as idnumber
 
             FROM dbo.TRANSCRIPTDETAIL
+                INNER JOIN #course_keys AS course_keys
+                    ON course_keys.EVENT_ID = dbo.TRANSCRIPTDETAIL.EVENT_ID
                 INNER JOIN dbo.SECTIONPER
                     ON dbo.TRANSCRIPTDETAIL.ACADEMIC_YEAR = dbo.SECTIONPER.ACADEMIC_YEAR
                         AND dbo.TRANSCRIPTDETAIL.ACADEMIC_TERM = dbo.SECTIONPER.ACADEMIC_TERM
@@ -31,24 +123,58 @@ def get_roster(db_h, *args, term=TERM, year=YEAR, print=True):
                     ON PEOPLE.PEOPLE_CODE_ID = EA.PeopleOrgCodeId
                     AND EA.EmailType = 'UWSSTU'
 
-            WHERE (dbo.SECTIONPER.ACADEMIC_YEAR = N'{year}')
-                AND (dbo.SECTIONPER.ACADEMIC_TERM = N'{term}')""".format(term=term, year=year)
-    if len(args) > 1:
-        query += "\n AND dbo.TRANSCRIPTDETAIL.EVENT_ID in {course}".format(course=args)
-    else:
-        query += "\n AND dbo.TRANSCRIPTDETAIL.EVENT_ID = '{course}'".format(course=args[0])
-    return query
+            WHERE (dbo.SECTIONPER.ACADEMIC_YEAR = @year)
+                AND (dbo.SECTIONPER.ACADEMIC_TERM = @term)"""
+    return Query(query, term_params(term, year),
+                 [course_keys_table((course, None) for course in args)])
 
 @query_to_df
 def get_all_rosters(db_h, *args, term=TERM, year=YEAR, print=True):
-    courses_str = str(args).replace(',)', ')')
-    query = """SELECT DISTINCT REPLACE(PEOPLE.PEOPLE_CODE_ID,'P','') as idnumber,
-                SECTIONS.EVENT_ID as course, dbo.TRANSCRIPTDETAIL.SECTION as section,
-                CASE
-                    WHEN dbo.TRANSCRIPTDETAIL.FINAL_GRADE=N'AU' THEN 'auditingstudent'
-                    ELSE 'student'
-                END AS role
+    """Rosters of every section of the courses passed as `args`, with
+    their PowerCampus section.
+    """
+    keys = [(course, None) for course in args]
+    return Query(ROSTERS_SQL.format(section='dbo.TRANSCRIPTDETAIL.SECTION'),
+                 term_params(term, year), [course_keys_table(keys)])
+
+
+@query_to_df
+def get_mapped_rosters(db_h, keys, term=TERM, year=YEAR, print=True):
+    """Rosters of the mapped (course, section) `keys`, filtered by section
+    on the server. Keys with a None section return every section of the
+    course with section ''.
+    """
+    return Query(MAPPED_ROSTERS_SQL, term_params(term, year), [course_keys_table(keys)])
+
+
+@query_to_df
+def get_roster_diff(db_h, key_rows, wc_rows, roles=('student', 'auditingstudent'), drops=True,
+                    term=TERM, year=YEAR, print=True):
+    """Conduit add/drop records computed on the server by comparing the
+    `get_mapped_rosters` enrollments of every mapped key with the Moodle
+    enrollments loaded in #wc_rosters, so only the difference is returned.
+
+    Args:
+        key_rows (list): (courseid, shortname, course, section) tuples of
+        every Moodle course to diff and the PowerCampus keys feeding it, a
+        None section standing for all sections of the course
+        wc_rows (list): (courseid, idnumber, role) tuples of Moodle
+        enrollments of those courses
+        roles (tuple): roles to compare
+        drops (bool): False to only return adds
+    """
+    query = """WITH expected AS (
+                SELECT DISTINCT mapping_keys.COURSEID,
+                    REPLACE(PEOPLE.PEOPLE_CODE_ID,'P','') as IDNUMBER,
+                    CASE
+                        WHEN dbo.TRANSCRIPTDETAIL.FINAL_GRADE=N'AU' THEN 'auditingstudent'
+                        ELSE 'student'
+                    END AS ROLE
                 FROM dbo.TRANSCRIPTDETAIL
+                INNER JOIN #mapping_keys AS mapping_keys
+                    ON mapping_keys.EVENT_ID = dbo.TRANSCRIPTDETAIL.EVENT_ID
+                        AND (mapping_keys.SECTION IS NULL
+                             OR mapping_keys.SECTION = dbo.TRANSCRIPTDETAIL.SECTION)
                 INNER JOIN dbo.SECTIONS
                     ON dbo.TRANSCRIPTDETAIL.ACADEMIC_YEAR = dbo.SECTIONS.ACADEMIC_YEAR
                         AND dbo.TRANSCRIPTDETAIL.ACADEMIC_TERM = dbo.SECTIONS.ACADEMIC_TERM
@@ -60,21 +186,124 @@ def get_all_rosters(db_h, *args, term=TERM, year=YEAR, print=True):
                         dbo.ACADEMIC.academic_year = dbo.TRANSCRIPTDETAIL.academic_year AND
                         dbo.ACADEMIC.academic_term = dbo.TRANSCRIPTDETAIL.academic_term AND
                         dbo.ACADEMIC.academic_session = dbo.TRANSCRIPTDETAIL.academic_session
-                WHERE dbo.SECTIONS.ACADEMIC_YEAR = N'{year}'
-                    AND dbo.SECTIONS.ACADEMIC_TERM = N'{term}'
+                WHERE dbo.SECTIONS.ACADEMIC_YEAR = @year
+                    AND dbo.SECTIONS.ACADEMIC_TERM = @term
                     AND dbo.TRANSCRIPTDETAIL.ADD_DROP_WAIT = N'A'
                     AND (dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'W' AND dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'WA')
                     AND (dbo.ACADEMIC.ENROLL_SEPARATION != 'LOA' AND dbo.ACADEMIC.ENROLL_SEPARATION != 'WITH'
-                        AND dbo.ACADEMIC.ENROLL_SEPARATION != 'AWIT')
-                    AND dbo.TRANSCRIPTDETAIL.EVENT_ID in {course}""".format(term=term, year=year, course=courses_str)
-    return query
+                        AND dbo.ACADEMIC.ENROLL_SEPARATION != 'AWIT')),
+            expected_roles AS (
+                SELECT COURSEID, IDNUMBER, ROLE FROM expected
+                WHERE (ROLE = 'student' AND @students = 1)
+                    OR (ROLE = 'auditingstudent' AND @audits = 1)),
+            actual_roles AS (
+                SELECT COURSEID, IDNUMBER, ROLE FROM #wc_rosters
+                WHERE (ROLE = 'student' AND @students = 1)
+                    OR (ROLE = 'auditingstudent' AND @audits = 1)),
+            changes AS (
+                SELECT 'add' AS action, adds.* FROM (
+                    SELECT * FROM expected_roles EXCEPT SELECT * FROM actual_roles) AS adds
+                UNION ALL
+                SELECT 'drop' AS action, drops.* FROM (
+                    SELECT * FROM actual_roles EXCEPT SELECT * FROM expected_roles) AS drops
+                WHERE @drops = 1)
+            SELECT changes.action, courses.SHORTNAME as shortname,
+                changes.IDNUMBER as idnumber, changes.ROLE as role
+            FROM changes
+            INNER JOIN (SELECT DISTINCT COURSEID, SHORTNAME FROM #mapping_keys) AS courses
+                ON courses.COURSEID = changes.COURSEID
+            ORDER BY changes.action, courses.SHORTNAME, changes.ROLE, changes.IDNUMBER"""
+    params = term_params(term, year) + [('students', 'bit', 'student' in roles),
+                                        ('audits', 'bit', 'auditingstudent' in roles),
+                                        ('drops', 'bit', drops)]
+    tables = [mapping_keys_table(key_rows), wc_rosters_table(wc_rows)]
+    return Query(query, params, tables)
 
 
 @query_to_df
+@cache_ttl(PROGRAMS_TTL)
 def get_students_by_program(db_h, term=TERM, year=YEAR, print=True):
     query = """SELECT DISTINCT REPLACE(aca.PEOPLE_CODE_ID,'P','') as idnumber, aca.CURRICULUM as program
             FROM ACADEMIC AS aca
             JOIN PEOPLE AS ppl on ppl.PEOPLE_CODE_ID = aca.PEOPLE_CODE_ID
             WHERE aca.CURRICULUM in ('CHIRO', 'NUTRIT', 'CLMH')
             and aca.ACADEMIC_YEAR = N'{year}' and aca.ACADEMIC_TERM = N'{term}'""".format(term=term, year=year)
-    return query
\ No newline at end of file
+    return query
+
+@query_to_df
+def get_mapped_roster_changes(db_h, keys, since, term=TERM, year=YEAR, print=True):
+    """All current roster rows of every (student, course) pair of the
+    mapped `keys` whose TRANSCRIPTDETAIL or ACADEMIC row was revised at or
+    after `since`. Rows failing the `get_mapped_rosters` eligibility rules
+    are returned with a NULL role so the caller can drop them.
+    """
+    query = """WITH changed AS (
+                SELECT DISTINCT dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID, dbo.TRANSCRIPTDETAIL.EVENT_ID
+                FROM dbo.TRANSCRIPTDETAIL
+                INNER JOIN #course_keys AS course_keys
+                    ON course_keys.EVENT_ID = dbo.TRANSCRIPTDETAIL.EVENT_ID
+                LEFT OUTER JOIN dbo.ACADEMIC
+                    ON dbo.ACADEMIC.PEOPLE_CODE_ID = dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID AND
+                    dbo.ACADEMIC.academic_year = dbo.TRANSCRIPTDETAIL.academic_year AND
+                    dbo.ACADEMIC.academic_term = dbo.TRANSCRIPTDETAIL.academic_term AND
+                    dbo.ACADEMIC.academic_session = dbo.TRANSCRIPTDETAIL.academic_session
+                WHERE dbo.TRANSCRIPTDETAIL.ACADEMIC_YEAR = @year
+                    AND dbo.TRANSCRIPTDETAIL.ACADEMIC_TERM = @term
+                    AND ({transcript_revised}
+                        OR {academic_revised}))
+            SELECT DISTINCT REPLACE(PEOPLE.PEOPLE_CODE_ID,'P','') as idnumber,
+                SECTIONS.EVENT_ID as course, COALESCE(course_keys.SECTION, '') as section,
+                CASE
+                    WHEN dbo.TRANSCRIPTDETAIL.ADD_DROP_WAIT = N'A'
+                        AND (dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'W' AND dbo.TRANSCRIPTDETAIL.FINAL_GRADE != N'WA')
+                        AND (dbo.ACADEMIC.ENROLL_SEPARATION != 'LOA' AND dbo.ACADEMIC.ENROLL_SEPARATION != 'WITH'
+                            AND dbo.ACADEMIC.ENROLL_SEPARATION != 'AWIT')
+                    THEN CASE
+                        WHEN dbo.TRANSCRIPTDETAIL.FINAL_GRADE=N'AU' THEN 'auditingstudent'
+                        ELSE 'student'
+                    END
+                END AS role
+                FROM changed
+                INNER JOIN dbo.TRANSCRIPTDETAIL
+                    ON dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID = changed.PEOPLE_CODE_ID
+                        AND dbo.TRANSCRIPTDETAIL.EVENT_ID = changed.EVENT_ID
+                INNER JOIN #course_keys AS course_keys
+                    ON course_keys.EVENT_ID = dbo.TRANSCRIPTDETAIL.EVENT_ID
+                        AND (course_keys.SECTION IS NULL
+                             OR course_keys.SECTION = dbo.TRANSCRIPTDETAIL.SECTION)
+                INNER JOIN dbo.SECTIONS
+                    ON dbo.TRANSCRIPTDETAIL.ACADEMIC_YEAR = dbo.SECTIONS.ACADEMIC_YEAR
+                        AND dbo.TRANSCRIPTDETAIL.ACADEMIC_TERM = dbo.SECTIONS.ACADEMIC_TERM
+                        AND dbo.TRANSCRIPTDETAIL.EVENT_ID = dbo.SECTIONS.EVENT_ID
+                    LEFT OUTER JOIN dbo.PEOPLE
+                        ON dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID = dbo.PEOPLE.PEOPLE_CODE_ID
+                    LEFT OUTER JOIN dbo.ACADEMIC
+                        ON dbo.ACADEMIC.PEOPLE_CODE_ID = dbo.TRANSCRIPTDETAIL.PEOPLE_CODE_ID AND
+                        dbo.ACADEMIC.academic_year = dbo.TRANSCRIPTDETAIL.academic_year AND
+                        dbo.ACADEMIC.academic_term = dbo.TRANSCRIPTDETAIL.academic_term AND
+                        dbo.ACADEMIC.academic_session = dbo.TRANSCRIPTDETAIL.academic_session
+                WHERE dbo.SECTIONS.ACADEMIC_YEAR = @year
+                    AND dbo.SECTIONS.ACADEMIC_TERM = @term""".format(
+                        transcript_revised=revised_since('dbo.TRANSCRIPTDETAIL'),
+                        academic_revised=revised_since('dbo.ACADEMIC'))
+    params = term_params(term, year) + [('since', 'datetime', since)]
+    return Query(query, params, [course_keys_table(keys)])
+
+
+@query_to_df
+def get_students_by_program_changes(db_h, since, term=TERM, year=YEAR, print=True):
+    """Current programs of every student whose ACADEMIC row for the term
+    was revised at or after `since`, with a NULL program for students no
+    longer in one of the synced programs.
+    """
+    query = """SELECT DISTINCT REPLACE(aca.PEOPLE_CODE_ID,'P','') as idnumber,
+                CASE WHEN aca.CURRICULUM in ('CHIRO', 'NUTRIT', 'CLMH') THEN aca.CURRICULUM END as program
+            FROM ACADEMIC AS aca
+            JOIN PEOPLE AS ppl on ppl.PEOPLE_CODE_ID = aca.PEOPLE_CODE_ID
+            WHERE aca.ACADEMIC_YEAR = @year and aca.ACADEMIC_TERM = @term
+            and aca.PEOPLE_CODE_ID in (
+                SELECT rev.PEOPLE_CODE_ID FROM ACADEMIC AS rev
+                WHERE rev.ACADEMIC_YEAR = @year and rev.ACADEMIC_TERM = @term
+                and {revised})""".format(revised=revised_since('rev'))
+    params = term_params(term, year) + [('since', 'datetime', since)]
+    return Query(query, params)
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from os import getenv
+
+import pandas as pd
+from .query_tools import Query
+from mdlpipeline.utils import metrics
+
+# Memory budget in MiB of the default query cache, 0 to disable it
+CACHE_MB = int(getenv('PC_QUERY_CACHE_MB', 0))
+# Directory of the on-disk tier of the default query cache
+CACHE_DIR = getenv('PC_QUERY_CACHE_DIR')
+
+CACHE_LOOKUPS = metrics.counter('pc_query_cache_lookups_total',
+                                'PowerCampus query cache lookups by tier answering them',
+                                ['query', 'result'])
+CACHE_BYTES = metrics.gauge('pc_query_cache_bytes', 'Memory held by the PowerCampus query cache')
+
+_default = None
+_default_lock = threading.Lock()
+
+# string literals, kept as is when normalizing whitespace
+LITERAL = re.compile(r"(N?'(?:[^']|'')*')")
+
+
+def normalize_sql(sql):
+    """`sql` with runs of whitespace outside string literals collapsed to
+    one space, so reformatted queries share cache entries.
+    """
+    parts = LITERAL.split(sql)
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part)
+                   for i, part in enumerate(parts)).strip()
+
+
+def value_size(value):
+    """Approximate bytes of memory held by a cached result.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # removed by another process sharing the directory
+        pass
+
+
+def copy_value(value):
+    # callers may modify results in place
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+class QueryCache():
+    """Cache of query results bounded by memory, evicting the least
+    recently used entries, with an optional on-disk tier.
+
+    Entries are keyed on the database, the kind of result, the query text
+    with normalized whitespace, its parameters and the rows of its
+    temporary tables, and expire `ttl` seconds after they were stored.
+    Results are copied in and out so callers may modify them. Disk entries
+    are pickles under `path` that survive restarts; their modification
+    time is set to their expiry.
+
+    The `query_tools` decorators use the cache of a handler's
+    `query_cache` attribute for queries declared with `cache_ttl`.
+
+    Args:
+        max_bytes (int): memory budget of the in-memory tier
+        path (str): directory of the on-disk tier, None for none
+
+    Attributes:
+        size (int): bytes held by the in-memory tier
+    """
+    def __init__(self, max_bytes=64 * 2 ** 20, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.prune()
+
+    def key(self, db_h, kind, query):
+        """Hex digest identifying the result of `query` of `kind` on the
+        database of `db_h`.
+        """
+        if not isinstance(query, Query):
+            query = Query(str(query))
+        tables = [[table.name, table.columns,
+                   hashlib.sha256(repr(table.rows).encode()).hexdigest()]
+                  for table in query.tables]
+        scope = db_h.cache_scope() if hasattr(db_h, 'cache_scope') else type(db_h).__name__
+        data = [scope, kind, normalize_sql(query.sql),
+                [[name, sql_type, repr(value)] for name, sql_type, value in query.params], tables]
+        return hashlib.sha256(json.dumps(data, default=str).encode()).hexdigest()
+
+    def disk_path(self, name, key):
+        return os.path.join(self.path, f'{name}-{key}.pkl')
+
+    def get(self, key, name='sql'):
+        """Returns:
+            object: copy of the cached result, None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, _, size, value = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    CACHE_LOOKUPS.inc(query=name, result='memory')
+                    return copy_value(value)
+                del self.entries[key]
+                self.size -= size
+        if self.path:
+            value, expires = self.load(name, key, now)
+            if value is not None:
+                self.store(key, name, value, expires)
+                CACHE_LOOKUPS.inc(query=name, result='disk')
+                return copy_value(value)
+        CACHE_LOOKUPS.inc(query=name, result='miss')
+        return None
+
+    def put(self, key, value, ttl, name='sql'):
+        """Cache `value` for `ttl` seconds, in memory and on disk.
+        """
+        if value is None or ttl <= 0:
+            return
+        expires = time.time() + ttl
+        value = copy_value(value)
+        self.store(key, name, value, expires)
+        if self.path:
+            self.dump(name, key, value, expires)
+
+    def store(self, key, name, value, expires):
+        size = value_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[key] = (expires, name, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted
+            CACHE_BYTES.set(self.size)
+
+    def load(self, name, key, now):
+        path = self.disk_path(name, key)
+        try:
+            if os.path.getmtime(path) <= now:
+                remove(path)
+                return None, None
+            with open(path, 'rb') as f:
+                return pickle.load(f), os.path.getmtime(path)
+        except FileNotFoundError:
+            return None, None
+        except (OSError, pickle.UnpicklingError, EOFError) as err:
+            print(f'query cache entry {path} not read: {err!r}')
+            return None, None
+
+    def dump(self, name, key, value, expires):
+        path = self.disk_path(name, key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.utime(tmp_path, (expires, expires))
+            os.replace(tmp_path, path)
+        except OSError as err:
+            print(f'query cache entry {path} not written: {err!r}')
+
+    def prune(self):
+        """Remove expired entries from disk.
+        """
+        now = time.time()
+        for file_name in os.listdir(self.path):
+            path = os.path.join(self.path, file_name)
+            if file_name.endswith('.pkl') and os.path.getmtime(path) <= now:
+                remove(path)
+
+    def invalidate(self, name=None):
+        """Drop the cached results of queries named `name`, e.g.
+        "get_courses", or of all queries, from memory and disk.
+
+        Returns:
+            int: number of entries dropped from memory
+        """
+        with self._lock:
+            keys = [key for key, (_, entry_name, _, _) in self.entries.items()
+                    if name is None or entry_name == name]
+            for key in keys:
+                self.size -= self.entries.pop(key)[2]
+            CACHE_BYTES.set(self.size)
+        if self.path:
+            for file_name in os.listdir(self.path):
+                if file_name.endswith('.pkl') and (
+                        name is None or file_name.rsplit('-', 1)[0] == name):
+                    remove(os.path.join(self.path, file_name))
+        return len(keys)
+
+
+def default_cache():
+    """Returns:
+        QueryCache: process-wide cache configured by `PC_QUERY_CACHE_MB`
+        and `PC_QUERY_CACHE_DIR`, None when disabled
+    """
+    global _default
+    if not CACHE_MB:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = QueryCache(CACHE_MB * 2 ** 20, CACHE_DIR)
+        return _default
@@ -1,15 +1,104 @@
 import functools
 
+
+class TempTable():
+    """Temporary table created and bulk loaded on the connection of a
+    `Query` before it runs.
+
+    Args:
+        name (str): table name starting with "#"
+        columns (list): list of (column name, SQL type) tuples
+        rows (list): list of tuples to insert
+    """
+    def __init__(self, name, columns, rows):
+        self.name = name
+        self.columns = columns
+        self.rows = list(rows)
+
+
+class Query():
+    """Parameterised query run with `sp_executesql` so that SQL Server
+    caches a single plan for the statement regardless of parameter values.
+
+    Args:
+        sql (str): statement referencing parameters as "@name"
+        params (list): list of (name, SQL type, value) tuples
+        tables (list): list of `TempTable` to load before running `sql`
+        name (str): name reported in metrics, defaults to the name of the
+        decorated query function
+    """
+    def __init__(self, sql, params=(), tables=(), name=None):
+        self.sql = sql
+        self.params = list(params)
+        self.tables = list(tables)
+        self.name = name
+
+    def __str__(self):
+        return self.sql
+
+def named_query(query, name):
+    """`query` as a `Query` named `name` unless it already has a name.
+    """
+    if not isinstance(query, Query):
+        return Query(query, name=name)
+    if query.name is None:
+        query.name = name
+    return query
+
+def cache_ttl(seconds):
+    """Declare that results of the decorated query function may be served
+    from the handler's `query_cache` for `seconds`. Apply below the
+    `query_to*` decorator.
+
+    Example:
+        >>> @query_to_df
+        ... @cache_ttl(6 * 60 * 60)
+        ... def get_courses(db_h, term=TERM, year=YEAR):
+        ...     return 'SELECT ...'
+    """
+    def decorator(func):
+        func.cache_ttl = seconds
+        return func
+    return decorator
+
+def run_cached(db_h, func, kind, query, run, ttl=None):
+    """Result of `run(query)`, from `db_h.query_cache` when the handler
+    has one and `query` may be cached for `ttl` seconds, defaulting to the
+    `cache_ttl` of `func`.
+    """
+    cache = getattr(db_h, 'query_cache', None)
+    ttl = getattr(func, 'cache_ttl', 0) if ttl is None else ttl
+    if cache is None or not ttl:
+        return run(query)
+    key = cache.key(db_h, kind, query)
+    results = cache.get(key, query.name)
+    if results is None:
+        results = run(query)
+        cache.put(key, results, ttl, query.name)
+    return results
+
 def query_to_df(func):
     """Decorated function desigend to wrap function returning a query string 
     to get resutls as Pandas DataFrame
+
+    The wrapped function accepts three extra keyword arguments: `chunksize`
+    to return a generator of DataFrames of at most `chunksize` rows
+    streamed with `fetchmany`, `dtype` to cast the results, and
+    `cache_ttl` to override the seconds results are cached for, 0 to
+    bypass the cache. Streamed results are never cached.
     """
     @functools.wraps(func)
     def wrapper_decorator(db_h, *args, **kwargs):
-        query = func(db_h, *args, **kwargs)
+        chunksize = kwargs.pop('chunksize', None)
+        dtype = kwargs.pop('dtype', None)
+        ttl = kwargs.pop('cache_ttl', None)
+        query = named_query(func(db_h, *args, **kwargs), func.__name__)
         if kwargs.get('print'):
             print(query)
-        return db_h.get_df(query)
+        if chunksize:
+            return db_h.iter_df(query, chunksize, dtype=dtype)
+        df = run_cached(db_h, func, 'df', query, db_h.get_df, ttl)
+        return df.astype(dtype) if dtype else df
     return wrapper_decorator
 
 def query_to_value(func):
@@ -18,8 +107,9 @@ def query_to_value(func):
     """
     @functools.wraps(func)
     def wrapper_decorator(db_h, *args, **kwargs):
-        query = func(db_h, *args, **kwargs)
-        results = db_h.get_value(query)
+        ttl = kwargs.pop('cache_ttl', None)
+        query = named_query(func(db_h, *args, **kwargs), func.__name__)
+        results = run_cached(db_h, func, 'value', query, db_h.get_value, ttl)
         print(query)
         return results
     return wrapper_decorator
@@ -30,8 +120,9 @@ def query_to_list(func):
     """
     @functools.wraps(func)
     def wrapper_decorator(db_h, *args, **kwargs):
-        query = func(db_h, *args, **kwargs)
-        results = db_h.get_list(query)
+        ttl = kwargs.pop('cache_ttl', None)
+        query = named_query(func(db_h, *args, **kwargs), func.__name__)
+        results = run_cached(db_h, func, 'list', query, db_h.get_list, ttl)
         print(query)
         return results
     return wrapper_decorator
\ No newline at end of file
@@ -0,0 +1,21 @@
+import sys
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.sync.partition import PARTITIONS, run_local, work
+
+def main():
+    """Runs one sync of the academic course mapping split into
+    `SYNC_PARTITIONS` partitions, pulled and diffed by as many local
+    worker processes, then merged and pushed as one Conduit file.
+
+    `partitioned_sync.py worker` instead runs a worker against the queue
+    in `cache/`, e.g. on another node sharing the directory, until no
+    partition is left.
+    """
+    if sys.argv[1:] == ['worker']:
+        work()
+    else:
+        run_local('data/wc_pc_mapping_wi21.json', workers=PARTITIONS,
+                  sync_class=SyncEnrollments, partitions=PARTITIONS)
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,31 @@
-import json
-import asyncio
-from mdlpipeline.sync.enrollments import SyncEnrollments
-from datetime import datetime
-from sched import scheduler
-from time import time, sleep
-import pytest
-
-def sync_daemon(local_handler):
-    """Loads course mapping file, runs pull to find add/drops
-    for webCampus's Conduit system, pushes file to SFTP to
-    sftp02-na.blackboardopenlms.com/webcampus.uws.edu/conduit/.
-    """
-    with open('data/wc_pc_mapping_wi21.json', 'r') as f:
-        MAPPING_JSON = json.load(f)
-    # Data pull to find add/drops for webCampus's Conduit system
-    se = asyncio.run(SyncEnrollments.pull(MAPPING_JSON))
-    # Log Conduit file in log directory
-    se.log_conduit()
-    # Push file via SFTP
-    se.push_conduit()
-    local_handler.enter(15*60, 1, sync_daemon, (local_handler,))
-
-if __name__ == '__main__':
-    handler = scheduler(time, sleep)
-    handler.enter(0, 1, sync_daemon, (handler,))
-    handler.run()
-    main()
\ No newline at end of file
+import asyncio
+import logging
+from mdlpipeline.sync.daemon import SyncDaemon
+from mdlpipeline.sync.enrollments import SyncEnrollments, SyncNonAcademicEnrollments
+from mdlpipeline.sync.runner import SyncJob, SyncRunner
+
+def main():
+    """Runs the sync daemon, pulling add/drops for webCampus's Conduit
+    system and pushing files to SFTP to
+    sftp02-na.blackboardopenlms.com/webcampus.uws.edu/conduit/ for the
+    academic course mapping and the program mapping.
+
+    Jobs run concurrently and share clients and pools; add a `SyncJob`
+    per mapping and term to sync several terms at once. Clients, pools,
+    caches and mappings are kept warm across cycles, see `SyncDaemon` for
+    the schedule and shutdown behaviour.
+
+    Structured JSON logs of every pull and cycle go to stderr; metrics
+    are exported with `METRICS_TEXTFILE` or `METRICS_PORT`.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    runner = SyncRunner([
+        SyncJob(SyncEnrollments, 'data/wc_pc_mapping_wi21.json', 'Winter', '2021',
+                name='enrollments'),
+        SyncJob(SyncNonAcademicEnrollments, 'data/non_academic_mapping.json', 'Winter', '2021',
+                name='programs'),
+    ])
+    asyncio.run(SyncDaemon(runner).run())
+
+if __name__ == '__main__':
+    main()
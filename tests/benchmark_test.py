@@ -0,0 +1,52 @@
+from benchmarks.bench_sync import run_benchmark, report
+from benchmarks.fakes import SqlitePcConnect
+from benchmarks.generate import generate_mapping, generate_enrollments, write_powercampus
+from mdlpipeline.utils.sqltools.queries import (get_all_rosters, get_mapped_rosters,
+                                                get_students_by_program)
+
+
+def test_powercampus_stand_in_runs_roster_queries(tmp_path):
+    mapping = generate_mapping(5)
+    rows, _, _ = generate_enrollments(mapping, students=10, audit=0.5)
+    write_powercampus(str(tmp_path / 'pc.sqlite'), rows)
+    db_h = SqlitePcConnect(str(tmp_path / 'pc.sqlite'))
+    course = next(iter(mapping.values()))['courses'][0]
+    df = get_mapped_rosters(db_h, [(course, None), (course, '01')], print=False)
+    enrolled = {(idnumber, section) for idnumber, c, section, grade in rows
+                if c == course and grade != 'W'}
+    assert set(df[df.section == '01'].idnumber) == {i for i, s in enrolled if s == '01'}
+    assert set(df[df.section == ''].idnumber) == {i for i, _ in enrolled}
+    assert set(df.role) == {'student', 'auditingstudent'}
+    assert len(get_students_by_program(db_h, print=False))
+
+
+def test_benchmark_finds_generated_drift(tmp_path):
+    results = run_benchmark(shells=20, students=10, workdir=str(tmp_path))
+    assert results['changes'] == results['expected_changes'] > 0
+    assert results['moodle_requests'] == 20 and not results['wc_pull_errors']
+    assert results['sftp_connections'] == 1
+    assert (tmp_path / 'sftp' / 'webcampus.uws.edu' / 'conduit' / 'enrollments.csv').exists()
+    assert 'peak_mb' in report(results)
+
+
+def test_course_keys_select_mapped_rosters(tmp_path):
+    mapping = generate_mapping(20, sectioned=0.5)
+    rows, _, _ = generate_enrollments(mapping, students=10, audit=0)
+    write_powercampus(str(tmp_path / 'pc.sqlite'), rows)
+    db_h = SqlitePcConnect(str(tmp_path / 'pc.sqlite'))
+    sections = {}
+    for idnumber, course, section, grade in rows:
+        if grade != 'W':
+            sections.setdefault(course, {}).setdefault(section, set()).add(idnumber)
+    course, other = sorted(sections)[:2]
+    section = sorted(sections[course])[0]
+    keys = [(course, section), (other, None), ('UNMAPPED', None)]
+    df = get_mapped_rosters(db_h, keys, print=False)
+    assert {(c, s) for c, s in zip(df.course, df.section)} == {(course, section), (other, '')}
+    assert set(df[df.course == course].idnumber) == sections[course][section]
+    assert set(df[df.course == other].idnumber) == set().union(*sections[other].values())
+
+    df = get_all_rosters(db_h, course, other, print=False)
+    assert set(zip(df.course, df.section, df.idnumber)) == {
+        (c, s, idnumber) for c in (course, other) for s, ids in sections[c].items()
+        for idnumber in ids}
@@ -0,0 +1,88 @@
+from mdlpipeline.utils.mdltools.conduit import ConduitSession, ConduitWriter, CONDUIT_DIR
+
+import gzip
+import io
+import pandas as pd
+
+
+class FakeFile(io.BytesIO):
+    def __init__(self, files, path):
+        super().__init__()
+        self.files, self.path = files, path
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        return super().write(data.encode() if isinstance(data, str) else data)
+
+    def close(self):
+        self.files[self.path] = self.getvalue()
+        super().close()
+
+
+class FakeSftp():
+    def __init__(self, files, fail=False):
+        self.files, self.fail = files, fail
+
+    def stat(self, path):
+        if self.fail:
+            raise EOFError('connection dropped')
+        if path not in self.files:
+            raise FileNotFoundError(path)
+
+    def get(self, path):
+        raise AssertionError('existence check must not download the file')
+
+    def open(self, path, mode):
+        return FakeFile(self.files, path)
+
+    def rename(self, path, new_path):
+        self.files[new_path] = self.files.pop(path)
+
+    def close(self):
+        pass
+
+
+class FakeSession(ConduitSession):
+    def __init__(self, connections):
+        super().__init__(host='sftp.example.edu', password='')
+        self.connections = connections
+
+    def connect(self):
+        return self.connections.pop(0)
+
+
+def test_put_streams_dataframe_over_one_session():
+    files = {}
+    conduit = FakeSession([FakeSftp(files)])
+    df = pd.DataFrame([['add', 'BSC5102Winter2021', '0023', 'student']],
+                      columns=['action', 'shortname', 'idnumber', 'role'])
+    assert conduit.put(df, 'enrollments.csv')
+    assert files == {conduit.directory + 'enrollments.csv': df.to_csv(index=False).encode()}
+    # the file is still waiting for Conduit so the next push is skipped
+    assert not conduit.put(df, 'enrollments.csv')
+    assert conduit.connections == []
+
+
+def test_put_reconnects_after_dropped_connection():
+    files = {}
+    conduit = FakeSession([FakeSftp(files, fail=True), FakeSftp(files)])
+    assert conduit.put(b'action,shortname\n', 'enrollments.csv')
+    assert list(files) == [conduit.directory + 'enrollments.csv']
+
+
+def test_writer_splits_upload_and_tees_log(tmp_path):
+    files = {}
+    df = pd.DataFrame([['add', 'BSC5102Winter2021', f'{i:04d}', 'student'] for i in range(5)],
+                      columns=['action', 'shortname', 'idnumber', 'role'])
+    with ConduitWriter('enrollments', FakeSession([FakeSftp(files)]), log_dir=str(tmp_path),
+                       compress=True, max_rows=2, chunk_rows=1) as writer:
+        writer.write(df)
+    assert writer.pushed == ['enrollments.csv', 'enrollments-2.csv', 'enrollments-3.csv']
+    assert writer.pushed_rows == 5
+    parts = [pd.read_csv(io.BytesIO(files[CONDUIT_DIR + name]), dtype=str) for name in writer.pushed]
+    assert [len(part) for part in parts] == [2, 2, 1]
+    assert pd.concat(parts, ignore_index=True).equals(df)
+    with gzip.open(writer.log_path) as f:
+        assert f.read() == df.to_csv(index=False).encode()
@@ -0,0 +1,139 @@
+from mdlpipeline.sync.daemon import SyncDaemon, OVERRUNS, parse_periods
+
+import asyncio
+import os
+from datetime import date
+
+
+class FakeRunner():
+    def __init__(self, changes, duration=0.0):
+        self.changes = list(changes)
+        self.duration = duration
+        self.running = 0
+        self.max_running = 0
+        self.runs = 0
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    async def run(self):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.duration)
+        self.running -= 1
+        self.runs += 1
+        changes = self.changes.pop(0) if self.changes else 0
+        if isinstance(changes, Exception):
+            raise changes
+        return changes
+
+
+def test_interval_adapts_to_changes():
+    daemon = SyncDaemon(FakeRunner([]), interval=10, min_interval=2, max_interval=40, busy_changes=100,
+                         add_drop_periods=[])
+    assert daemon.get_interval(500) == 2
+    assert daemon.get_interval(5) == 10
+    intervals = []
+    for _ in range(4):
+        daemon.next_interval = daemon.get_interval(0)
+        intervals.append(daemon.next_interval)
+    assert intervals == [20, 40, 40, 40]
+    daemon.add_drop_periods = parse_periods(f'{date.today()}/{date.today()}')
+    assert daemon.get_interval(0) == 2
+
+
+def test_failed_cycle_keeps_normal_interval():
+    runner = FakeRunner([0, 0, RuntimeError('PowerCampus down'), 0])
+    daemon = SyncDaemon(runner, interval=10, min_interval=2, max_interval=40, busy_changes=100,
+                         add_drop_periods=[])
+    intervals = []
+
+    async def drive():
+        for _ in range(4):
+            changes = await daemon.run_cycle()
+            daemon.next_interval = daemon.get_interval(changes)
+            intervals.append((changes, daemon.next_interval))
+            daemon.record_cycle(changes, 0.01, 10)
+
+    asyncio.run(drive())
+    # a failure neither backs off further nor counts as a quiet cycle
+    assert intervals == [(0, 20), (0, 40), (None, 10), (0, 20)]
+
+
+def test_ticks_coalesce_and_never_overlap():
+    runner = FakeRunner([1, 1, 1], duration=0.05)
+    daemon = SyncDaemon(runner, interval=0.01, min_interval=0.01, max_interval=0.01,
+                         add_drop_periods=[])
+
+    async def drive():
+        task = asyncio.ensure_future(daemon.run())
+        await asyncio.sleep(0.01)
+        # triggers while a cycle runs collapse into one extra cycle
+        daemon.trigger()
+        daemon.trigger()
+        await asyncio.sleep(0.12)
+        daemon.stop()
+        await task
+
+    asyncio.run(drive())
+    assert runner.max_running == 1
+    assert daemon.cycles == runner.runs
+    assert runner.closed
+
+
+def test_second_stop_cancels_running_cycle():
+    runner = FakeRunner([1], duration=10)
+    daemon = SyncDaemon(runner, add_drop_periods=[])
+
+    async def drive():
+        task = asyncio.ensure_future(daemon.run())
+        await asyncio.sleep(0.01)
+        daemon.stop()
+        daemon.stop()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(drive())
+    assert runner.runs == 0 and daemon.cycles == 0 and runner.closed
+
+
+def test_cycles_export_metrics(tmp_path):
+    runner = FakeRunner([3], duration=0.02)
+    textfile = tmp_path / 'sync.prom'
+    # an interval shorter than the cycle counts as an overrun
+    daemon = SyncDaemon(runner, interval=0.01, min_interval=0.01, max_interval=0.01,
+                        add_drop_periods=[], metrics_textfile=str(textfile))
+    overruns = OVERRUNS.get()
+
+    async def drive():
+        task = asyncio.ensure_future(daemon.run())
+        await asyncio.sleep(0.01)
+        daemon.stop()
+        await task
+
+    asyncio.run(drive())
+    assert OVERRUNS.get() == overruns + 1
+    assert 'sync_last_cycle_changes 3' in textfile.read_text()
+
+
+def test_trigger_file_profiles_next_cycle(tmp_path):
+    runner = FakeRunner([1, 1, 1], duration=0.01)
+    trigger = tmp_path / 'profile_next_cycle'
+    daemon = SyncDaemon(runner, interval=0.02, min_interval=0.02, max_interval=0.02,
+                        add_drop_periods=[], metrics_textfile=None,
+                        profile_trigger=str(trigger), profile_dir=str(tmp_path / 'profiles'))
+
+    async def drive():
+        task = asyncio.ensure_future(daemon.run())
+        await asyncio.sleep(0.03)
+        trigger.touch()
+        await asyncio.sleep(0.1)
+        daemon.stop()
+        await task
+
+    asyncio.run(drive())
+    assert daemon.cycles >= 3
+    assert not trigger.exists()
+    assert len(os.listdir(tmp_path / 'profiles')) == 1
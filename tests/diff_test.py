@@ -0,0 +1,91 @@
+from mdlpipeline.sync.enrollments import SyncEnrollments, SyncNonAcademicEnrollments
+
+import pandas as pd
+import random
+import pytest
+
+ROLES = ('student', 'auditingstudent')
+
+
+def reference_diff(se, roles):
+    """Per-course set based diff the vectorized engine must match."""
+    records = set()
+    for course in se.mapping:
+        courseid = se.mapping[course]["id"]
+        if courseid in se.wc_pull_errors:
+            continue
+        for role in roles:
+            section = se.mapping[course].get('section', '')
+            pc_roster = set().union(*[se.pc_rosters.get((crosslist, section), {}).get(role, set())
+                                      for crosslist in se.mapping[course]["courses"]])
+            wc_roster = se.wc_rosters[courseid][role]
+            records |= {("add", course, idnumber, role) for idnumber in pc_roster - wc_roster}
+            records |= {("drop", course, idnumber, role) for idnumber in wc_roster - pc_roster}
+    return records
+
+
+def random_sync(seed, n_courses=40, n_students=300):
+    rng = random.Random(seed)
+    students = [f'{i:07d}' for i in range(n_students)]
+    pc_courses = [f'BSC{i}' for i in range(n_courses)]
+    mapping = {}
+    for i in range(n_courses):
+        entry = {"courses": rng.sample(pc_courses, rng.choice([1, 1, 2, 3])), "id": 1000 + i}
+        if rng.random() < 0.5:
+            entry["section"] = rng.choice(['01', '02'])
+        mapping[f'COURSE{i}'] = entry
+    se = SyncEnrollments(mapping, db_h=object())
+    se.pc_rosters = {(course, section): {role: set(rng.sample(students, rng.randint(0, 30)))
+                                         for role in ROLES if rng.random() < 0.8}
+                     for course in pc_courses for section in ('', '01', '02')}
+    se.wc_rosters = {entry["id"]: {role: set(rng.sample(students, rng.randint(0, 30)))
+                                   for role in ROLES}
+                     for entry in mapping.values()}
+    se.wc_pull_errors = [1003, 1007]
+    for courseid in se.wc_pull_errors:
+        del se.wc_rosters[courseid]
+    return se
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_conduit_diff_matches_reference(seed):
+    se = random_sync(seed)
+    df = se.get_conduit_diff(ROLES)
+    records = set(df.itertuples(index=False, name=None))
+    assert len(records) == len(df)
+    assert records == reference_diff(se, ROLES)
+
+
+def test_conduit_enrollments_single_role():
+    se = random_sync(0)
+    df = se.get_conduit_enrollments('auditingstudent')
+    assert set(df.itertuples(index=False, name=None)) == reference_diff(se, ('auditingstudent',))
+
+
+def test_non_academic_only_adds():
+    se = SyncNonAcademicEnrollments({"Hub": {"program": "CLMH", "id": 1}}, db_h=object())
+    se.pc_rosters = {"CLMH": {"1", "2"}, "CHIRO": {"3"}}
+    se.wc_rosters = {1: {"student": {"2", "4"}, "auditingstudent": set()}}
+    df = se.get_conduit_diff(('student',))
+    assert df.values.tolist() == [["add", "Hub", "1", "student"]]
+
+
+class CapturingDb():
+    def get_df(self, query):
+        self.query = query
+        return pd.DataFrame([], columns=['action', 'shortname', 'idnumber', 'role'])
+
+
+def test_sql_diff_uploads_moodle_rosters():
+    se = random_sync(1)
+    se.db_h = CapturingDb()
+    se.diff_mode = 'sql'
+    df = se.get_conduit_diff(('student',))
+    assert list(df.columns) == ['action', 'shortname', 'idnumber', 'role']
+    key_table, wc_table = se.db_h.query.tables
+    courses = {course for course in se.mapping if se.mapping[course]["id"] in se.wc_rosters}
+    assert {row[1] for row in key_table.rows} == courses
+    assert set(wc_table.rows) == {(courseid, idnumber, 'student')
+                                  for courseid, roster in se.wc_rosters.items()
+                                  for idnumber in roster['student']}
+    assert dict((name, value) for name, _, value in se.db_h.query.params)['audits'] is False
@@ -0,0 +1,61 @@
+from mdlpipeline.utils.mdltools.enrol import apply_enrolments
+
+import asyncio
+import pandas as pd
+
+USERS = {'0001': 11, '0002': 12, '0003': 13}
+
+
+class FakeResponse():
+    def __init__(self, body):
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return self.body
+
+
+class FakeMoodle():
+    """Stand-in for an aiohttp session posting to Moodle Web Services."""
+    def __init__(self, bad_userids=()):
+        self.bad_userids = set(bad_userids)
+        self.calls = []
+
+    def post(self, url, data):
+        function = data['wsfunction']
+        self.calls.append(function)
+        if function == 'core_user_get_users_by_field':
+            values = [value for key, value in data.items() if key.startswith('values[')]
+            return FakeResponse([{'id': USERS[idnumber], 'idnumber': idnumber}
+                                 for idnumber in values if idnumber in USERS])
+        userids = {value for key, value in data.items() if key.endswith('[userid]')}
+        if userids & self.bad_userids:
+            return FakeResponse({'exception': 'invalid_parameter_exception',
+                                 'message': 'Invalid parameter value detected'})
+        return FakeResponse(None)
+
+
+def conduit_df(records):
+    return pd.DataFrame(records, columns=['action', 'shortname', 'idnumber', 'role'])
+
+
+def test_batches_and_per_record_results():
+    moodle = FakeMoodle(bad_userids={12})
+    df = conduit_df([['add', 'BSC', '0001', 'student'], ['add', 'BSC', '0002', 'student'],
+                     ['add', 'BSC', '0003', 'auditingstudent'], ['drop', 'BSC', '0004', 'student']])
+    userids = {'0001': 11}
+    results = asyncio.run(apply_enrolments(df, {'BSC': 4748}, userids, batch_size=10,
+                                           session=moodle))
+    assert results.status.tolist() == ['ok', 'failed', 'ok', 'unknown user']
+    assert 'invalid_parameter_exception' in results.message[1]
+    assert userids == USERS
+    # one lookup, one batch, then a retry per enrolment of the failed batch
+    assert moodle.calls == ['core_user_get_users_by_field'] + ['enrol_manual_enrol_users'] * 4
@@ -0,0 +1,180 @@
+from benchmarks.fakes import SqlitePcConnect
+from benchmarks.generate import generate_mapping, generate_enrollments, write_powercampus
+from mdlpipeline.sync.enrollments import SyncEnrollments, SyncNonAcademicEnrollments
+from mdlpipeline.sync.incremental import IncrementalExtract
+from mdlpipeline.utils.sqltools.query_cache import QueryCache
+from mdlpipeline.utils.sqltools.queries import get_mapped_roster_changes, get_students_by_program
+
+from datetime import datetime, timedelta
+import sqlite3
+import pytest
+
+
+class Clock():
+    """Handler answering `SELECT GETDATE()` with `now`."""
+    def __init__(self, now):
+        self.now = now
+
+    def get_value(self, query):
+        assert query == 'SELECT GETDATE()'
+        return self.now
+
+
+def make_extract(path, **kwargs):
+    return IncrementalExtract('rosters', path=str(path / 'rosters.pkl'), **kwargs)
+
+
+def test_watermark_moves_with_server_time(tmp_path):
+    clock = Clock(datetime(2021, 1, 4, 23, 58))
+    extract = make_extract(tmp_path, overlap=300)
+    deltas = []
+    full = lambda: {'pulls': 1}
+    delta = lambda since: deltas.append(since) or 'rows'
+    apply = lambda rosters, rows: rosters.update(pulls=rosters['pulls'] + 1)
+
+    assert extract.pull(clock, full, delta, apply, signature='a') == {'pulls': 1}
+    assert extract.last_pull == 'full' and extract.watermark == clock.now
+
+    # across midnight the delta starts from the previous day
+    clock.now = datetime(2021, 1, 5, 0, 3)
+    assert extract.pull(clock, full, delta, apply, signature='a') == {'pulls': 2}
+    assert extract.last_pull == 'delta'
+    assert deltas == [datetime(2021, 1, 4, 23, 53)]
+    assert extract.watermark == clock.now and extract.refreshed == datetime(2021, 1, 4, 23, 58)
+
+    # the cache and watermark survive a restart
+    restarted = make_extract(tmp_path, overlap=300)
+    assert (restarted.rosters, restarted.watermark) == ({'pulls': 2}, clock.now)
+    assert restarted.pull(clock, full, delta, apply, signature='b') == {'pulls': 1}
+    assert restarted.last_pull == 'full'
+
+
+def test_full_refresh_after_interval(tmp_path):
+    clock = Clock(datetime(2021, 1, 4, 12))
+    extract = make_extract(tmp_path, full_refresh=3600)
+    pull = lambda: extract.pull(clock, lambda: [], lambda since: None, lambda r, d: None)
+    pull()
+    clock.now += timedelta(minutes=59)
+    pull()
+    assert extract.last_pull == 'delta'
+    clock.now += timedelta(minutes=1)
+    pull()
+    assert extract.last_pull == 'full' and extract.refreshed == clock.now
+
+
+def test_failed_delta_drops_the_cache(tmp_path):
+    clock = Clock(datetime(2021, 1, 4, 12))
+    extract = make_extract(tmp_path)
+    extract.pull(clock, lambda: {'a': 1}, None, None)
+
+    def broken(rosters, rows):
+        rosters['a'] = 2
+        raise ValueError('bad delta')
+
+    clock.now += timedelta(minutes=10)
+    with pytest.raises(ValueError):
+        extract.pull(clock, None, lambda since: [], broken)
+    assert extract.rosters is None and extract.watermark == datetime(2021, 1, 4, 12)
+    extract.pull(clock, lambda: {'a': 3}, None, None)
+    assert extract.last_pull == 'full' and extract.rosters == {'a': 3}
+
+
+class ClockedPcConnect(SqlitePcConnect):
+    """SQLite stand-in whose server time is `now`."""
+    now = None
+
+    def get_value(self, query, result=0):
+        if query == 'SELECT GETDATE()':
+            return self.now
+        return super().get_value(query, result)
+
+
+def revise(path, sql, revised, *params, time_date=None):
+    """Run `sql` on the PowerCampus stand-in, stamping changed rows as
+    revised at `revised` with a REVISION_TIME on `time_date`.
+    """
+    con = sqlite3.connect(path)
+    con.execute(sql.format(revision=f"REVISION_DATE = '{revised:%Y-%m-%d} 00:00:00', "
+                                    f"REVISION_TIME = '{time_date or '1900-01-01'} "
+                                    f"{revised:%H:%M:%S}'"), params)
+    con.commit()
+    con.close()
+
+
+def test_deltas_across_midnight(tmp_path):
+    path = str(tmp_path / 'pc.sqlite')
+    mapping = generate_mapping(10, sectioned=0)
+    rows, _, _ = generate_enrollments(mapping, students=10, audit=0)
+    write_powercampus(path, rows)
+    db_h = ClockedPcConnect(path)
+    extract = IncrementalExtract('rosters', path=str(tmp_path / 'rosters.pkl'), overlap=300)
+
+    def pull():
+        se = SyncEnrollments(mapping, db_h=db_h, conduit=object(), pc_cache=extract)
+        return {key: dict(roles) for key, roles in se.get_pc_rosters().items()}
+
+    db_h.now = datetime(2021, 1, 4, 23, 58)
+    before = pull()
+    course = sorted(before)[0]
+    dropped, audit, early = sorted(before[course]['student'])[:3]
+    update = ("UPDATE TRANSCRIPTDETAIL SET {revision}, %s "
+              "WHERE PEOPLE_CODE_ID = ? AND EVENT_ID = ?")
+    # after midnight, just before midnight with the time stored on another
+    # date, and before the overlap of the watermark
+    revise(path, update % "ADD_DROP_WAIT = 'D'", datetime(2021, 1, 5, 0, 1),
+           f'P{dropped}', course[0])
+    revise(path, update % "FINAL_GRADE = 'AU'", datetime(2021, 1, 4, 23, 55),
+           f'P{audit}', course[0], time_date='1899-12-30')
+    revise(path, update % "FINAL_GRADE = 'W'", datetime(2021, 1, 4, 23, 50),
+           f'P{early}', course[0])
+
+    since = datetime(2021, 1, 4, 23, 53)
+    changes = get_mapped_roster_changes(db_h, [(course[0], None)], since, print=False)
+    assert sorted(changes.idnumber) == sorted([dropped, audit])
+    assert set(changes[changes.idnumber == dropped].role.isna()) == {True}
+
+    db_h.now = datetime(2021, 1, 5, 0, 3)
+    after = pull()
+    assert extract.last_pull == 'delta'
+    assert dropped not in after[course]['student']
+    assert audit in after[course]['auditingstudent'] and audit not in after[course]['student']
+    # revised before the watermark overlap, left for the next full refresh
+    assert early in after[course]['student']
+    assert {k: v for k, v in after.items() if k != course} == {
+        k: v for k, v in before.items() if k != course}
+
+    extract.rosters = None
+    refreshed = pull()
+    assert extract.last_pull == 'full'
+    assert refreshed[course]['student'] == after[course]['student'] - {early}
+    assert refreshed[course]['auditingstudent'] == after[course]['auditingstudent']
+
+
+def test_program_pulls_bypass_the_query_cache(tmp_path):
+    path = str(tmp_path / 'pc.sqlite')
+    mapping = generate_mapping(10, sectioned=0)
+    rows, _, _ = generate_enrollments(mapping, students=10, audit=0)
+    write_powercampus(path, rows)
+    db_h = ClockedPcConnect(path, query_cache=QueryCache())
+    # e.g. a notebook reading the program memberships through the cache
+    get_students_by_program(db_h, print=False)
+    extract = IncrementalExtract('programs', path=str(tmp_path / 'programs.pkl'), overlap=300)
+
+    def pull():
+        se = SyncNonAcademicEnrollments({}, db_h=db_h, conduit=object(), pc_cache=extract)
+        return {key: roles['student'] for key, roles in se.get_pc_rosters().items()}
+
+    chiro = sorted(get_students_by_program(db_h, print=False)
+                   .query("program == 'CHIRO'").idnumber)[0]
+    revise(path, "UPDATE ACADEMIC SET {revision}, CURRICULUM = 'NUTRIT' "
+                 "WHERE PEOPLE_CODE_ID = ?", datetime(2021, 1, 4, 12, 5), f'P{chiro}')
+    db_h.now = datetime(2021, 1, 4, 12, 10)
+    programs = pull()
+    assert extract.last_pull == 'full'
+    assert chiro in programs['NUTRIT'] and chiro not in programs['CHIRO']
+
+    # the delta starts from the full read, so the change is kept
+    db_h.now = datetime(2021, 1, 4, 12, 30)
+    programs = pull()
+    assert extract.last_pull == 'delta'
+    assert chiro in programs['NUTRIT'] and chiro not in programs['CHIRO']
@@ -0,0 +1,79 @@
+from mdlpipeline.sync.ledger import PendingLedger
+from mdlpipeline.sync.rosters import RosterStore
+
+import threading
+
+import pandas as pd
+
+COLUMNS = ['action', 'shortname', 'idnumber', 'role']
+
+
+def conduit_df(records):
+    return pd.DataFrame(records, columns=COLUMNS)
+
+
+def test_pending_records_are_subtracted_until_confirmed(tmp_path):
+    path = str(tmp_path / 'ledger.json')
+    ledger = PendingLedger(path, ttl=60)
+    ledger.record(conduit_df([['add', 'BSC', '0001', 'student'],
+                              ['drop', 'BSC', '0002', 'student']]), now=0)
+    ledger.save()
+
+    ledger = PendingLedger(path, ttl=60)
+    df = conduit_df([['add', 'BSC', '0001', 'student'], ['drop', 'BSC', '0002', 'student'],
+                     ['add', 'BSC', '0003', 'student']])
+    assert ledger.subtract(df).idnumber.tolist() == ['0003']
+
+    # Moodle now has 0001 enrolled but still has 0002
+    rosters = RosterStore.from_rosters({4748: {'student': ['0001', '0002']}})
+    ledger.confirm(rosters, {'BSC': 4748})
+    assert list(ledger.entries) == [('drop', 'BSC', '0002', 'student')]
+
+    # courses without a successful pull are left pending
+    ledger.confirm(RosterStore(), {})
+    assert len(ledger) == 1
+
+
+def test_expired_records_are_resent():
+    ledger = PendingLedger('unused.json', ttl=60)
+    ledger.record(conduit_df([['add', 'BSC', '0001', 'student']]), now=0)
+    ledger.expire(now=30)
+    assert len(ledger) == 1
+    ledger.expire(now=60)
+    df = conduit_df([['add', 'BSC', '0001', 'student']])
+    assert ledger.subtract(df).equals(df)
+
+
+def test_keep_pending_of_other_pulls():
+    ledger = PendingLedger('unused.json', ttl=60)
+    ledger.record(conduit_df([['add', 'BSC', '0001', 'student'],
+                              ['drop', 'BSC', '0002', 'student'],
+                              ['add', 'CHEM', '0003', 'student']]))
+    ledger.keep_pending(['BSC'], [('drop', 'BSC', '0002', 'student')])
+    assert sorted(ledger.entries) == [('add', 'CHEM', '0003', 'student'),
+                                      ('drop', 'BSC', '0002', 'student')]
+
+
+def test_concurrent_pushes_and_diffs(tmp_path):
+    ledger = PendingLedger(str(tmp_path / 'ledger.json'), ttl=60)
+    rosters = RosterStore.from_rosters({4748: {'student': []}})
+    df = conduit_df([['add', 'BSC', '0001', 'student']])
+
+    def push(worker):
+        for i in range(200):
+            ledger.record(conduit_df([['add', 'BSC', f'{worker}{i:04d}', 'student']]))
+            ledger.save()
+
+    pushes = [threading.Thread(target=push, args=(worker,)) for worker in 'ab']
+    for thread in pushes:
+        thread.start()
+    # diffs expire, confirm and subtract while the pushes record
+    while any(thread.is_alive() for thread in pushes):
+        ledger.expire()
+        ledger.confirm(rosters, {'BSC': 4748})
+        assert ledger.subtract(df).equals(df)
+        ledger.shortnames()
+    for thread in pushes:
+        thread.join()
+    assert len(ledger) == 400
+    assert len(PendingLedger(ledger.path)) == 400
@@ -0,0 +1,44 @@
+from mdlpipeline.sync.mapping import MappingIndex, MappingFile, MappingError
+
+import json
+import os
+import pytest
+
+MAPPING = {
+    "COUN6552COUN855202Winter2021": {"courses": ["COUN6552", "COUN8552"], "section": "02", "id": 4766},
+    "COUN6552Winter2021": {"courses": ["COUN6552"], "id": 4767},
+    "BSC5102Winter2021": {"courses": ["BSC5102", "COUN6552"], "id": 4748},
+}
+
+
+def test_lookups():
+    index = MappingIndex(MAPPING)
+    assert index.ids["BSC5102Winter2021"] == 4748
+    assert index.shortnames[4766] == "COUN6552COUN855202Winter2021"
+    assert index.course_keys == [("COUN6552", "02"), ("COUN8552", "02"),
+                                 ("COUN6552", None), ("BSC5102", None)]
+    assert index.pc_keys("COUN6552Winter2021") == [("COUN6552", "")]
+    assert index.key_shortnames[("COUN6552", "")] == ["COUN6552Winter2021",
+                                                      "BSC5102Winter2021"]
+    assert dict(index) == MAPPING
+
+
+def test_validation_lists_problems():
+    with pytest.raises(MappingError) as err:
+        MappingIndex({"A": {"courses": [], "id": 1}, "B": {"courses": ["X"], "id": 1}})
+    assert '"courses"' in str(err.value) and 'already used by A' in str(err.value)
+
+
+def test_file_recompiled_only_on_change(tmp_path):
+    path = tmp_path / 'mapping.json'
+    path.write_text(json.dumps(MAPPING))
+    mapping_file = MappingFile(str(path))
+    index = mapping_file.load()
+    assert mapping_file.load() is index
+
+    # touched but unchanged content keeps the compiled index
+    os.utime(path, ns=(0, 0))
+    assert mapping_file.load() is index
+
+    path.write_text(json.dumps({"BSC5102Winter2021": MAPPING["BSC5102Winter2021"]}))
+    assert list(mapping_file.load()) == ["BSC5102Winter2021"]
@@ -0,0 +1,204 @@
+from mdlpipeline.utils.mdltools.mdl_connect import *
+from mdlpipeline.sync.enrollments import SyncEnrollments
+
+from aiohttp import ClientConnectionError
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+import asyncio
+import json
+import random
+import time
+import pytest
+
+
+class ChunkedStream():
+    """Minimal stand-in for `aiohttp.StreamReader`."""
+    def __init__(self, payload, size):
+        self.payload = payload
+        self.size = size
+
+    async def iter_chunked(self, chunk_size):
+        for i in range(0, len(self.payload), self.size):
+            yield self.payload[i:i + self.size]
+
+
+async def collect(stream):
+    return [item async for item in iter_json_array(stream)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 64, 10000])
+def test_iter_json_array(size):
+    users = [{"id": i, "idnumber": f"00{i}", "fullname": "Zoë",
+              "roles": [{"roleid": 5}]} for i in range(20)]
+    payload = json.dumps(users, indent=2, ensure_ascii=False).encode()
+    assert asyncio.run(collect(ChunkedStream(payload, size))) == users
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5])
+def test_iter_json_array_scalars_across_chunks(size):
+    items = [12345, -6.5e10, True, False, None, "a,b]", 7, [1, 23], {"k": 456}, 0]
+    payload = json.dumps(items).encode()
+    assert asyncio.run(collect(ChunkedStream(payload, size))) == items
+    assert asyncio.run(collect(ChunkedStream(b' [ 123 ,\n456 ] ', size))) == [123, 456]
+
+
+def test_iter_json_array_large_item():
+    items = [{"id": 1, "roles": list(range(5000))}, 2]
+    payload = json.dumps(items).encode()
+    assert asyncio.run(collect(ChunkedStream(payload, 7))) == items
+    assert asyncio.run(collect(ChunkedStream(b'[]', 1))) == []
+
+
+def test_iter_json_array_exception():
+    payload = json.dumps({"exception": "moodle_exception"}).encode()
+    assert asyncio.run(collect(ChunkedStream(payload, 4))) == [{"exception": "moodle_exception"}]
+
+
+@pytest.mark.parametrize("payload", [
+    b'[{"id": 1}, {"id": 2}, {"id": 3, "idn',
+    b'[{"id": 1}, <b>Notice</b>: Undefined index]',
+    b'[{"id": 1}',
+    b'[{"id": 1}] <b>Notice</b>',
+    b'[{"id": 1} {"id": 2}]',
+    b'',
+    b'  \n',
+])
+@pytest.mark.parametrize("size", [1, 5, 10000])
+def test_iter_json_array_malformed(payload, size):
+    with pytest.raises(json.JSONDecodeError):
+        asyncio.run(collect(ChunkedStream(payload, size)))
+
+
+def test_roster_signature():
+    assert roster_signature([3, 1, 2]) == roster_signature({1, 2, 3})
+    assert roster_signature([1, 2]) != roster_signature([1, 2, 3])
+
+
+class FakeResponse():
+    """Minimal stand-in for `aiohttp.ClientResponse`."""
+    def __init__(self, status, payload=None):
+        self.status = status
+        self.payload = payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise ClientResponseError(SimpleNamespace(real_url=URL), (), status=self.status)
+
+    async def json(self):
+        return self.payload
+
+
+class FakeSession():
+    """Session answering POSTs from a list of outcomes, an HTTP status or
+    an exception each, then 200 with the posted courseid."""
+    def __init__(self, outcomes=(), delay=0):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.posts = 0
+
+    def post(self, url, data):
+        self.posts += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        return self.respond(outcome, data)
+
+    @asynccontextmanager
+    async def respond(self, outcome, data):
+        await asyncio.sleep(self.delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        yield FakeResponse(outcome, [data['courseid']])
+
+
+def make_client(session, **kwargs):
+    kwargs = {'backoff': 0.001, **kwargs}
+    return MdlWebServicesClient('core_enrol_get_enrolled_users', 'courseid', [7],
+                                session=session, **kwargs)
+
+
+def test_post_retries_transient_errors():
+    session = FakeSession([503, asyncio.TimeoutError(), ClientConnectionError(), 429])
+    client = make_client(session)
+    assert asyncio.run(client.fetch_all()) == {7: [7]}
+    assert session.posts == 5
+    assert client.errors == []
+
+
+def test_post_does_not_retry_client_errors():
+    session = FakeSession([404])
+    client = make_client(session)
+    assert asyncio.run(client.fetch_all()) == {}
+    assert session.posts == 1
+    assert client.errors == [7]
+
+
+def test_post_gives_up_after_retries():
+    session = FakeSession([503] * 10)
+    client = make_client(session, retries=2)
+    assert asyncio.run(client.fetch_all()) == {}
+    assert session.posts == 3
+    assert client.errors == [7]
+
+
+@pytest.mark.parametrize("attempt", [0, 1, 3, 10, 30])
+def test_backoff_delay_bounds(attempt):
+    client = make_client(None, backoff=0.5)
+    bound = min(BACKOFF_MAX, 0.5 * 2 ** attempt)
+    random.seed(attempt)
+    delays = [client.backoff_delay(attempt) for _ in range(200)]
+    assert all(0 <= delay <= bound for delay in delays)
+    # full jitter spreads delays over the whole range
+    assert max(delays) > bound / 2
+
+
+def test_post_budget_stops_retries():
+    session = FakeSession([503] * 10)
+    client = make_client(session, backoff=10, retries=10, time_budget=0.5)
+    start = time.monotonic()
+    assert asyncio.run(client.fetch_all()) == {}
+    # the first backoff already overruns the budget unless it jitters to ~0
+    assert time.monotonic() - start < 5.5
+    assert client.errors == [7]
+
+
+def test_post_budget_checked_after_queueing():
+    # one slot and requests slower than the budget: requests queued on the
+    # semaphore past the deadline give up without being sent
+    session = FakeSession(delay=0.2)
+    client = MdlWebServicesClient('core_enrol_get_enrolled_users', 'courseid', [1, 2, 3, 4],
+                                  session=session, concurrency=1, time_budget=0.1)
+    assert asyncio.run(client.fetch_all()) == {1: [1]}
+    assert session.posts == 1
+    assert client.errors == [2, 3, 4]
+
+
+class RosterSession():
+    """Session answering every course with its raw response body."""
+    def __init__(self, bodies):
+        self.bodies = bodies
+
+    @asynccontextmanager
+    async def post(self, url, data):
+        yield SimpleNamespace(raise_for_status=lambda: None,
+                              content=ChunkedStream(self.bodies[data['courseid']], 16))
+
+
+def test_malformed_roster_is_a_pull_error():
+    users = [{'id': i, 'idnumber': f'000{i}', 'roles': [{'roleid': 5}]} for i in range(3)]
+    body = json.dumps(users).encode()
+    session = RosterSession({1: body, 2: body[:-20],
+                             3: body[:30] + b'<b>Notice</b>: Undefined index' + body[30:]})
+    mapping = {f'BSC510{i}Winter2021': {'courses': [f'BSC510{i}'], 'id': i} for i in (1, 2, 3)}
+    se = SyncEnrollments(mapping, session=session, conduit=object())
+    se.wc_rosters = asyncio.run(se.get_wc_rosters())
+    assert sorted(se.wc_pull_errors) == [2, 3]
+    se.pc_rosters = {(f'BSC510{i}', ''): {'student': {'0000'}} for i in (1, 2, 3)}
+    df = se.get_conduit_diff(('student',))
+    # only the roster that parsed is diffed, the others are not dropped
+    assert set(zip(df.action, df.shortname, df.idnumber)) == {
+        ('drop', 'BSC5101Winter2021', '0001'), ('drop', 'BSC5101Winter2021', '0002')}
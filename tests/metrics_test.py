@@ -0,0 +1,37 @@
+from mdlpipeline.utils.metrics import Registry
+
+import pytest
+
+
+def test_render_prometheus_text(tmp_path):
+    registry = Registry()
+    errors = registry.counter('moodle_request_errors_total', 'Failed requests',
+                              ['wsfunction', 'error'])
+    errors.inc(wsfunction='core_enrol_get_enrolled_users', error='503')
+    errors.inc(2, wsfunction='core_enrol_get_enrolled_users', error='503')
+    registry.gauge('sync_changes', 'Changes', ['role']).set(4, role='say "hi"\n')
+    latency = registry.histogram('moodle_request_seconds', 'Latency', buckets=(0.1, 1))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    assert registry.counter('moodle_request_errors_total', 'Failed requests',
+                            ['wsfunction', 'error']) is errors
+    text = registry.render()
+    assert '# TYPE moodle_request_errors_total counter' in text
+    assert ('moodle_request_errors_total{wsfunction="core_enrol_get_enrolled_users",'
+            'error="503"} 3') in text
+    assert 'sync_changes{role="say \\"hi\\"\\n"} 4' in text
+    assert 'moodle_request_seconds_bucket{le="0.1"} 1' in text
+    assert 'moodle_request_seconds_bucket{le="+Inf"} 2' in text
+    assert 'moodle_request_seconds_sum 0.55' in text
+    assert 'moodle_request_seconds_count 2' in text
+    registry.write_textfile(str(tmp_path / 'sync.prom'))
+    assert (tmp_path / 'sync.prom').read_text() == text
+
+
+def test_labels_must_match():
+    registry = Registry()
+    counter = registry.counter('sync_cycles_total', 'Cycles')
+    with pytest.raises(ValueError):
+        counter.inc(job='enrollments')
+    with pytest.raises(ValueError):
+        registry.gauge('sync_cycles_total', 'Cycles')
@@ -0,0 +1,160 @@
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.sync.partition import (WorkQueue, partition_mapping, run_local,
+                                        merge_partitions, work)
+from mdlpipeline.sync.ledger import PendingLedger
+
+import asyncio
+import json
+import pickle
+import threading
+import time
+import pandas as pd
+import pytest
+
+MAPPING = {f'BSC{5100 + i}Winter2021': {'courses': [f'BSC{5100 + i}'], 'id': 4700 + i}
+           for i in range(12)}
+
+
+class LocalSync(SyncEnrollments):
+    """Pipeline with made up rosters: every Moodle course has idnumber
+    "0001", PowerCampus has "0002" in every course."""
+    async def get_wc_rosters(self):
+        return {courseid: {'student': {'0001'}, 'auditingstudent': set()}
+                for courseid in self.courseids}
+
+    def get_pc_rosters(self):
+        keys = self.get_course_keys()
+        return self.transform_rosters(pd.DataFrame(
+            {'course': [course for course, _ in keys], 'section': [''] * len(keys),
+             'role': 'student', 'idnumber': '0002'}))
+
+
+def write_mapping(tmp_path):
+    path = tmp_path / 'mapping.json'
+    path.write_text(json.dumps(MAPPING))
+    return str(path)
+
+
+def sorted_diff(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_partitions_are_deterministic_and_complete():
+    parts = partition_mapping(MAPPING, 3)
+    assert parts == partition_mapping(MAPPING, 3)
+    assert sorted(shortname for part in parts for shortname in part) == sorted(MAPPING)
+    by_id = partition_mapping(MAPPING, 3, by='courseid')
+    assert all(entry['id'] % 3 == i for i, part in enumerate(by_id) for entry in part.values())
+
+
+def test_each_partition_is_claimed_once(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    run = queue.submit('mapping.json', partitions=3)
+    claims = [queue.claim('a'), queue.claim('b'), queue.claim('a'), queue.claim('b')]
+    assert [task['partition'] for task in claims[:3]] == [0, 1, 2] and claims[3] is None
+    queue.finish(run, 0, result='0.pkl')
+    queue.finish(run, 1, error='boom')
+    assert queue.tasks(run).status.tolist() == ['done', 'failed', 'running']
+    assert not queue.wait(run, timeout=0)
+
+
+def test_local_workers_match_single_process_pull(tmp_path):
+    mapping_path = write_mapping(tmp_path)
+    ledger_path = str(tmp_path / 'ledger.json')
+    ledger = PendingLedger(ledger_path)
+    # already pushed and still pending in Moodle, so left out of the diff
+    ledger.record(pd.DataFrame([['add', 'BSC5100Winter2021', '0002', 'student']],
+                               columns=['action', 'shortname', 'idnumber', 'role']))
+    ledger.save()
+    se = run_local(mapping_path, workers=3, sync_class=LocalSync, partitions=4,
+                   queue_path=str(tmp_path / 'queue.sqlite'), cache_dir=str(tmp_path),
+                   ledger_path=ledger_path, push=False)
+    single = asyncio.run(LocalSync.pull(MAPPING, ledger=PendingLedger(ledger_path)))
+    merged = se.conduit_dfs['enrollments']
+    assert len(merged) == 2 * len(MAPPING) - 1
+    assert sorted_diff(merged).equals(sorted_diff(single.conduit_dfs['enrollments']))
+
+
+def test_new_run_cancels_earlier_run(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    old = queue.submit('mapping.json', partitions=2)
+    stale = queue.claim('a')
+    other = queue.submit('other.json', partitions=1)
+    run = queue.submit('mapping.json', partitions=2)
+    assert queue.tasks(old).status.tolist() == ['cancelled', 'cancelled']
+    assert queue.wait(old, timeout=0)
+    # the worker of the cancelled run cannot mark it done
+    assert not queue.finish(old, stale['partition'], result='0.pkl', worker='a')
+    assert queue.claim('b', run=run)['run'] == run
+    assert queue.claim('b')['run'] == other
+    assert queue.claim('b')['run'] == run
+    assert queue.claim('b', run=run) is None
+
+
+def test_lease_is_renewed_while_pulling(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), lease=0.2)
+    run = queue.submit('mapping.json', partitions=1)
+    queue.claim('a')
+    for _ in range(3):
+        time.sleep(0.1)
+        assert queue.renew(run, 0, 'a')
+        assert queue.claim('b') is None
+    time.sleep(0.25)
+    assert queue.claim('b')['partition'] == 0
+    # the lease moved on, so the first worker can neither renew nor finish
+    assert not queue.renew(run, 0, 'a')
+    assert not queue.finish(run, 0, result='a.pkl', worker='a')
+    assert queue.finish(run, 0, result='b.pkl', worker='b')
+
+
+class SlowSync(LocalSync):
+    async def get_wc_rosters(self):
+        await asyncio.sleep(0.5)
+        return await super().get_wc_rosters()
+
+
+def test_worker_heartbeat_keeps_its_partition(tmp_path):
+    mapping_path = write_mapping(tmp_path)
+    queue_path = str(tmp_path / 'queue.sqlite')
+    queue = WorkQueue(queue_path, lease=0.15)
+    run = queue.submit(mapping_path, sync_class=SlowSync, partitions=1)
+    worker = threading.Thread(target=work, args=(queue_path, str(tmp_path),
+                                                 str(tmp_path / 'ledger.json')),
+                              kwargs={'worker': 'a', 'run': run, 'lease': 0.15})
+    worker.start()
+    while queue.tasks(run).status.tolist() == ['queued']:
+        time.sleep(0.01)
+    claims = []
+    while worker.is_alive():
+        claims.append(queue.claim('b', run=run))
+        time.sleep(0.05)
+    worker.join()
+    assert claims and not any(claims)
+    assert queue.tasks(run).worker.tolist() == ['a']
+    assert queue.tasks(run).status.tolist() == ['done']
+
+
+def test_merge_waits_for_running_partitions(tmp_path):
+    mapping_path = write_mapping(tmp_path)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    run = queue.submit(mapping_path, sync_class=LocalSync, partitions=2)
+    results = []
+    for worker in ('a', 'b'):
+        task = queue.claim(worker, run=run)
+        path = str(tmp_path / f'{worker}.pkl')
+        df = pd.DataFrame([['add', f'BSC510{task["partition"]}Winter2021', '0002', 'student']],
+                          columns=['action', 'shortname', 'idnumber', 'role'])
+        with open(path, 'wb') as f:
+            pickle.dump({'conduit_dfs': {'enrollments': df}, 'wc_userids': {},
+                         'shortnames': [], 'pending': []}, f)
+        results.append((task['partition'], path))
+    queue.finish(run, *results[0][:1], result=results[0][1], worker='a')
+
+    with pytest.raises(TimeoutError):
+        merge_partitions(queue, run, timeout=0)
+    finisher = threading.Timer(0.3, queue.finish, args=(run, results[1][0]),
+                               kwargs={'result': results[1][1], 'worker': 'b'})
+    finisher.start()
+    se = merge_partitions(queue, run)
+    finisher.join()
+    assert len(se.conduit_dfs['enrollments']) == 2
@@ -0,0 +1,212 @@
+from mdlpipeline.utils.sqltools import pc_connect
+from mdlpipeline.utils.sqltools.pc_connect import PcConnect
+from mdlpipeline.utils.sqltools.query_tools import Query, TempTable
+
+import pymssql
+import pytest
+
+
+class FakeCursor():
+    """Cursor of a `FakeConnection` returning `rows` for every query."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = [('value',)]
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params=None):
+        if not self.conn.alive:
+            raise pymssql.OperationalError('connection dropped')
+        self.conn.statements.append(sql)
+        self.conn.params.append(params)
+        self.rows = list(self.conn.rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeConnection():
+    """Stand-in for a pymssql connection recording its statements."""
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+        self.statements = []
+        self.params = []
+        self.rows = [(1,), (2,), (3,)]
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if not self.alive:
+            raise pymssql.OperationalError('connection dropped')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePcConnect(PcConnect):
+    def __init__(self, pool_size=2):
+        super().__init__('test', user='user', password='password', pool_size=pool_size)
+        self.connections = []
+
+    def get_connection(self):
+        self.connections.append(FakeConnection(len(self.connections)))
+        return self.connections[-1]
+
+
+def test_pool_reuses_last_released_connection():
+    db_h = FakePcConnect()
+    first, second = db_h.acquire(), db_h.acquire()
+    db_h.release(first)
+    db_h.release(second)
+    assert db_h.acquire() is second
+    assert db_h.acquire() is first
+    assert len(db_h.connections) == 2
+
+
+def test_pool_is_bounded(monkeypatch):
+    monkeypatch.setattr(pc_connect, 'POOL_TIMEOUT', 0.05)
+    db_h = FakePcConnect(pool_size=1)
+    db_h.acquire()
+    with pytest.raises(TimeoutError):
+        db_h.acquire()
+    assert len(db_h.connections) == 1
+
+
+def test_idle_connections_are_health_checked(monkeypatch):
+    db_h = FakePcConnect()
+    conn = db_h.acquire()
+    db_h.release(conn)
+    assert db_h.acquire() is conn and conn.statements == []
+    db_h.release(conn)
+
+    monkeypatch.setattr(pc_connect, 'HEALTH_CHECK_AFTER', 0)
+    assert db_h.acquire() is conn and conn.statements == ['SELECT 1']
+    db_h.release(conn)
+
+
+def test_dropped_connections_are_replaced(monkeypatch):
+    monkeypatch.setattr(pc_connect, 'HEALTH_CHECK_AFTER', 0)
+    db_h = FakePcConnect(pool_size=1)
+    conn = db_h.acquire()
+    db_h.release(conn)
+    conn.alive = False
+    fresh = db_h.acquire()
+    assert fresh is not conn and conn.closed
+    assert db_h._opened == 1
+
+
+def test_released_connections_are_clean():
+    db_h = FakePcConnect(pool_size=1)
+    query = Query('SELECT value FROM #keys',
+                  tables=[TempTable('#keys', [('value', 'int')], [(1,), (2,)])])
+    assert db_h.get_list(query) == [1, 2, 3]
+    conn = db_h.connections[0]
+    assert conn.statements[-2:] == [
+        'SELECT value FROM #keys',
+        "IF OBJECT_ID('tempdb..#keys') IS NOT NULL DROP TABLE #keys"]
+    assert conn.statements[0] == conn.statements[-1]
+    assert conn.rollbacks == 1
+    assert db_h.acquire() is conn
+
+
+def test_connections_are_rolled_back_on_error():
+    db_h = FakePcConnect(pool_size=1)
+    with pytest.raises(ValueError):
+        with db_h.connection():
+            raise ValueError('query failed')
+    conn = db_h.connections[0]
+    assert conn.rollbacks == 1 and not conn.closed
+
+    # a connection which cannot be rolled back is not reused
+    with pytest.raises(ValueError):
+        with db_h.connection() as conn:
+            conn.alive = False
+            raise ValueError('connection dropped')
+    assert conn.closed and db_h._opened == 0
+    assert db_h.acquire() is not conn
+
+
+def test_streaming_closed_early_releases_connection():
+    db_h = FakePcConnect(pool_size=1)
+    batches = db_h.iter_records('SELECT value FROM t', batch_size=1)
+    assert next(batches) == [(1,)]
+    batches.close()
+    conn = db_h.connections[0]
+    assert conn.rollbacks == 1
+    assert db_h.acquire() is conn
+
+
+def test_close_discards_connections():
+    db_h = FakePcConnect()
+    borrowed, idle = db_h.acquire(), db_h.acquire()
+    db_h.release(idle)
+    db_h.close()
+    assert idle.closed and not borrowed.closed
+    db_h.release(borrowed)
+    assert borrowed.closed and db_h._opened == 0
+    with pytest.raises(RuntimeError):
+        db_h.acquire()
+
+
+def test_iter_df_streams_typed_batches():
+    db_h = FakePcConnect(pool_size=1)
+    conn = db_h.acquire()
+    conn.rows = [(str(i),) for i in range(5)]
+    db_h.release(conn)
+    batches = db_h.iter_df('SELECT value FROM t', batch_size=2, dtype={'value': 'int64'})
+    first = next(batches)
+    # nothing beyond the first batch is fetched before it is consumed
+    assert first.value.tolist() == [0, 1] and str(first.value.dtype) == 'int64'
+    assert db_h._pool.empty()
+    assert [df.value.tolist() for df in batches] == [[2, 3], [4]]
+    assert db_h.acquire() is conn
+
+
+def test_temp_tables_are_loaded_in_batches(monkeypatch):
+    monkeypatch.setattr(pc_connect, 'INSERT_BATCH', 2)
+    db_h = FakePcConnect(pool_size=1)
+    keys = [('ENG101', None), ('MAT201', '01'), ('BIO110', None)]
+    query = Query('SELECT 1 FROM #course_keys WHERE term = @term',
+                  [('term', 'nvarchar(20)', 'Winter')],
+                  [TempTable('#course_keys', [('EVENT_ID', 'nvarchar(20) NOT NULL'),
+                                              ('SECTION', 'nvarchar(10) NULL')], keys)])
+    db_h.get_records(query)
+    conn = db_h.connections[0]
+    assert conn.statements[:4] == [
+        "IF OBJECT_ID('tempdb..#course_keys') IS NOT NULL DROP TABLE #course_keys",
+        'CREATE TABLE #course_keys (EVENT_ID nvarchar(20) NOT NULL, SECTION nvarchar(10) NULL)',
+        'INSERT INTO #course_keys VALUES (%s, %s), (%s, %s)',
+        'INSERT INTO #course_keys VALUES (%s, %s)']
+    assert conn.params[2:4] == [('ENG101', None, 'MAT201', '01'), ('BIO110', None)]
+    # parameters go through sp_executesql so the plan is reused
+    assert conn.statements[4] == 'EXEC sp_executesql %s, %s, @term=%s'
+    assert conn.params[4] == ('SELECT 1 FROM #course_keys WHERE term = @term',
+                              '@term nvarchar(20)', 'Winter')
+
+
+@pytest.mark.parametrize('getter, rows', [
+    ('get_records', 3), ('get_record', 1), ('get_value', 1), ('get_list', 3), ('get_df', 3)])
+def test_getters_record_query_metrics(getter, rows):
+    db_h = FakePcConnect()
+    name = f'{getter}_metrics'
+    getattr(db_h, getter)(Query('SELECT value FROM test', name=name))
+    assert pc_connect.QUERY_SECONDS.get(query=name)[-2] == 1
+    assert pc_connect.QUERY_ROWS.get(query=name) == rows
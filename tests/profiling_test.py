@@ -0,0 +1,54 @@
+from mdlpipeline.utils import profiling
+from mdlpipeline.utils.profiling import Profiler
+
+import asyncio
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+import pytest
+
+
+def test_profiler_writes_comparable_files(tmp_path):
+    async def stage():
+        await asyncio.sleep(0.02)
+        # blocks the event loop, which shows as lag
+        time.sleep(0.1)
+        await asyncio.sleep(0.02)
+        return [str(i) for i in range(10000)]
+
+    async def run():
+        async with Profiler('pull', str(tmp_path), interval=0.002, lag_interval=0.01) as profiler:
+            rows = await stage()
+            profiling.mark('extract')
+            del rows
+            profiling.mark('diff')
+        return profiler
+
+    profiler = asyncio.run(run())
+    assert profiling.active() is None and not tracemalloc.is_tracing()
+    files = set(os.listdir(profiler.path))
+    assert {'cprofile.pstats', 'cprofile.txt', 'wall.folded', 'tasks.folded',
+            'loop_lag.json', 'summary.json', 'tracemalloc-00-extract.snap',
+            'tracemalloc-01-diff.txt', 'tracemalloc-02-end.snap'} <= files
+
+    stats = pstats.Stats(os.path.join(profiler.path, 'cprofile.pstats'))
+    assert any(name == 'stage' for _, _, name in stats.stats)
+    with open(os.path.join(profiler.path, 'tasks.folded')) as f:
+        assert 'profiling_test.py:test_profiler_writes_comparable_files.<locals>.run' in f.read()
+    with open(os.path.join(profiler.path, 'summary.json')) as f:
+        summary = json.load(f)
+    assert [stage['stage'] for stage in summary['stages']] == ['extract', 'diff', 'end']
+    assert summary['loop_lag']['max'] >= 0.05
+    assert summary['samples'] > 0
+    snapshot = tracemalloc.Snapshot.load(os.path.join(profiler.path, 'tracemalloc-00-extract.snap'))
+    assert snapshot.statistics('lineno')
+
+
+def test_profilers_do_not_nest(tmp_path):
+    with Profiler('outer', str(tmp_path)):
+        with pytest.raises(RuntimeError):
+            Profiler('inner', str(tmp_path)).start()
+    assert profiling.active() is None
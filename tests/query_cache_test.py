@@ -0,0 +1,56 @@
+from benchmarks.fakes import SqlitePcConnect
+from benchmarks.generate import generate_mapping, generate_enrollments, write_powercampus
+from mdlpipeline.utils.sqltools.queries import get_courses, get_students_by_program
+from mdlpipeline.utils.sqltools.query_cache import QueryCache, normalize_sql
+
+import time
+
+import pandas as pd
+
+
+def make_db(tmp_path, query_cache):
+    rows, _, _ = generate_enrollments(generate_mapping(5), students=10)
+    write_powercampus(str(tmp_path / 'pc.sqlite'), rows)
+    return SqlitePcConnect(str(tmp_path / 'pc.sqlite'), query_cache)
+
+
+def test_decorated_queries_are_served_from_cache(tmp_path):
+    db_h = make_db(tmp_path, QueryCache(path=str(tmp_path / 'cache')))
+    courses = get_courses(db_h)
+    courses['EVENT_ID'] = None
+    assert get_courses(db_h).EVENT_ID.notna().all()
+    assert db_h.queries == 1
+    get_courses(db_h, cache_ttl=0)
+    get_courses(db_h, term='Spring')
+    assert db_h.queries == 3
+
+    # a restarted process finds the results on disk
+    restarted = SqlitePcConnect(db_h.path, QueryCache(path=str(tmp_path / 'cache')))
+    assert len(get_courses(restarted)) == len(courses)
+    get_students_by_program(restarted, print=False)
+    assert restarted.queries == 1
+    restarted.query_cache.invalidate('get_students_by_program')
+    get_courses(restarted)
+    get_students_by_program(restarted, print=False)
+    assert restarted.queries == 2
+
+
+def test_entries_expire_and_evict_least_recently_used():
+    cache = QueryCache(max_bytes=3 * 1500)
+    frames = {name: pd.DataFrame({'idnumber': [f'{i:07d}' for i in range(20)]})
+              for name in 'abcd'}
+    for name in 'abc':
+        cache.put(name, frames[name], 60, name)
+    assert cache.size <= cache.max_bytes
+    cache.get('a', 'a')
+    cache.put('d', frames['d'], 60, 'd')
+    assert cache.get('b', 'b') is None
+    assert cache.get('a', 'a').equals(frames['a'])
+    cache.put('e', [1, 2], 0.01, 'e')
+    time.sleep(0.02)
+    assert cache.get('e', 'e') is None
+
+
+def test_normalize_sql_keeps_literals():
+    assert (normalize_sql("SELECT  *\n  FROM t WHERE name = N'a   b'  ")
+            == "SELECT * FROM t WHERE name = N'a   b'")
@@ -0,0 +1,55 @@
+from mdlpipeline.sync.rosters import IdInterner, RosterStore, MISSING
+
+import pickle
+import pandas as pd
+
+
+def test_add_frame_matches_sets():
+    df = pd.DataFrame([('0001', 'BSC', '01', 'student'), ('0002', 'BSC', '01', 'student'),
+                       ('0001', 'BSC', '', 'auditingstudent'), ('0001', 'BSC', '01', 'student')],
+                      columns=['idnumber', 'course', 'section', 'role'])
+    store = RosterStore()
+    store.add_frame(df, ['course', 'section'])
+    assert {key: dict(roles) for key, roles in store.items()} == {
+        ('BSC', '01'): {'student': {'0001', '0002'}},
+        ('BSC', ''): {'auditingstudent': {'0001'}}}
+
+
+def test_discard_and_update():
+    store = RosterStore.from_rosters({'A': {'student': ['1', '2']}, 'B': {'student': ['2', '3']}})
+    store.discard('A', store.interner.encode(['1']))
+    assert store['A']['student'] == {'2'}
+
+    other = RosterStore.from_rosters({'A': {'student': ['9', '2']}})
+    store.update(other)
+    assert store['A']['student'] == {'2', '9'}
+
+
+def test_interner_pickles_codes():
+    interner = IdInterner()
+    codes = interner.encode(['0010', '0020', '0010'])
+    restored = pickle.loads(pickle.dumps(interner))
+    assert list(restored.encode(['0020', '0030'])) == [codes[1], 2]
+    assert list(restored.decode(codes)) == ['0010', '0020', '0010']
+
+
+def test_null_idnumbers_are_skipped():
+    # a null idnumber must not take the code of another student
+    interner = IdInterner()
+    codes = interner.encode(['0001', None, '0002', float('nan'), '', '0001'])
+    assert list(codes) == [0, MISSING, 1, MISSING, MISSING, 0]
+    assert interner.idnumbers == ['0001', '0002']
+    assert list(interner.encode([None])) == [MISSING]
+
+    df = pd.DataFrame([('0003', 'BSC', '01', 'student'), (None, 'BSC', '01', 'student'),
+                       ('0004', 'BSC', '01', 'student'), (None, 'ART', '', 'student'),
+                       ('', 'BSC', '01', 'auditingstudent')],
+                      columns=['idnumber', 'course', 'section', 'role'])
+    store = RosterStore(interner)
+    for chunk in (df[:2], df[2:]):
+        store.add_frame(chunk, ['course', 'section'])
+    assert {key: dict(roles) for key, roles in store.items()} == {
+        ('BSC', '01'): {'student': {'0003', '0004'}}}
+
+    store.add('ART', 'student', ['0005', None])
+    assert store['ART']['student'] == {'0005'}
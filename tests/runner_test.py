@@ -0,0 +1,144 @@
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.sync.ledger import PendingLedger
+from mdlpipeline.sync.mapping import MappingIndex
+from mdlpipeline.sync.runner import SyncRunner
+
+import asyncio
+import pickle
+import pandas as pd
+
+MAPPING = {
+    'BSC5102Winter2021': {'courses': ['BSC5102'], 'id': 4748},
+}
+SPRING = {
+    'BSC5102Spring2021': {'courses': ['BSC5102'], 'id': 4801},
+}
+
+
+def conduit_df(records):
+    return pd.DataFrame(records, columns=['action', 'shortname', 'idnumber', 'role'])
+
+
+class LocalSync(SyncEnrollments):
+    pushes = 0
+    pushed = []
+
+    async def push(self):
+        LocalSync.pushes += 1
+        LocalSync.pushed.append(len(self.conduit_dfs['enrollments']))
+
+
+def pipeline(mapping, term, records):
+    se = LocalSync(mapping, session=object(), conduit=object(), term=term, year='2021')
+    se.conduit_dfs['enrollments'] = conduit_df(records)
+    return se
+
+
+class FakeJob():
+    def __init__(self, name, se=None, fail=False, warm=None, duration=0.0):
+        self.name, self.se, self.fail = name, se, fail
+        self.warm, self.duration = warm, duration
+
+    async def pull(self, session, snapshot, ledger, executor=None):
+        await asyncio.sleep(self.duration)
+        if self.fail:
+            raise ValueError('mapping not found')
+        return self.se
+
+    async def warm_pull(self, session, ledger):
+        return self.warm
+
+
+class LocalRunner(SyncRunner):
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def test_merge_pushes_terms_together():
+    winter = pipeline(MAPPING, 'Winter', [['add', 'BSC5102Winter2021', '0001', 'student']])
+    spring = pipeline(SPRING, 'Spring', [['add', 'BSC5102Spring2021', '0001', 'student'],
+                                         ['drop', 'BSC5102Spring2021', '0002', 'student']])
+    winter.wc_userids['0001'] = 11
+    merged = LocalSync.merge([winter, spring])
+    assert merged.conduit is winter.conduit and merged.session is winter.session
+    assert set(merged.mapping) == {'BSC5102Winter2021', 'BSC5102Spring2021'}
+    assert merged.conduit_dfs['enrollments'].shortname.tolist() == [
+        'BSC5102Winter2021', 'BSC5102Spring2021', 'BSC5102Spring2021']
+    assert merged.wc_userids == {'0001': 11}
+
+
+def test_overlapping_jobs_push_per_mapping():
+    # one mapping file synced in two terms, and another file reusing its
+    # Moodle course under another shortname
+    mapping = MappingIndex(MAPPING, digest='wi21')
+    cohort = MappingIndex({'BSC5102Cohort': {'courses': ['BSC5102'], 'id': 4748}},
+                          digest='cohort')
+    add = ['add', 'BSC5102Winter2021', '0001', 'student']
+    winter = pipeline(mapping, 'Winter', [add])
+    intersession = pipeline(mapping, 'Intersession',
+                            [add, ['add', 'BSC5102Winter2021', '0002', 'student']])
+    other = pipeline(cohort, 'Winter', [['add', 'BSC5102Cohort', '0001', 'student']])
+    runner = LocalRunner([FakeJob('winter', winter), FakeJob('intersession', intersession),
+                          FakeJob('cohort', other)])
+    pushes = LocalSync.pushes
+    assert asyncio.run(runner.run()) == 3
+    assert LocalSync.pushes == pushes + 2 and LocalSync.pushed[-2:] == [2, 1]
+    merged, cohort_se = runner.last
+    assert merged.conduit_dfs['enrollments'].values.tolist() == [
+        add, ['add', 'BSC5102Winter2021', '0002', 'student']]
+    assert cohort_se is other
+
+
+def test_pickled_pipeline_leaves_connections_behind():
+    se = pickle.loads(pickle.dumps(pipeline(MAPPING, 'Winter', [])))
+    assert se.session is None and se.conduit is None
+    assert se.term == 'Winter' and list(se.mapping) == ['BSC5102Winter2021']
+
+
+def test_failed_job_does_not_stop_the_others():
+    winter = pipeline(MAPPING, 'Winter', [['add', 'BSC5102Winter2021', '0001', 'student']])
+    runner = LocalRunner([FakeJob('winter', winter), FakeJob('spring', fail=True)])
+    pushes = LocalSync.pushes
+    assert asyncio.run(runner.run()) == 1
+    assert LocalSync.pushes == pushes + 1
+    assert list(runner.failures) == ['spring']
+
+
+def test_first_run_pushes_saved_rosters_during_fresh_pull():
+    warm = pipeline(MAPPING, 'Winter', [['add', 'BSC5102Winter2021', '0001', 'student']])
+    fresh = pipeline(MAPPING, 'Winter', [['add', 'BSC5102Winter2021', '0001', 'student'],
+                                         ['add', 'BSC5102Winter2021', '0002', 'student']])
+    runner = LocalRunner([FakeJob('winter', fresh, warm=warm, duration=0.05)], warm_start=True)
+    assert asyncio.run(runner.run()) == 3
+    assert LocalSync.pushed[-2:] == [1, 2]
+    assert asyncio.run(runner.run()) == 2
+    assert LocalSync.pushed[-1] == 2 and LocalSync.pushed[-3:-1] == [1, 2]
+
+
+class RecordingSync(LocalSync):
+    async def push(self):
+        await asyncio.sleep(0.05)
+        await super().push()
+        self.ledger.record(self.conduit_dfs['enrollments'])
+
+
+def test_fresh_diff_leaves_out_warm_push_finished_after_it(tmp_path):
+    ledger = PendingLedger(str(tmp_path / 'ledger.json'))
+    warm = RecordingSync(MAPPING, session=object(), conduit=object(), ledger=ledger,
+                         term='Winter', year='2021')
+    warm.conduit_dfs['enrollments'] = conduit_df(
+        [['add', 'BSC5102Winter2021', '0001', 'student']])
+    fresh = RecordingSync(MAPPING, session=object(), conduit=object(), ledger=ledger,
+                          term='Winter', year='2021')
+    fresh.conduit_dfs['enrollments'] = conduit_df(
+        [['add', 'BSC5102Winter2021', '0001', 'student'],
+         ['add', 'BSC5102Winter2021', '0002', 'student']])
+    # the fresh pull is done before the warm push records its changes
+    runner = LocalRunner([FakeJob('winter', fresh, warm=warm)], warm_start=True)
+    runner.ledger = ledger
+    assert asyncio.run(runner.run()) == 2
+    assert LocalSync.pushed[-2:] == [1, 1]
+    assert fresh.conduit_dfs['enrollments'].idnumber.tolist() == ['0002']
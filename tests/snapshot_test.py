@@ -0,0 +1,83 @@
+from benchmarks.fakes import FakeMoodle
+from mdlpipeline.utils.mdltools import mdl_connect
+from mdlpipeline.utils.mdltools.mdl_connect import WebCampusRosters, create_session
+from mdlpipeline.utils.mdltools.snapshot import RosterSnapshot
+
+import asyncio
+import pytest
+
+
+def make_rosters(courses=4, students=5):
+    return {courseid: {f'{courseid}{i:03d}': [5 if i else 14] for i in range(students)}
+            for courseid in range(1, courses + 1)}
+
+
+@pytest.fixture
+def moodle(monkeypatch):
+    moodle = FakeMoodle(make_rosters())
+    loop = asyncio.new_event_loop()
+    monkeypatch.setattr(mdl_connect, 'URL', loop.run_until_complete(moodle.start()))
+    yield moodle, loop
+    loop.run_until_complete(moodle.close())
+    loop.close()
+
+
+def pull(moodle, snapshot, **kwargs):
+    moodle, loop = moodle
+    wc = WebCampusRosters(sorted(moodle.users), snapshot=snapshot, **kwargs)
+    rosters = loop.run_until_complete(wc.get_rosters())
+    return rosters, wc.fetched
+
+
+def test_snapshot_skips_unchanged_courses(moodle, tmp_path):
+    snapshot = RosterSnapshot(str(tmp_path / 'snapshot.json'))
+    rosters, fetched = pull(moodle, snapshot)
+    assert fetched == [1, 2, 3, 4]
+    assert rosters[2] == {'student': {'2001', '2002', '2003', '2004'},
+                          'auditingstudent': {'2000'}}
+
+    again, fetched = pull(moodle, RosterSnapshot(str(tmp_path / 'snapshot.json')))
+    assert fetched == [] and again == rosters
+
+    moodle[0].users[3].pop()
+    changed, fetched = pull(moodle, snapshot)
+    assert fetched == [3]
+    assert changed[3]['student'] == {'3001', '3002', '3003'}
+    assert {k: v for k, v in changed.items() if k != 3} == {
+        k: v for k, v in rosters.items() if k != 3}
+
+
+def test_snapshot_refetches_stale_and_invalidated(moodle, tmp_path):
+    snapshot = RosterSnapshot(str(tmp_path / 'snapshot.json'))
+    pull(moodle, snapshot)
+    snapshot.invalidate([1, 4])
+    assert pull(moodle, snapshot)[1] == [1, 4]
+
+    # a role change keeps the probed id set, only a stale entry catches it
+    moodle[0].users[2][0]['roles'] = [{'roleid': 5}]
+    assert pull(moodle, snapshot)[1] == []
+    snapshot.max_age = 0
+    rosters, fetched = pull(moodle, snapshot)
+    assert fetched == [1, 2, 3, 4]
+    assert rosters[2]['auditingstudent'] == set()
+
+
+def test_snapshot_failed_probe_is_refetched(moodle, tmp_path):
+    snapshot = RosterSnapshot(str(tmp_path / 'snapshot.json'))
+    pull(moodle, snapshot)
+    assert snapshot.is_current(1, snapshot.entries[1]['signature'])
+    assert not snapshot.is_current(1, None)
+    assert not snapshot.is_current(99, snapshot.entries[1]['signature'])
+
+
+def test_shared_session_reuses_connections(moodle):
+    # two pulls of 4 courses in pages of 2, over at most 2 keep-alive
+    # connections of one session
+    async def run():
+        async with create_session(limit_per_host=2) as session:
+            for _ in range(2):
+                wc = WebCampusRosters(sorted(moodle[0].users), session=session, page_size=2)
+                assert len(await wc.get_rosters()) == 4
+    moodle[1].run_until_complete(run())
+    assert moodle[0].requests == 2 * 4 * 3
+    assert len(moodle[0].peers) <= 2
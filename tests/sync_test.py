@@ -1,17 +1,151 @@
-from mldpipeline.utils.mdltools.mdl_connect import *
-from mldpipeline.utils.sqltools.pc_connect import *
-from mldpipeline.utils.sqltools.queries import *
-from mldpipeline.utils.sqltools.query_tools import *
-from mldpipeline.sync.enrollments import SyncEnrollments
-
-import json
-import pytest 
-
-with open('../data/wc_pc_mapping_wi21.json', 'r') as f:
-    MAPPING_JSON = json.load(f)
-
-RESULTS = []
-
-@pytest.mark.parametrize("course", MAPPING_JSON.keys())
-def test_roster(course):
-    pass
\ No newline at end of file
+from mdlpipeline.utils.mdltools.mdl_connect import *
+from mdlpipeline.utils.sqltools.pc_connect import *
+from mdlpipeline.utils.sqltools.queries import *
+from mdlpipeline.utils.sqltools.query_tools import *
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.sync.mapping import MappingIndex
+
+import asyncio
+import json
+import os
+import pandas as pd
+import time
+import pytest 
+
+with open(os.path.join(os.path.dirname(__file__), '..', 'data', 'wc_pc_mapping_wi21.json'), 'r') as f:
+    MAPPING_JSON = json.load(f)
+
+MAPPING = MappingIndex(MAPPING_JSON)
+
+@pytest.mark.parametrize("course", MAPPING_JSON.keys())
+def test_roster(course):
+    assert MAPPING.ids[course] == MAPPING_JSON[course]['id']
+    assert MAPPING.pc_keys(course)
+
+
+class SlowExtract(SyncEnrollments):
+    """Pipeline whose extracts take `delay` seconds, the PowerCampus one
+    blocking its thread like pymssql."""
+    delay = 0.3
+
+    async def get_wc_rosters(self):
+        await asyncio.sleep(self.delay)
+        return {'wc': True}
+
+    def get_pc_rosters(self):
+        time.sleep(self.delay)
+        return {'pc': True}
+
+
+def make_slow(**kwargs):
+    se = SlowExtract(MAPPING, db_h=object(), conduit=object())
+    se.__dict__.update(kwargs)
+    return se
+
+
+def test_extracts_overlap():
+    se = make_slow()
+    ticks = []
+
+    async def run():
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.ensure_future(tick())
+        try:
+            await se.extract()
+        finally:
+            ticker.cancel()
+
+    asyncio.run(run())
+    assert se.wc_rosters == {'wc': True} and se.pc_rosters == {'pc': True}
+    assert se.timings['wc_pull'] >= 0.3 and se.timings['pc_pull'] >= 0.3
+    assert se.timings['extract'] < 0.55
+    # the blocking PowerCampus pull leaves the event loop running
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.2
+
+
+def test_extract_sql_diff_mode_skips_powercampus():
+    se = make_slow(diff_mode='sql')
+    asyncio.run(se.extract())
+    assert se.wc_rosters == {'wc': True} and se.pc_rosters == {}
+    assert 'pc_pull' not in se.timings
+
+
+def test_extract_failure_propagates():
+    class FailingExtract(SlowExtract):
+        def get_pc_rosters(self):
+            raise ConnectionError('PowerCampus down')
+
+    se = FailingExtract(MAPPING, db_h=object(), conduit=object())
+    with pytest.raises(ConnectionError):
+        asyncio.run(se.extract())
+    assert 'pc_pull' in se.timings
+
+
+def test_pc_rosters_stream_in_chunks(tmp_path):
+    from benchmarks.fakes import SqlitePcConnect
+    from benchmarks.generate import generate_mapping, generate_enrollments, write_powercampus
+    from mdlpipeline.sync.enrollments import ROSTER_DTYPES
+
+    mapping = generate_mapping(30)
+    rows, _, _ = generate_enrollments(mapping, students=15, audit=0.2)
+    write_powercampus(str(tmp_path / 'pc.sqlite'), rows)
+    db_h = SqlitePcConnect(str(tmp_path / 'pc.sqlite'))
+    se = SyncEnrollments(mapping, db_h=db_h, conduit=object())
+    keys = se.get_course_keys()
+
+    whole = get_mapped_rosters(db_h, keys, print=False)
+    chunks = list(get_mapped_rosters(db_h, keys, print=False, chunksize=50, dtype=ROSTER_DTYPES))
+    assert len(chunks) == -(-len(whole) // 50)
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert all(str(chunk[column].dtype) == str(dtype)
+               for chunk in chunks for column, dtype in ROSTER_DTYPES.items())
+
+    se.chunksize = 50
+    streamed = se.get_shard_rosters(keys)
+    expected = SyncEnrollments(mapping, db_h=db_h, conduit=object()).transform_rosters(whole)
+    assert len(expected) and {key: dict(roles) for key, roles in streamed.items()} == {
+        key: dict(roles) for key, roles in expected.items()}
+
+
+def test_sharded_pc_rosters_match_single_query(tmp_path):
+    from benchmarks.fakes import SqlitePcConnect
+    from benchmarks.generate import generate_mapping, generate_enrollments, write_powercampus
+
+    mapping = generate_mapping(40)
+    rows, _, _ = generate_enrollments(mapping, students=10, audit=0.2)
+    write_powercampus(str(tmp_path / 'pc.sqlite'), rows)
+    db_h = SqlitePcConnect(str(tmp_path / 'pc.sqlite'))
+
+    def pull(shards):
+        se = SyncEnrollments(mapping, db_h=db_h, conduit=object())
+        se.shards = shards
+        return se, se.pull_pc_rosters(se.get_course_keys())
+
+    _, single = pull(1)
+    queries = db_h.queries
+    se, sharded = pull(4)
+    assert db_h.queries - queries == 4
+    # shards intern into the pipeline's codes, so the stores merge as is
+    assert sharded.interner is se.interner
+    assert len(single) and {key: dict(roles) for key, roles in sharded.items()} == {
+        key: dict(roles) for key, roles in single.items()}
+    # more shards than keys run one query per key
+    _, few = pull(100)
+    assert len(few) == len(single)
+
+
+def test_failed_shard_fails_the_pull():
+    class FailingShards(SyncEnrollments):
+        def get_shard_rosters(self, keys):
+            if ('BROKEN', None) in keys:
+                raise ConnectionError('shard failed')
+            return self.transform_rosters(pd.DataFrame(
+                {'idnumber': ['1'], 'course': [keys[0][0]], 'section': [''], 'role': ['student']}))
+
+    se = FailingShards(MAPPING, db_h=object(), conduit=object())
+    se.shards = 2
+    with pytest.raises(ConnectionError):
+        se.pull_pc_rosters([('A', None), ('BROKEN', None), ('C', None)])
@@ -0,0 +1,78 @@
+from mdlpipeline.sync.enrollments import SyncEnrollments
+from mdlpipeline.sync.ledger import PendingLedger
+from mdlpipeline.sync.mapping import MappingIndex
+from mdlpipeline.sync.rosters import RosterStore
+from mdlpipeline.sync.warm import WarmState
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+ENTRIES = {'BSC5102Winter2021': {'courses': ['BSC5102'], 'id': 4748}}
+
+
+def pulled(tmp_path):
+    se = SyncEnrollments(MappingIndex(ENTRIES, digest='a1'), session=object(), conduit=object())
+    se.wc_rosters = RosterStore.from_rosters({4748: {'student': ['0001', '0003']}}, se.interner)
+    se.pc_rosters = RosterStore.from_rosters(
+        {('BSC5102', ''): {'student': ['0001', '0002'], 'auditingstudent': ['0004']}},
+        se.interner)
+    se.wc_userids = {'0001': 11, '0003': 13}
+    return se
+
+
+def test_saved_rosters_are_mapped_back(tmp_path):
+    state = WarmState(str(tmp_path))
+    se = pulled(tmp_path)
+    assert state.save(se) and state.save(se)
+    assert sorted(os.listdir(tmp_path))[0] == 'idnumbers.2.npy'
+    assert len(os.listdir(tmp_path)) == 8
+
+    restored = SyncEnrollments(MappingIndex(ENTRIES, digest='a1'), session=object(),
+                               conduit=object())
+    assert WarmState(str(tmp_path)).restore(restored)
+    assert isinstance(restored.pc_rosters.codes(('BSC5102', ''), 'student'), np.memmap)
+    assert dict(restored.pc_rosters) == dict(se.pc_rosters)
+    assert dict(restored.wc_rosters) == dict(se.wc_rosters)
+    assert restored.wc_userids == se.wc_userids
+    # changes replace the mapped arrays instead of writing to them
+    restored.pc_rosters.add(('BSC5102', ''), 'student', ['0005'])
+    restored.pc_rosters.discard(('BSC5102', ''), restored.interner.encode(['0001']))
+    assert restored.pc_rosters[('BSC5102', '')]['student'] == {'0002', '0005'}
+
+
+def test_warm_start_diffs_saved_rosters(tmp_path):
+    state = WarmState(str(tmp_path))
+    state.save(pulled(tmp_path))
+    se = SyncEnrollments.warm_start(MappingIndex(ENTRIES, digest='a1'), state,
+                                    session=object(), conduit=object())
+    df = se.conduit_dfs['enrollments']
+    assert set(zip(df.action, df.idnumber, df.role)) == {
+        ('add', '0002', 'student'), ('add', '0004', 'auditingstudent'),
+        ('drop', '0003', 'student')}
+    assert 'warm_load' in se.timings
+
+    # a changed mapping file or another term invalidates the saved rosters
+    assert SyncEnrollments.warm_start(MappingIndex(ENTRIES, digest='b2'), state,
+                                      session=object(), conduit=object()) is None
+    assert SyncEnrollments.warm_start(MappingIndex(ENTRIES, digest='a1'), state,
+                                      session=object(), conduit=object(), term='Spring') is None
+
+
+def test_warm_start_resends_expired_ledger_records(tmp_path):
+    state = WarmState(str(tmp_path))
+    state.save(pulled(tmp_path))
+    ledger = PendingLedger(str(tmp_path / 'ledger.json'), ttl=60)
+    ledger.record(pd.DataFrame([['add', 'BSC5102Winter2021', '0002', 'student'],
+                                ['drop', 'BSC5102Winter2021', '0003', 'student']],
+                               columns=['action', 'shortname', 'idnumber', 'role']),
+                  now=time.time() - 120)
+    ledger.record(pd.DataFrame([['add', 'BSC5102Winter2021', '0004', 'auditingstudent']],
+                               columns=['action', 'shortname', 'idnumber', 'role']))
+    se = SyncEnrollments.warm_start(MappingIndex(ENTRIES, digest='a1'), state,
+                                    session=object(), conduit=object(), ledger=ledger)
+    df = se.conduit_dfs['enrollments']
+    assert set(zip(df.action, df.idnumber)) == {('add', '0002'), ('drop', '0003')}
+    assert len(ledger) == 1